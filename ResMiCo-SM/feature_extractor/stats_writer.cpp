@@ -3,11 +3,14 @@
 #include "util/logger.hpp"
 #include "util/util.hpp"
 
+#include <algorithm>
+#include <cmath>
 #include <cstddef>
 #include <filesystem>
 #include <json/json.hpp>
 #include <limits>
 #include <string>
+#include <tuple>
 #include <vector>
 
 std::vector<std::string> headers = { "assembler",
@@ -42,6 +45,29 @@ std::vector<std::string> headers = { "assembler",
                                      "Extensive_misassembly",
                                      "Extensive_misassembly_by_pos" };
 
+/**
+ * Feature names and histogram ranges (min, max, bin count) of the metrics in StatsWriter::sums, in
+ * order; must match HISTOGRAM_RANGES in resmico/histograms.py
+ */
+const std::vector<std::tuple<std::string, double, double, uint32_t>> histogram_ranges = {
+    { "min_insert_size_Match", 0, 2000, 400 },   { "mean_insert_size_Match", 0, 2000, 400 },
+    { "stdev_insert_size_Match", 0, 2000, 400 }, { "max_insert_size_Match", 0, 2000, 400 },
+    { "min_mapq_Match", 0, 256, 256 },           { "mean_mapq_Match", 0, 256, 256 },
+    { "stdev_mapq_Match", 0, 256, 256 },         { "max_mapq_Match", 0, 256, 256 },
+    { "min_al_score_Match", -128, 128, 256 },    { "mean_al_score_Match", -128, 128, 256 },
+    { "stdev_al_score_Match", -128, 128, 256 },  { "max_al_score_Match", -128, 128, 256 },
+    { "seq_window_perc_gc", 0, 1, 100 },         { "seq_window_entropy", 0, 2, 100 },
+    { "coverage", 0, 1024, 512 }
+};
+
+void Histogram::add(double v) {
+    if (std::isnan(v)) {
+        return;
+    }
+    const int64_t bin = static_cast<int64_t>(std::floor((v - min) / (max - min) * counts.size()));
+    counts[std::clamp(bin, int64_t(0), static_cast<int64_t>(counts.size()) - 1)]++;
+}
+
 /** Truncate to 3 decimals */
 std::string r3(float v) {
     return std::to_string(static_cast<int>(v * 1000) / 1000) + '.'
@@ -196,23 +222,22 @@ StatsWriter::StatsWriter(const std::filesystem::path &out_dir,
     toc.open(out_dir / "toc");
     toc_chunk.open(out_dir / "toc_chunked");
     binary_features = out_dir / "features_binary";
-    binary_chunk_features = out_dir / "features_binary_chunked";
-    // make sure the feature files are empty (we don't inadvertently append to existing data)
+    // make sure the feature file is empty (we don't inadvertently append to existing data)
     std::filesystem::remove(binary_features);
-    std::filesystem::remove(binary_chunk_features);
 
-    sums.resize(15, 0);
-    sums2.resize(15, 0);
+    sums.resize(histogram_ranges.size(), 0);
+    sums2.resize(histogram_ranges.size(), 0);
+    for (const auto &[name, min, max, bins] : histogram_ranges) {
+        histograms.emplace_back(min, max, bins);
+    }
     tsv_stream.precision(3);
 
     // write tsv header
     tsv_stream << join_vec(headers, '\t');
 
-    // write toc header for binary features (entire contig + chunks)
-    std::string toc_str
-            = "Contig\tLengthBases\tMisassemblyCnt\tSizeBytes\tBreakingPoints\tAvgCoverage\n";
-    toc << toc_str;
-    toc_chunk << toc_str;
+    // write toc header for binary features (entire contig) and for the chunk intervals
+    toc << "Contig\tLengthBases\tMisassemblyCnt\tSizeBytes\tBreakingPoints\tAvgCoverage\n";
+    toc_chunk << "Contig\tStart\tStop\tMisassemblyCnt\tBreakingPoints\n";
 }
 
 std::string to_string(const std::vector<MisassemblyInfo> &mis, uint32_t start = 0) {
@@ -298,51 +323,33 @@ void StatsWriter::write_stats(QueueItem &&item,
 
         if (!std::isnan(s.mean_i_size)) { // coverage > 0
             count_mean++;
-            sums[0] += s.min_i_size;
-            sums2[0] += s.min_i_size * s.min_i_size;
-            sums[1] += s.mean_i_size;
-            sums2[1] += s.mean_i_size * s.mean_i_size;
-            sums[3] += s.max_i_size;
-            sums2[3] += s.max_i_size * s.max_i_size;
-
-            sums[4] += s.min_map_qual;
-            sums2[4] += s.min_map_qual * s.min_map_qual;
-            sums[5] += s.mean_map_qual;
-            sums2[5] += s.mean_map_qual * s.mean_map_qual;
-            sums[7] += s.max_map_qual;
-            sums2[7] += s.max_map_qual * s.max_map_qual;
-
-            sums[8] += s.min_al_score;
-            sums2[8] += s.min_al_score * s.min_al_score;
-            sums[9] += s.mean_al_score;
-            sums2[9] += s.mean_al_score * s.mean_al_score;
-            sums[11] += s.max_al_score;
-            sums2[11] += s.max_al_score * s.max_al_score;
+            add_value(0, s.min_i_size);
+            add_value(1, s.mean_i_size);
+            add_value(3, s.max_i_size);
+
+            add_value(4, s.min_map_qual);
+            add_value(5, s.mean_map_qual);
+            add_value(7, s.max_map_qual);
+
+            add_value(8, s.min_al_score);
+            add_value(9, s.mean_al_score);
+            add_value(11, s.max_al_score);
 
             if (!std::isnan(s.std_dev_i_size)) {
                 assert(!std::isnan(s.std_dev_al_score && !std::isnan(s.std_dev_map_qual)));
                 count_std_dev++;
-                sums[2] += s.std_dev_i_size;
-                sums2[2] += s.std_dev_i_size * s.std_dev_i_size;
-
-                sums[6] += s.std_dev_map_qual;
-                sums2[6] += s.std_dev_map_qual * s.std_dev_map_qual;
-
-                sums[10] += s.std_dev_al_score;
-                sums2[10] += s.std_dev_al_score * s.std_dev_al_score;
+                add_value(2, s.std_dev_i_size);
+                add_value(6, s.std_dev_map_qual);
+                add_value(10, s.std_dev_al_score);
             }
         }
 
-        sums[14] += s.coverage;
-        sums2[14] += s.coverage * s.coverage;
+        add_value(14, s.coverage);
 
         // gc percent and entropy can be computed even on positions with zero coverage (because
         // they summarize state accross multiple positions)
-        sums[12] += s.gc_percent;
-        sums2[12] += s.gc_percent * s.gc_percent;
-
-        sums[13] += s.entropy;
-        sums2[13] += s.entropy * s.entropy;
+        add_value(12, s.gc_percent);
+        add_value(13, s.entropy);
 
         tsv_stream << assembler << '\t' << item.reference_name << '\t' << pos << '\t';
 
@@ -370,12 +377,33 @@ void StatsWriter::write_stats(QueueItem &&item,
 
     std::string binary_stats_file = out_dir / (item.reference_name + ".gz");
     write_data(item.reference, binary_stats_file, cs);
+    const uint64_t size_bytes = std::filesystem::file_size(binary_stats_file);
     toc << item.reference_name << '\t' << item.stats.size() << '\t' << mis.size() << '\t'
-        << std::filesystem::file_size(binary_stats_file) << '\t' << to_string(mis) << '\t'
-        << avg_coverage / item.stats.size() << std::endl;
+        << size_bytes << '\t' << to_string(mis) << '\t' << avg_coverage / item.stats.size()
+        << std::endl;
     append_file(binary_features, binary_stats_file);
 
-    // ----- start selecting a chunk and writing its stats to disk ----
+    TocRecord record = { binary_features_size,
+                         toc_names.size(),
+                         static_cast<uint32_t>(item.reference_name.size()),
+                         static_cast<uint32_t>(item.stats.size()),
+                         static_cast<uint32_t>(size_bytes),
+                         static_cast<uint32_t>(mis.size()),
+                         static_cast<float>(avg_coverage / item.stats.size()),
+                         static_cast<uint32_t>(toc_breakpoints.size() / 2),
+                         static_cast<uint32_t>(mis.size()),
+                         0 };
+    toc_records.push_back(record);
+    for (const auto &mi : mis) {
+        toc_breakpoints.push_back(mi.break_start);
+        toc_breakpoints.push_back(mi.break_end);
+    }
+    toc_names += item.reference_name;
+    binary_features_size += size_bytes;
+
+    // ----- select the chunk(s) used for training on short sequences -----
+    // chunks are not written to disk separately; each chunk is recorded in #toc_chunk as an
+    // interval [start, stop) of the full contig record in #binary_features
     uint32_t start, stop;
     if (mis.empty()) {
         // select a chunk of length chunk_size randomly from the string
@@ -387,25 +415,16 @@ void StatsWriter::write_stats(QueueItem &&item,
             start = rnd_start(random_engine);
             stop = start + chunk_size;
         }
-        std::string fname = out_dir / (item.reference_name + ".ok.gz");
-        write_data(item.reference, fname, cs, start, stop);
-        toc_chunk << item.reference_name << '\t' << chunk_size << "\t0\t"
-                  << std::filesystem::file_size(fname) << "\t-" << std::endl;
-        append_file(binary_chunk_features, fname);
+        toc_chunk << item.reference_name << '\t' << start << '\t' << stop << "\t0\t-" << std::endl;
     } else {
-        // create one stats file for each mis-assembly breakpoint
+        // create one chunk for each mis-assembly breakpoint
         for (uint32_t i = 0; i < mis.size(); ++i) {
             std::tie(start, stop) = get_chunk_interval(mis[i], contig_len);
 
             assert(mis[i].break_start >= start);
 
-            std::string fname
-                    = out_dir / (item.reference_name + ".mis" + std::to_string(i) + ".gz");
-            write_data(item.reference, fname, cs, start, stop);
-            toc_chunk << item.reference_name + "_" + std::to_string(i) << '\t' << chunk_size
-                      << "\t1\t" << std::filesystem::file_size(fname) << '\t'
+            toc_chunk << item.reference_name << '\t' << start << '\t' << stop << "\t1\t"
                       << to_string({ mis[i] }, start) << std::endl;
-            append_file(binary_chunk_features, fname);
         }
     }
 
@@ -445,6 +464,23 @@ void StatsWriter::write_summary() {
     j["coverage"]["sum"] = sums[14];
     j["coverage"]["sum2"] = sums2[14];
 
+    for (uint32_t i = 0; i < histograms.size(); ++i) {
+        j["histograms"][std::get<0>(histogram_ranges[i])] = { { "min", histograms[i].min },
+                                                               { "max", histograms[i].max },
+                                                               { "counts", histograms[i].counts } };
+    }
+
     std::ofstream stats(out_dir / "stats");
     stats << j.dump(2);
+
+    // the binary toc; the layout must match resmico/toc.py
+    std::ofstream toc_binary(out_dir / "toc_binary", std::ios::binary);
+    const uint64_t header[] = { toc_records.size(), toc_breakpoints.size() / 2, toc_names.size() };
+    toc_binary.write("RMCTOC01", 8);
+    toc_binary.write(reinterpret_cast<const char *>(header), sizeof(header));
+    toc_binary.write(reinterpret_cast<const char *>(toc_records.data()),
+                     toc_records.size() * sizeof(TocRecord));
+    toc_binary.write(reinterpret_cast<const char *>(toc_breakpoints.data()),
+                     toc_breakpoints.size() * sizeof(uint32_t));
+    toc_binary.write(toc_names.data(), toc_names.size());
 }
@@ -61,14 +61,48 @@ struct QueueItem {
     std::string reference; // the actual reference contig
 };
 
+/**
+ * A fixed-width record of the binary table of contents (toc_binary), which can be memory-mapped
+ * by the Python reader (see resmico/toc.py for the file layout).
+ */
+struct TocRecord {
+    uint64_t offset; // offset of the contig record in features_binary
+    uint64_t name_offset; // offset of the contig name in the name blob
+    uint32_t name_len;
+    uint32_t length;
+    uint32_t size_bytes;
+    uint32_t misassembly;
+    float avg_coverage;
+    uint32_t breakpoint_idx; // index of the first breakpoint of the contig in the breakpoint array
+    uint32_t breakpoint_cnt;
+    uint32_t reserved;
+};
+static_assert(sizeof(TocRecord) == 48, "TocRecord must match TOC_DTYPE in resmico/toc.py");
+
+/**
+ * A fixed-bin histogram of the values of a feature over [min, max); values outside the range are
+ * counted in the first/last bin and NaN values are ignored. Histograms with the same range (see
+ * resmico/histograms.py) are merged by adding up the counts, which allows computing quantiles
+ * across data sets without reading the features.
+ */
+struct Histogram {
+    Histogram(double min, double max, uint32_t bins) : min(min), max(max), counts(bins, 0) {}
+
+    void add(double v);
+
+    double min;
+    double max;
+    std::vector<uint64_t> counts;
+};
+
 /**
  * Writes statistics for all the contigs in a BAM alignment file.
  */
 class StatsWriter {
   public:
     /**
-     * @param out_dir directory where output files (features.tsv.gz, stats, toc, etc. will be
-     * written
+     * @param out_dir directory where output files (features.tsv.gz, stats, toc, toc_chunked etc.
+     * will be written
      * @param chunk_size size of contig chunks created around breakpoints
      * @param breakpoint_margin how close to the contig edge can a breakpoint be
      */
@@ -93,6 +127,9 @@ class StatsWriter {
                      const std::string &assembler,
                      const std::vector<MisassemblyInfo> &mis);
 
+    /**
+     * Writes the stats (sums, sums of squares and histograms for each metric) and the binary toc
+     */
     void write_summary();
 
   public: // Visible for testing
@@ -100,14 +137,26 @@ class StatsWriter {
                                                      uint32_t contig_len);
 
   private:
+    /**
+     * Adds v to the sum, sum of squares and histogram of the metric at index idx in #sums (v is
+     * squared in its own type, as the sums of squares were always computed)
+     */
+    template <typename T>
+    void add_value(uint32_t idx, T v) {
+        sums[idx] += v;
+        sums2[idx] += v * v;
+        histograms[idx].add(v);
+    }
+
     ContigStats contig_stats;
 
     std::filesystem::path out_dir;
 
     /**
      * The number of bases around a breaking point (a mis-assembly point, as
-     * detected by metaQUAST) that are going to be written to train the network on representative
-     * data; for contigs that are not misassembled, a random sequence of size chunk_size is picked
+     * detected by metaQUAST) that are going to be recorded in toc_chunked to train the network on
+     * representative data; for contigs that are not misassembled, a random sequence of size
+     * chunk_size is picked
      */
     uint32_t chunk_size;
 
@@ -118,15 +167,22 @@ class StatsWriter {
     each contig that was written using #write_stats.*/
     std::ofstream toc;
 
-    /** Table of contents for the contig chunks. If a contig has multiple breakpoints (rare) one
-     * line for each breakpoint will be written */
+    /** Table of contents for the contig chunks. Each line describes an interval [start, stop) of a
+     * contig in #binary_features, with breakpoints relative to start. If a contig has multiple
+     * breakpoints (rare) one line for each breakpoint will be written */
     std::ofstream toc_chunk;
 
     /** File containing the features for all the contigs in #toc */
     std::string binary_features;
 
-    /** File containing the features for all the contig chunks in #toc */
-    std::string binary_chunk_features;
+    /** Size of #binary_features, i.e. the offset of the next contig record */
+    uint64_t binary_features_size = 0;
+
+    /** Records, breakpoints (start, end pairs) and concatenated contig names of the binary toc,
+     * written by #write_summary */
+    std::vector<TocRecord> toc_records;
+    std::vector<uint32_t> toc_breakpoints;
+    std::string toc_names;
 
     std::mt19937 random_engine;
 
@@ -145,6 +201,9 @@ class StatsWriter {
     /** The sums of squares of all the non-NaN position for each of the 12 float metrics */
     std::vector<double> sums2;
 
+    /** Histograms of all the non-NaN positions for each metric in #sums */
+    std::vector<Histogram> histograms;
+
     /* Selects the position of the breakpoint in the contig chunk */
     std::uniform_int_distribution<uint32_t> breakpoint_gen;
 };
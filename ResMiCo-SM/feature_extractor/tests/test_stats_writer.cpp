@@ -7,6 +7,7 @@
 #include <json/json.hpp>
 
 #include <filesystem>
+#include <numeric>
 #include <string>
 #include <unordered_map>
 #include <vector>
@@ -44,11 +45,61 @@ void check_toc_files() {
     std::getline(toc_read_chunk, line); // skip header
     for (uint32_t i : { 0, 1 }) {
         std::string contig_name;
-        uint32_t is_missasembly, offset, length;
-        toc_read_chunk >> contig_name >> length >> is_missasembly >> offset >> breaking_points;
-        ASSERT_EQ(i == 0 ? "Contig2_0" : "Contig1", contig_name);
+        uint32_t is_missasembly, start, stop;
+        toc_read_chunk >> contig_name >> start >> stop >> is_missasembly >> breaking_points;
+        ASSERT_EQ(i == 0 ? "Contig2" : "Contig1", contig_name);
         ASSERT_EQ(i == 0 ? 1 : 0, is_missasembly);
+        ASSERT_TRUE(start < stop && stop <= 500);
     }
+
+    // check the binary table of contents, which must describe the same contigs as the text toc
+    std::ifstream toc_binary("/tmp/stats/toc_binary", std::ios::binary);
+    char magic[8];
+    uint64_t header[3];
+    toc_binary.read(magic, 8);
+    toc_binary.read(reinterpret_cast<char *>(header), sizeof(header));
+    ASSERT_EQ("RMCTOC01", std::string(magic, 8));
+    ASSERT_EQ(2, header[0]);
+    std::vector<TocRecord> records(header[0]);
+    std::vector<uint32_t> breakpoints(2 * header[1]);
+    std::string names(header[2], ' ');
+    toc_binary.read(reinterpret_cast<char *>(records.data()), records.size() * sizeof(TocRecord));
+    toc_binary.read(reinterpret_cast<char *>(breakpoints.data()),
+                    breakpoints.size() * sizeof(uint32_t));
+    toc_binary.read(names.data(), names.size());
+    ASSERT_TRUE(toc_binary.good());
+    ASSERT_EQ("Contig2Contig1", names);
+    ASSERT_EQ(0, records[0].offset);
+    ASSERT_EQ(records[0].size_bytes, records[1].offset);
+    ASSERT_EQ(std::filesystem::file_size("/tmp/stats/features_binary"),
+              records[1].offset + records[1].size_bytes);
+    for (uint32_t i : { 0, 1 }) {
+        ASSERT_EQ(500, records[i].length);
+        ASSERT_EQ(7, records[i].name_len);
+        ASSERT_EQ(i == 0 ? 1 : 0, records[i].misassembly);
+        ASSERT_EQ(i == 0 ? 1 : 0, records[i].breakpoint_cnt);
+    }
+}
+
+struct ChunkInfo {
+    std::string contig_name;
+    uint32_t start;
+    uint32_t stop;
+    uint32_t is_misassembly;
+    std::string breaking_points;
+};
+
+std::vector<ChunkInfo> read_chunk_toc(const std::string &toc) {
+    std::ifstream toc_read(toc);
+    std::string line;
+    std::getline(toc_read, line); // skip header
+    std::vector<ChunkInfo> result;
+    ChunkInfo ci;
+    while (toc_read >> ci.contig_name >> ci.start >> ci.stop >> ci.is_misassembly
+           >> ci.breaking_points) {
+        result.push_back(ci);
+    }
+    return result;
 }
 
 void separate_contig_data(const std::string &toc,
@@ -97,10 +148,9 @@ TEST(WriteData, TwoReads) {
     }
     stats_writer.write_summary();
 
-    std::string out_files[]
-            = { "/tmp/stats/features.tsv.gz", "/tmp/stats/toc",
-                "/tmp/stats/toc_chunked",     "/tmp/stats/stats",
-                "/tmp/stats/features_binary", "/tmp/stats/features_binary_chunked" };
+    std::string out_files[] = { "/tmp/stats/features.tsv.gz", "/tmp/stats/toc",
+                                "/tmp/stats/toc_chunked",     "/tmp/stats/stats",
+                                "/tmp/stats/features_binary" };
     for (const std::string &fname : out_files) {
         ASSERT_TRUE(std::filesystem::exists(fname));
     }
@@ -456,6 +506,17 @@ TEST(WriteData, TwoReadsFeaturesAndStats) {
     ASSERT_NEAR(j["al_score"]["sum2"]["mean"], mean_al_score_sum2, 1e-5);
     ASSERT_NEAR(j["al_score"]["sum"]["stdev"], std_dev_al_score_sum, 1e-5);
     ASSERT_NEAR(j["al_score"]["sum2"]["stdev"], std_dev_al_score_sum2, 1e-5);
+
+    // the histograms count the same (non-NaN) positions as the sums
+    auto histogram_count = [&](const std::string &name) {
+        const std::vector<uint64_t> counts = j["histograms"][name]["counts"];
+        return std::accumulate(counts.begin(), counts.end(), uint64_t(0));
+    };
+    ASSERT_EQ(histogram_count("mean_insert_size_Match"), mean_count);
+    ASSERT_EQ(histogram_count("stdev_insert_size_Match"), std_dev_count);
+    ASSERT_EQ(histogram_count("coverage"), j["all_count"]);
+    ASSERT_EQ(j["histograms"]["min_al_score_Match"]["min"], -128);
+    ASSERT_EQ(j["histograms"]["min_al_score_Match"]["counts"].size(), 256);
 }
 
 TEST(StatsWriter, get_chunk_interval) {
@@ -512,16 +573,24 @@ TEST(WriteData, TwoReadsChunkStats) {
     }
     stats_writer.write_summary();
 
-    // separate data for each contig from teh concatenated features file
-    separate_contig_data("/tmp/stats/toc_chunked", "/tmp/stats/features_binary_chunked",
-                         "/tmp/stats/");
+    // chunks are intervals of the full contig records, so we check the chunk interval of the full
+    // data for the first contig (Contig2)
+    std::vector<ChunkInfo> chunks = read_chunk_toc("/tmp/stats/toc_chunked");
+    ASSERT_EQ(2, chunks.size());
+    ASSERT_EQ("Contig2", chunks[0].contig_name);
+    ASSERT_EQ(5, chunks[0].stop - chunks[0].start);
+    ASSERT_EQ(1, chunks[0].is_misassembly);
+    ASSERT_EQ("Contig1", chunks[1].contig_name);
+    ASSERT_EQ(0, chunks[1].is_misassembly);
 
+    // separate data for each contig from the concatenated features file
+    separate_contig_data("/tmp/stats/toc", "/tmp/stats/features_binary", "/tmp/stats/");
 
     uint32_t len;
 
     igzstream stats2("/tmp/stats/binary_features0");
     stats2.read(reinterpret_cast<char *>(&len), 4);
-    ASSERT_EQ(5, len);
+    ASSERT_EQ(500, len);
 
     std::string contig(len, 'N');
     std::vector<uint16_t> coverage(len);
@@ -590,7 +659,7 @@ TEST(WriteData, TwoReadsChunkStats) {
     stats2.read(reinterpret_cast<char *>(gc_percent.data()), len * sizeof(gc_percent[0]));
     stats2.read(reinterpret_cast<char *>(entropy.data()), len * sizeof(entropy[0]));
 
-    for (uint32_t i = 0; i < len; ++i) {
+    for (uint32_t i = chunks[0].start; i < chunks[0].stop; ++i) {
         ASSERT_EQ('A', contig[i]) << "Position: " << i;
         ASSERT_EQ(0, num_proper_snp[i]);
         ASSERT_EQ(0, coverage[i]);
@@ -643,7 +712,6 @@ TEST(WriteData, TwoReadsChunkStatsWithOffset) {
     std::string contig_names[] = { "Contig2", "Contig1" };
     std::string fasta_files[] = { "data/test2.fa.gz", "data/test.fa" };
     std::string bam_files[] = { "data/test2.bam", "data/test1.bam" };
-    int32_t offset = 0;
     for (uint32_t rep = 0; rep < 10; ++rep) {
         StatsWriter stats_writer("/tmp/stats/", chunk_size, breakpoint_offset);
         for (uint32_t i : { 0, 1 }) {
@@ -655,14 +723,18 @@ TEST(WriteData, TwoReadsChunkStatsWithOffset) {
         }
         stats_writer.write_summary();
 
-        // separate data for each contig from teh concatenated features file
-        separate_contig_data("/tmp/stats/toc_chunked", "/tmp/stats/features_binary_chunked",
-                             "/tmp/stats/");
+        std::vector<ChunkInfo> chunks = read_chunk_toc("/tmp/stats/toc_chunked");
+        ASSERT_EQ("Contig2", chunks[0].contig_name);
+        ASSERT_EQ(chunk_size, chunks[0].stop - chunks[0].start);
+        ASSERT_TRUE(chunks[0].start <= breakpoint_pos && breakpoint_pos < chunks[0].stop);
+
+        // separate data for each contig from the concatenated features file
+        separate_contig_data("/tmp/stats/toc", "/tmp/stats/features_binary", "/tmp/stats/");
         uint32_t len;
 
         igzstream stats2("/tmp/stats/binary_features0");
         stats2.read(reinterpret_cast<char *>(&len), 4);
-        ASSERT_EQ(5, len);
+        ASSERT_EQ(500, len);
 
         std::string contig(len, 'N');
         std::vector<uint16_t> coverage(len);
@@ -670,22 +742,18 @@ TEST(WriteData, TwoReadsChunkStatsWithOffset) {
         for (uint32_t i : { 0, 1, 2, 3 }) {
             n_bases[i].resize(len);
         }
-        std::vector<uint16_t> num_snps(len);
 
         stats2.read(reinterpret_cast<char *>(contig.data()), len);
         stats2.read(reinterpret_cast<char *>(coverage.data()), len * sizeof(coverage[0]));
         for (uint32_t i : { 0, 1, 2, 3 }) {
             stats2.read(reinterpret_cast<char *>(n_bases[i].data()), len * sizeof(n_bases[i][0]));
         }
-        stats2.read(reinterpret_cast<char *>(num_snps.data()), len * sizeof(num_snps[0]));
-
 
-        for (uint32_t i = 0; i < len; ++i) {
-            ASSERT_EQ('A', contig[i]) << "Position: " << i;
-            assert(i + breakpoint_pos + offset > chunk_size / 2);
-            uint32_t contig_idx = i + breakpoint_pos + offset - chunk_size / 2;
-            ASSERT_EQ(expected_coverage[contig_idx], coverage[i]);
-            uint16_t base_counts[] = { n_bases[0][i], n_bases[1][i], n_bases[2][i], n_bases[3][i] };
+        for (uint32_t contig_idx = chunks[0].start; contig_idx < chunks[0].stop; ++contig_idx) {
+            ASSERT_EQ('A', contig[contig_idx]) << "Position: " << contig_idx;
+            ASSERT_EQ(expected_coverage[contig_idx], coverage[contig_idx]);
+            uint16_t base_counts[] = { n_bases[0][contig_idx], n_bases[1][contig_idx],
+                                       n_bases[2][contig_idx], n_bases[3][contig_idx] };
             ASSERT_THAT(base_counts,
                         ElementsAre(expected_bases[0][contig_idx], expected_bases[1][contig_idx],
                                     expected_bases[2][contig_idx], expected_bases[3][contig_idx]));
@@ -6,6 +6,7 @@ from resmico.commands import bam2feat
 from resmico.commands import train
 from resmico.commands import evaluate
 from resmico.commands import filter_contigs
+from resmico.commands import repack
 
 
 def main(args=None):
@@ -17,7 +18,7 @@ def main(args=None):
     desc = 'ResMiCo: mis-assembly detection with deep learning'
     epi = """DESCRIPTION:
     Usage: resmico <subcommand> <subcommand_params>
-    subcommand is one of: bam2feat, train, evaluate, filter
+    subcommand is one of: bam2feat, train, evaluate, filter, repack
     Example: resmico train -h
 
     For general info, see https://github.com/leylabmpi/resmico/
@@ -39,7 +40,10 @@ def main(args=None):
     evaluator.set_defaults(func=evaluate.main)
     # filter
     filter_cntgs = filter_contigs.parse_args(subparsers=subparsers)
-    filter_cntgs.set_defaults(func=filter_contigs.main)    
+    filter_cntgs.set_defaults(func=filter_contigs.main)
+    # repack
+    repacker = repack.parse_args(subparsers=subparsers)
+    repacker.set_defaults(func=repack.main)
 
     # parsing args
     if args:
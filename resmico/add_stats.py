@@ -1,116 +1,175 @@
+"""
+Adds the coverage, GC content and sequence entropy sums (and sums of squares) and histograms to the stats files of
+feature directories created by older bam2feat versions, and the average coverage of each contig to their toc files.
+
+Feature directories are processed independently in parallel worker processes. Each worker streams the contigs of its
+directory in batches (so peak memory is bounded by the batch size rather than the data set size), merges the batch
+moments in float64 using Chan's parallel algorithm and finally replaces the stats and toc files atomically (the
+previous versions are kept as stats_old/toc_old).
+"""
 import argparse
+import csv
 import json
-import os
 import logging
+import mmap
+import multiprocessing
+import os
 from shutil import copyfile
 import sys
+from timeit import default_timer as timer
+from typing import Dict, List
 
 import numpy as np
 
 from resmico import contig_reader
-from resmico import models_fl as Models
+from resmico import histograms
+from resmico import toc
 from resmico.commands import arguments
 
-
-def get_toc_name(contig_info: Models.ContigInfo, is_chunked: bool, base_dir: str):
-    return os.path.join(os.path.dirname(os.path.join(base_dir, contig_info.file)), 'toc' + (
-        '_chunked' if is_chunked else ''))
-
-
-def get_stats_name(fname: Models.ContigInfo, base_dir: str):
-    return os.path.join(os.path.dirname(os.path.join(base_dir, fname)), 'stats')
-
-
-def write_stats(prev_file, feature_files_path, sum_entropy, sum2_entropy, sum_gc_percent, sum2_gc_percent, sum_coverage,
-                sum2_coverage, all_count):
-    stats_fname = get_stats_name(prev_file, feature_files_path)
-    stats_file = open(stats_fname)
-    stats = json.load(stats_file)
-    stats_file.close()
-    copyfile(stats_fname, stats_fname + '_old')
-    stats['seq_window_entropy'] = {'sum': sum_entropy, 'sum2': sum2_entropy}
-    stats['seq_window_perc_gc'] = {'sum': sum_gc_percent, 'sum2': sum2_gc_percent}
-    stats['coverage'] = {'sum': int(sum_coverage), 'sum2': int(sum2_coverage)}
-    stats['all_count'] = int(all_count)
-    stats_file = open(stats_fname, 'w')
-    json.dump(stats, stats_file, indent=2)
-    stats_file.close()
+FEATURES = ['coverage', 'seq_window_perc_gc', 'seq_window_entropy']
+
+
+class Moments:
+    """ Count, mean and sum of squared deviations from the mean of a stream of values, mergeable across batches """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, values: np.ndarray):
+        """ Merges the moments of values into self (Chan et al.) """
+        count = len(values)
+        if count == 0:
+            return
+        values = values.astype(np.float64)
+        mean = float(np.mean(values))
+        m2 = float(np.sum((values - mean) ** 2))
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    @property
+    def sum(self) -> float:
+        return self.mean * self.count
+
+    @property
+    def sum2(self) -> float:
+        return self.m2 + self.mean ** 2 * self.count
+
+
+def _replace(fname: str, content: str):
+    """ Atomically replaces the content of fname, keeping a copy of the previous version in fname_old """
+    copyfile(fname, fname + '_old')
+    tmp_file = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(content)
+    os.replace(tmp_file, fname)
+
+
+def process_dir(stats_file: str, batch_size: int) -> int:
+    """
+    Computes the coverage/GC/entropy moments and the average contig coverages for the feature directory of stats_file
+    and updates its stats and toc files.
+    Returns:
+        - the number of contigs in the directory
+    """
+    start = timer()
+    base = stats_file[:-len('stats')]
+    with open(base + 'toc') as f:
+        rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = next(rd, None)
+        rows = list(rd)
+    if header is None:
+        logging.info(f'Empty toc for {stats_file}, skipping')
+        return 0
+
+    moments: Dict[str, Moments] = {feature_name: Moments() for feature_name in FEATURES}
+    feature_histograms = {feature_name: histograms.Histogram.empty(feature_name) for feature_name in FEATURES}
+    avg_coverages: List[float] = []
+    with open(base + 'features_binary', 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = memoryview(mm)
+        offset = 0
+        for batch_start in range(0, len(rows), batch_size):
+            batch: Dict[str, List[np.ndarray]] = {feature_name: [] for feature_name in FEATURES}
+            for row in rows[batch_start:batch_start + batch_size]:
+                size_bytes = int(row[3])
+                features = contig_reader._read_contig_data(data[offset:offset + size_bytes], FEATURES)
+                offset += size_bytes
+                avg_coverages.append(round(float(np.average(features['coverage'])), 5))
+                for feature_name in FEATURES:
+                    batch[feature_name].append(features[feature_name])
+            for feature_name in FEATURES:
+                values = np.concatenate(batch[feature_name])
+                moments[feature_name].add(values)
+                feature_histograms[feature_name].add(values)
+            del batch
+        del data
+
+    with open(stats_file) as f:
+        stats = json.load(f)
+    for feature_name in ['seq_window_entropy', 'seq_window_perc_gc']:
+        stats[feature_name] = {'sum': moments[feature_name].sum, 'sum2': moments[feature_name].sum2}
+    # coverage is an integer feature, so the float64 moments are exact up to rounding
+    stats['coverage'] = {'sum': int(round(moments['coverage'].sum)), 'sum2': int(round(moments['coverage'].sum2))}
+    stats['all_count'] = int(moments['coverage'].count)
+    for feature_name, histogram in feature_histograms.items():
+        stats.setdefault('histograms', {})[feature_name] = histogram.to_json()
+
+    # keep any columns after the average coverage (e.g. the source column of repacked directories)
+    header = header[:5] + ['AvgCoverage'] + header[6:]
+    lines = ['\t'.join(header)]
+    for row, avg_coverage in zip(rows, avg_coverages):
+        lines.append('\t'.join(row[:5] + [str(avg_coverage)] + row[6:]))
+    _replace(base + 'toc', '\n'.join(lines) + '\n')
+    _replace(stats_file, json.dumps(stats, indent=2))
+    # the binary toc and name index would be older than the toc and thus ignored, so regenerate them
+    if os.path.exists(base + 'toc_binary'):
+        toc.write_binary_toc(base + 'toc', base + 'toc_binary')
+        if os.path.exists(base + 'toc_index'):
+            toc.write_name_index(base + 'toc_binary', base + 'toc_index')
+    logging.info(f'Updated {stats_file} ({len(rows)} contigs) in {(timer() - start):5.2f}s')
+    return len(rows)
+
+
+def _process_dir(params):
+    return process_dir(*params)
+
+
+def add_stats(input_dirs: str, feature_file_match: str = '', process_count: int = 1, batch_size: int = 256) -> int:
+    """
+    Updates the stats and toc files of all feature directories in input_dirs (see contig_reader.find_stats_files).
+    Returns:
+        - the total number of contigs processed
+    """
+    file_list, _ = contig_reader.find_stats_files(input_dirs, feature_file_match)
+    logging.info(f'Found {len(file_list)} stats files')
+    params = [(stats_file, batch_size) for stats_file in file_list]
+    if process_count > 1 and len(file_list) > 1:
+        with multiprocessing.Pool(min(process_count, len(file_list))) as pool:
+            counts = list(pool.imap_unordered(_process_dir, params))
+    else:
+        counts = [_process_dir(p) for p in params]
+    return sum(counts)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Add stats')
     arguments.add_common_args(parser)
+    parser.add_argument('--stats-batch-size', default=256, type=int,
+                        help='Number of contigs held in memory at once by each process (default: %(default)s)')
 
     args = parser.parse_args(sys.argv[1:])
 
     logging.basicConfig(format='%(asctime)s - %(message)s', level=logging._nameToLevel[args.log_level.upper()])
 
-    args.features = ['coverage', 'seq_window_perc_gc', 'seq_window_entropy']
-
-    logging.info('Loading contig metadata data...')
-    reader = contig_reader.ContigReader(args.feature_files_path, args.features, args.n_procs,
-                                        args.no_cython)
-
-    logging.info(f'Loaded metadata for {len(reader.contigs)} contigs. ')
-    logging.info('Loading actual contig data...')
-    if len(reader.contigs) == 0:
-        logging.info('Nothing to do')
-        exit(0)
-
-    contig_data = reader.read_contigs(reader.contigs, return_raw=True)
-    logging.info('All contigs loaded in memory. Updating toc/stats files')
-
-    prev_file = ''
-    toc_new = None
-    toc_header = 'Contig\tLengthBases\tMisassemblyCnt\tSizeBytes\tBreakingPoints\tAvgCoverage\n'
-    sum_entropy: float = 0
-    sum_gc_percent: float = 0
-    sum2_entropy: float = 0
-    sum2_gc_percent: float = 0
-    all_count: float = 0
-    sum_coverage: int = 0
-    sum2_coverage: int = 0
-
-    for contig_info, contig_data in zip(reader.contigs, contig_data):
-        if prev_file != contig_info.file:  # new file starting
-            if toc_new is not None:
-                toc_new.close()
-            toc_fname = get_toc_name(contig_info, args.chunks, args.feature_files_path)
-            copyfile(toc_fname, toc_fname + '_old')
-            toc_new = open(toc_fname, 'w')
-            toc_new.write(toc_header)
-            # write previous data, if any
-            if prev_file != '' and not args.chunks:  # stats are computed on the full data (not the contig chunks)
-                write_stats(prev_file, args.feature_files_path, sum_entropy, sum2_entropy, sum_gc_percent,
-                            sum2_gc_percent, sum_coverage, sum2_coverage, all_count)
-                sum_entropy = 0
-                sum_gc_percent = 0
-                sum2_entropy = 0
-                sum2_gc_percent = 0
-                all_count = 0
-                sum_coverage = 0
-                sum2_coverage = 0
-            prev_file = contig_info.file
-
-        breakpoints = '-' if len(contig_info.breakpoints) == 0 else ",".join(
-            str(b[0]) + "-" + str(b[1]) for b in contig_info.breakpoints)
-        toc_new.write(f'{contig_info.name}\t{contig_info.length}\t{contig_info.misassembly}\t'
-                      f'{contig_info.size_bytes}\t{breakpoints}\t'
-                      f'{round(np.average(contig_data["coverage"]), 5)}\n')
-
-        all_count += len(contig_data['coverage'])
-        sum_entropy += np.sum(contig_data['seq_window_entropy'])
-        sum2_entropy += np.sum(contig_data['seq_window_entropy'] ** 2)
-        sum_gc_percent += np.sum(contig_data['seq_window_perc_gc'])
-        sum2_gc_percent += np.sum(contig_data['seq_window_perc_gc'] ** 2)
-        sum_coverage += np.sum(contig_data['coverage'])
-        sum2_coverage += np.sum(contig_data['coverage'] ** 2)
-
-    # write leftover data
-    write_stats(prev_file, args.feature_files_path, sum_entropy, sum2_entropy, sum_gc_percent,
-                sum2_gc_percent, sum_coverage, sum2_coverage, all_count)
-
-    logging.info('Done.')
+    start = timer()
+    contig_count = add_stats(args.feature_files_path, args.feature_file_match, args.n_procs, args.stats_batch_size)
+    logging.info(f'Processed {contig_count} contigs in {(timer() - start):5.2f}s. Done.')
+
 
 if __name__ == '__main__':
     main()
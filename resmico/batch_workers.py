@@ -0,0 +1,226 @@
+"""
+Builds training batches in worker processes, so that the Python/NumPy parts of building a batch (interval selection,
+slicing, stacking, masking) are not limited by the GIL of the training process.
+
+The workers are started with the 'spawn' method, as the training process has already initialized Tensorflow and
+the reader threads, which isn't safe to fork. Each worker gets a pickled copy of the dataset, so it creates its own
+ContigReader state (native readers, threads, memory maps) and contig cache (the memory and spill budgets are split
+between the workers, which log their cache statistics when the epoch changes). A worker builds a complete batch and writes x and
+mask into its slot of a shared-memory ring buffer; the training process returns zero-copy views into the slot, and the
+slot is reused only once all the views (and the tensors created from them) are released.
+
+The content of a batch only depends on the dataset seed, the epoch, the batch index and the repeat number (see
+BinaryDatasetTrain.get_batch), which are sent with each task along with the contig indices of the batch, so the batches
+are the same as when they are built in the training process, regardless of which worker builds them and of changes
+to the dataset (e.g. set_state when resuming) after the workers were started.
+"""
+from concurrent.futures import Future
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import signal
+import threading
+import traceback
+from typing import Dict
+import weakref
+
+import numpy as np
+
+# the alignment of the arrays in the shared memory; tensorflow only wraps (rather than copies) aligned buffers
+_ALIGNMENT = 64
+# the interval (in seconds) at which the liveness of the workers is checked while waiting for results
+_POLL_SECONDS = 1
+
+
+def _aligned(size: int) -> int:
+    return (size + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _worker(dataset, buffer: shared_memory.SharedMemory, slot_bytes: int, process_count: int, log_level: int, tasks,
+            results):
+    """ Builds the batches requested in #tasks into the slots of #buffer until it receives None """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # interrupts are handled by the training process
+    logging.basicConfig(format='%(asctime)s - batch worker - %(message)s', level=log_level)
+    if dataset.contig_cache is not None:  # each worker has its own contig cache, so they share the memory budget
+        dataset.contig_cache.share(process_count)
+    last_epoch = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        slot, index, batch_indices, epoch, repeat, seed = task
+        dataset.seed = seed  # e.g. restored by set_state after the workers were started
+        if epoch != last_epoch:
+            if dataset.contig_cache is not None and last_epoch is not None:
+                dataset.contig_cache.log_stats()
+            last_epoch = epoch
+        try:
+            (x, mask), y, weights, lengths = dataset.build_batch(index, batch_indices, epoch, repeat, True)
+            layout = []
+            offset = slot * slot_bytes
+            for array in [x, mask]:
+                if offset + array.nbytes > (slot + 1) * slot_bytes:
+                    raise ValueError(f'Batch #{index} does not fit into a slot of {slot_bytes} bytes')
+                np.ndarray(array.shape, array.dtype, buffer=buffer.buf, offset=offset)[...] = array
+                layout.append((offset, array.shape, array.dtype))
+                offset += _aligned(array.nbytes)
+            results.put((slot, (layout, y, weights, lengths), None))
+        except Exception:
+            results.put((slot, None, traceback.format_exc()))
+
+
+class BatchWorkerPool:
+    def __init__(self, dataset, process_count: int, slot_count: int):
+        """
+        Arguments:
+            - dataset: the BinaryDatasetTrain whose batches are built
+            - process_count: the number of worker processes
+            - slot_count: the number of batches in the ring buffer, i.e. the maximum number of batches that are being
+              built or used at the same time; get_batch blocks while all the slots are in use
+        """
+        self.dataset = dataset
+        self.slot_bytes = _aligned(dataset.max_batch_bytes())
+        self.slot_count = slot_count
+        self.buffer = shared_memory.SharedMemory(create=True, size=self.slot_bytes * slot_count)
+        logging.info(f'Building batches in {process_count} worker processes, using {slot_count} slots of '
+                     f'{self.slot_bytes / 1e6:.1f}MB')
+        self._free_slots = queue.Queue()
+        for slot in range(slot_count):
+            self._free_slots.put(slot)
+        # maps a slot that is being filled by a worker to the future of the batch
+        self._futures: Dict[int, Future] = {}
+        self._futures_lock = threading.Lock()
+        self._error = None
+        self._closed = False
+
+        # the dataset is pickled for the workers (see the module docstring)
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._workers = [context.Process(target=_worker, name=f'batch-worker-{i}', daemon=True,
+                                         args=(dataset, self.buffer, self.slot_bytes, process_count,
+                                               logging.getLogger().getEffectiveLevel(), self._tasks, self._results))
+                         for i in range(process_count)]
+        for worker in self._workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, name='batch-collector', daemon=True)
+        self._collector.start()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def seed(self) -> int:
+        return self.dataset.seed
+
+    @property
+    def epoch(self) -> int:
+        return self.dataset.epoch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _collect(self):
+        """ Hands the results of the workers to the waiting get_batch calls, and fails them if a worker dies """
+        while not self._closed:
+            try:
+                slot, result, error = self._results.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                dead = [w for w in self._workers if not w.is_alive()]
+                if dead and not self._closed:
+                    self._fail(RuntimeError(f'Batch worker {dead[0].name} exited with code {dead[0].exitcode}'))
+                    return
+                continue
+            with self._futures_lock:
+                future = self._futures.pop(slot, None)
+            if future is None:  # the pool failed in the meantime
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(f'Building a batch failed in a worker process:\n{error}'))
+
+    def _fail(self, error: Exception):
+        with self._futures_lock:
+            self._error = error
+            for future in self._futures.values():
+                future.set_exception(error)
+            self._futures.clear()
+
+    def _next_slot(self) -> int:
+        """ Waits until a slot is free and returns it """
+        waited = 0
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                return self._free_slots.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                waited += _POLL_SECONDS
+                if waited % 60 == 0:
+                    logging.warning(f'Waited {waited}s for a free batch slot; the batches are still referenced')
+
+    def get_batch(self, index: int, repeat: int = 0, with_lengths: bool = False):
+        """
+        Returns the mini-batch #index of the dataset (see BinaryDataset.get_batch), built by a worker process.
+        x and mask are views into the shared memory, whose slot is reused once they are no longer referenced.
+        """
+        slot = self._next_slot()
+        future = Future()
+        with self._futures_lock:
+            error = self._error
+            if error is None:
+                self._futures[slot] = future
+        if error is not None:
+            self._release(slot)
+            raise error
+        self._tasks.put((slot, index, self.dataset.batch_indices(index), self.dataset.epoch, repeat,
+                         self.dataset.seed))
+        try:
+            layout, y, weights, lengths = future.result()
+        except BaseException:
+            self._release(slot)
+            raise
+        slot_start = slot * self.slot_bytes
+        # the views created below are views of slot_view, so slot_view is freed (and the slot released) only after
+        # the last of them
+        slot_view = np.ndarray((self.slot_bytes,), np.uint8, buffer=self.buffer.buf, offset=slot_start)
+        # the finalizer also keeps the pool (and thus the shared memory) alive as long as the views are referenced
+        weakref.finalize(slot_view, self._release, slot)
+        x, mask = [slot_view[offset - slot_start:offset - slot_start + int(np.prod(shape)) * dtype.itemsize]
+                   .view(dtype).reshape(shape) for offset, shape, dtype in layout]
+        return ((x, mask), y, weights, lengths) if with_lengths else ((x, mask), y, weights)
+
+    def _release(self, slot: int):
+        with self._futures_lock:
+            self._free_slots.put(slot)
+            if self._closed:
+                self._close_buffer()
+
+    def _close_buffer(self):
+        """ Unmaps the shared memory once no slot is in use (numpy doesn't prevent unmapping referenced buffers) """
+        if self._free_slots.qsize() == self.slot_count and self.buffer.buf is not None:
+            self.buffer.close()
+
+    def close(self):
+        """ Stops the workers and releases the shared memory (when the last batch is no longer referenced) """
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._collector.join()
+        self._fail(RuntimeError('The batch worker pool is closed'))
+        # the name is removed right away, the memory is released once it is unmapped
+        self.buffer.unlink()
+        with self._futures_lock:
+            self._close_buffer()
@@ -0,0 +1,116 @@
+"""
+Dataset catalog: a JSON file listing the feature directories of a data set together with their contig counts, sizes
+and the content of their stats file (sums and sums of squares for each feature). The catalog can be passed to
+--feature-files-path instead of a directory, which avoids the recursive search for stats files and re-reading every
+stats file; the global means/stdevs are computed exactly by adding the per-directory sums. New directories can be
+registered incrementally with `python -m resmico.catalog`.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from glob import glob
+from typing import Dict, List
+
+from resmico import toc
+
+CATALOG_VERSION = 1
+
+
+def is_catalog(fname: str) -> bool:
+    """ Returns True if fname is a catalog file (as opposed to a plain list of stats files) """
+    if not os.path.isfile(fname):
+        return False
+    with open(fname) as f:
+        return f.read(1) == '{'
+
+
+def load(fname: str) -> Dict:
+    """ Loads the catalog in fname, or returns an empty catalog if the file doesn't exist """
+    if not os.path.exists(fname):
+        return {'version': CATALOG_VERSION, 'datasets': []}
+    with open(fname) as f:
+        catalog = json.load(f)
+    if catalog.get('version') != CATALOG_VERSION:
+        raise ValueError(f'Unsupported catalog version in {fname}: {catalog.get("version")}')
+    return catalog
+
+
+def save(catalog: Dict, fname: str):
+    """ Writes the catalog atomically, so that concurrent readers never see a partially written file """
+    tmp_file = fname + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(catalog, f, indent=2)
+    os.replace(tmp_file, fname)
+
+
+def stats_files(catalog: Dict, fname: str) -> List[str]:
+    """ Returns the paths of the stats files in the catalog, resolved relative to the catalog location """
+    base_dir = os.path.dirname(os.path.abspath(fname))
+    return [os.path.normpath(os.path.join(base_dir, d['stats'])) for d in catalog['datasets']]
+
+
+def describe(stats_file: str) -> Dict:
+    """ Collects the catalog entry (contig count, sizes and stats) for the feature directory of stats_file """
+    base = stats_file[:-len('stats')]
+    with open(stats_file) as f:
+        stats = json.load(f)
+    contig_count = 0
+    total_length = 0
+    if os.path.exists(base + 'toc_binary'):
+        binary_toc = toc.BinaryToc(base + 'toc_binary')
+        contig_count = len(binary_toc)
+        total_length = int(binary_toc.records['length'].sum())
+    elif os.path.exists(base + 'toc'):
+        with open(base + 'toc') as f:
+            next(f, None)  # skip header
+            for line in f:
+                contig_count += 1
+                total_length += int(line.split('\t')[1])
+    size_bytes = os.path.getsize(base + 'features_binary') if os.path.exists(base + 'features_binary') else 0
+    return {'contig_count': contig_count, 'total_length': total_length, 'size_bytes': size_bytes, 'stats_data': stats}
+
+
+def register(fname: str, input_dirs: List[str]) -> int:
+    """
+    Adds the feature directories found in input_dirs to the catalog in fname (creating it if needed). Directories
+    that are already in the catalog are updated.
+    Returns:
+        - the number of registered directories
+    """
+    catalog = load(fname)
+    base_dir = os.path.dirname(os.path.abspath(fname))
+    datasets = {d['stats']: d for d in catalog['datasets']}
+    count = 0
+    for input_dir in input_dirs:
+        found = [input_dir] if os.path.basename(input_dir) == 'stats' else sorted(
+            glob(input_dir + '/**/stats', recursive=True))
+        for stats_file in found:
+            path = os.path.relpath(os.path.abspath(stats_file), base_dir)
+            datasets[path] = dict(stats=path, **describe(stats_file))
+            count += 1
+    catalog['datasets'] = list(datasets.values())
+    save(catalog, fname)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Register feature directories in a dataset catalog')
+    parser.add_argument('--catalog', required=True, type=str,
+                        help='Catalog file to create or update; can be passed to --feature-files-path')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['CRITICAL', 'FATAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help='Logging level (default: %(default)s)')
+    parser.add_argument('input_dirs', nargs='+',
+                        help='Directories searched recursively for feature files (or paths to stats files)')
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging._nameToLevel[args.log_level.upper()])
+
+    count = register(args.catalog, args.input_dirs)
+    logging.info(f'Registered {count} feature directories in {args.catalog}')
+
+
+if __name__ == '__main__':
+    main()
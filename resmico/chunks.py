@@ -0,0 +1,119 @@
+"""
+(Re-)generates the toc_chunked files for an existing data set. A chunk is an interval [start, stop) of a full contig
+record in features_binary, so chunk sets of any size can be created after the fact without re-running bam2feat.
+"""
+import argparse
+import csv
+import logging
+import os
+import random
+import sys
+from glob import glob
+from typing import List, Tuple
+
+TOC_CHUNKED_HEADER = 'Contig\tStart\tStop\tMisassemblyCnt\tBreakingPoints\n'
+
+
+def get_chunk_interval(breakpoint: Tuple[int, int], contig_len: int, chunk_size: int, breakpoint_margin: int,
+                       rnd: random.Random):
+    """
+    Selects an interval of length chunk_size around the given breakpoint, such that the breakpoint is at least
+    breakpoint_margin positions away from the chunk edges (if the contig is long enough). Mirrors
+    StatsWriter::get_chunk_interval in bam2feat.
+    Returns:
+        - the (start, stop) of the selected interval
+    """
+    if contig_len < chunk_size:
+        return 0, contig_len
+    mid = (breakpoint[0] + breakpoint[1]) // 2
+    breakpoint_pos = rnd.randint(breakpoint_margin, chunk_size - breakpoint_margin)
+    start = max(0, mid - breakpoint_pos)
+    if start > breakpoint[0]:  # unlikely, but may happen if break_start << break_end
+        start = breakpoint[0]
+    stop = start + chunk_size
+    if stop > contig_len:
+        start -= stop - contig_len
+        stop = contig_len
+    return start, stop
+
+
+def select_chunks(contig_len: int, breakpoints: List[Tuple[int, int]], chunk_size: int, breakpoint_margin: int,
+                  rnd: random.Random):
+    """
+    Selects the chunks for a contig: one random chunk if the contig is not misassembled, or one chunk around each
+    breakpoint otherwise.
+    Returns:
+        - a list of (start, stop, breakpoints) tuples, where breakpoints are relative to start
+    """
+    if not breakpoints:
+        if contig_len <= chunk_size:
+            return [(0, contig_len, [])]
+        start = rnd.randint(0, contig_len - chunk_size)
+        return [(start, start + chunk_size, [])]
+    result = []
+    for breakpoint in breakpoints:
+        start, stop = get_chunk_interval(breakpoint, contig_len, chunk_size, breakpoint_margin, rnd)
+        result.append((start, stop, [(breakpoint[0] - start, breakpoint[1] - start)]))
+    return result
+
+
+def write_chunk_toc(toc_file: str, out_file: str, chunk_size: int, breakpoint_margin: int, rnd: random.Random):
+    """
+    Reads the contig table of contents in toc_file and writes the chunk descriptors to out_file.
+    Returns:
+        - the number of chunks written
+    """
+    count = 0
+    with open(toc_file) as f, open(out_file, 'w') as out:
+        out.write(TOC_CHUNKED_HEADER)
+        rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        next(rd, None)  # skip header
+        for row in rd:
+            contig_name, contig_len, breakpoints = row[0], int(row[1]), []
+            if int(row[2]) > 0 and len(row) >= 5 and row[4] != '-':
+                for break_point in row[4].split(','):
+                    start_stop = break_point.split('-')
+                    breakpoints.append((int(start_stop[0]), int(start_stop[1])))
+            for start, stop, chunk_breakpoints in select_chunks(contig_len, breakpoints, chunk_size,
+                                                                breakpoint_margin, rnd):
+                bps = '-' if not chunk_breakpoints else ','.join(f'{b[0]}-{b[1]}' for b in chunk_breakpoints)
+                out.write(f'{contig_name}\t{start}\t{stop}\t{1 if chunk_breakpoints else 0}\t{bps}\n')
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='(Re-)generate the toc_chunked files for existing feature files')
+    parser.add_argument('--feature-files-path', default='.', type=str,
+                        help='Path to the feature files produced by ResMiCo-SM (default: %(default)s)')
+    parser.add_argument('--chunk-size', default=500, type=int,
+                        help='Length of the chunks (default: %(default)s)')
+    parser.add_argument('--breakpoint-margin', default=50, type=int,
+                        help='Minimum distance between a breakpoint and the chunk edges (default: %(default)s)')
+    parser.add_argument('--out-name', default='toc_chunked', type=str,
+                        help='Name of the chunk file written next to each toc file (default: %(default)s)')
+    parser.add_argument('--seed', default=54321, type=int,
+                        help='Seed used for selecting the chunk positions (default: %(default)s)')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['CRITICAL', 'FATAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help='Logging level (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging._nameToLevel[args.log_level.upper()])
+
+    if 2 * args.breakpoint_margin > args.chunk_size:
+        logging.error('--breakpoint-margin must be at most half of --chunk-size')
+        exit(1)
+
+    rnd = random.Random(args.seed)
+    toc_files = sorted(glob(args.feature_files_path + '/**/toc', recursive=True))
+    logging.info(f'Writing chunks for {len(toc_files)} toc files...')
+    for toc_file in toc_files:
+        out_file = os.path.join(os.path.dirname(toc_file), args.out_name)
+        count = write_chunk_toc(toc_file, out_file, args.chunk_size, args.breakpoint_margin, rnd)
+        logging.debug(f'Wrote {count} chunks to {out_file}')
+    logging.info('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@ def add_common_args(parser: argparse.ArgumentParser):
                            '2 options are available:\n'
                            '  1) Provide the base path, and subdirectories will be searched.\n'
                            '  2) Provide a file that lists all stats files.\n'
-                           '     Note: assocaited files (eg., toc files) must be in the same directories.\n')
+                           '     Note: assocaited files (eg., toc files) must be in the same directories.\n'
+                           '  3) Provide a dataset catalog created with `python -m resmico.catalog`.\n')
     parser_g1.add_argument('--feature-file-match', default='', type=str,
                            help='String that paths to feature files must match.\n'
                            'Example: use "0.005" to select file paths containing "0.005".\n'
@@ -60,6 +61,27 @@ def add_common_args(parser: argparse.ArgumentParser):
     parser_g1.add_argument('--log-level', default='INFO',
                            choices = ['CRITICAL', 'FATAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
                            help='Logging level (default: %(default)s)')
+    parser_g1.add_argument('--tensor-cache-dir', default='', type=str,
+                           help='Directory (ideally on a local SSD) where the normalized features are cached on disk\n'
+                           'and reused across epochs and runs. Empty string disables the cache (default: %(default)s)')
+    parser_g1.add_argument('--tensor-cache-dtype', default='float32', choices=['float32', 'float16'],
+                           help='Storage type of the features in the tensor cache (default: %(default)s)')
+    parser_g1.add_argument('--feature-dtype', default='float32', choices=['float32', 'float16', 'bfloat16'],
+                           help='Type of the feature tensors produced by the data pipeline and kept in the in-memory\n'
+                           'caches; the model converts them to float32 at its input (default: %(default)s)')
+    parser_g1.add_argument('--precision', default='float32', choices=['float32', 'mixed_float16', 'mixed_bfloat16'],
+                           help='Keras precision policy of the model; with the mixed policies, the layers compute in\n'
+                           'float16/bfloat16 except the pooling and output layers (default: %(default)s)')
+    parser_g1.add_argument('--jit-compile', dest='jit_compile', action='store_true',
+                           help='If set, the model is compiled with XLA. Each distinct batch length is compiled\n'
+                           'separately, so this pays off mostly with fixed length models or with --length-buckets,\n'
+                           'whose training batches are then padded to the bucket boundaries')
+    parser_g1.add_argument('--fused-reader', dest='fused_reader', action='store_true',
+                           help='If set, features are decoded, normalized and written directly into the batch tensor\n'
+                           'in a single native pass (requires the Cython bindings; ignored with --tensor-cache-dir)')
+    parser_g1.add_argument('--prefetch-batches', default=2, type=int,
+                           help='Number of batches that are read in the background while the current batch is\n'
+                           'being processed; 0 reads each batch on demand (default: %(default)s)')
     parser_g1.add_argument('--no-cython', dest='no_cython', action='store_true',
                            help='If set, data is read using pure Python rather than using the Cython bindings\n'
-                           '(about 2x slower; only useful for debugging)')
\ No newline at end of file
+                           '(for platforms where the extension can\'t be built; somewhat slower)')
\ No newline at end of file
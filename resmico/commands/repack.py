@@ -0,0 +1,57 @@
+from __future__ import print_function
+import argparse
+import logging
+from resmico import repack
+
+# functions
+def get_desc():
+    desc = 'Repack feature directories into large shards'
+    return desc
+
+def parse_args(test_args=None, subparsers=None):
+    desc = get_desc()
+    epi = """DESCRIPTION:
+    Consolidate the many feature directories produced by "resmico bam2feat" into a few large shards
+    (shard_00000, shard_00001, ...), so that training opens few files and reads long sequential ranges.
+    Contig records are copied without re-encoding. Contig names and original directories are preserved,
+    so "resmico evaluate" on the shards reports the same contigs as on the original directories.
+    The output directory can be passed to --feature-files-path (or use the generated catalog.json).
+    """
+    if subparsers:
+        parser = subparsers.add_parser('repack', description=desc, epilog=epi,
+                                       formatter_class=argparse.RawTextHelpFormatter)
+    else:
+        parser = argparse.ArgumentParser(description=desc, epilog=epi,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+    # args
+    parser.add_argument('--feature-files-path', default='.', type=str,
+                        help='Path to the feature files produced by ResMiCo-SM, a file listing the stats files or a\n'
+                             'dataset catalog (default: %(default)s)')
+    parser.add_argument('--feature-file-match', default='', type=str,
+                        help='Only repack feature files whose path contains this string (default: %(default)s)')
+    parser.add_argument('--outdir', default='resmico-repack', type=str,
+                        help='Output directory; must be empty or not exist (default: %(default)s)')
+    parser.add_argument('--shard-size-gb', default=4.0, type=float,
+                        help='Approximate size of each shard in GB (default: %(default)s)')
+    parser.add_argument('--order', default='source', choices=['source', 'length', 'class'],
+                        help='Order of the contigs in the shards: "source" keeps the original order,\n'
+                             '"length" orders by contig length, "class" puts the contigs without\n'
+                             'misassemblies first, each class ordered by length (default: %(default)s)')
+    # test args
+    if test_args:
+        args = parser.parse_args(test_args)
+        return args
+    # return
+    return parser
+
+def main(args=None):
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+    # Input
+    if args is None:
+        args = parse_args()
+    # Main interface
+    repack.main(args)
+
+# main
+if __name__ == '__main__':
+    pass
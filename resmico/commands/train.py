@@ -45,7 +45,16 @@ def parse_args(curr_args=None, subparsers=None):
     parser_g1.add_argument('--cache-validation', dest='cache_validation', action='store_true',
                            help='Cache the validation data in memory for quicker access (default: %(default)s)')
     parser_g1.add_argument('--cache-train', dest='cache_train', action='store_true',
-                           help='Cache the train data in memory for quicker access (default: %(default)s)')
+                           help='Cache the features of the training contigs in memory for quicker access, evicting\n'
+                           'the least recently used contigs beyond --cache-mem-gb (default: %(default)s)')
+    parser_g1.add_argument('--cache-mem-gb', default=4, type=float,
+                           help='Maximum size of the training contig features cached in memory (default: %(default)s)')
+    parser_g1.add_argument('--cache-spill-dir', default='', type=str,
+                           help='Directory (ideally on a local SSD) where training contigs evicted from the memory\n'
+                           'cache are kept in a memory-mapped file. Empty string disables spilling\n'
+                           '(default: %(default)s)')
+    parser_g1.add_argument('--cache-spill-gb', default=16, type=float,
+                           help='Size of the spill file in --cache-spill-dir (default: %(default)s)')
     parser_g1.add_argument('--log-progress', default=False,
                            help='Show a progressbar for training/evaluation progress (default: %(default)s)',
                            dest='log_progress', action='store_true')
@@ -55,9 +64,47 @@ def parse_args(curr_args=None, subparsers=None):
     parser_g1.add_argument('--max-translation-bases', default=0, type=int,
                            help='Maximum number of bases to translate around the breaking point\n'
                            '(i.e. misassembled contigs) that are longer than max-len (default: %(default)s)')
+    parser_g1.add_argument('--augment-reverse-prob', default=0, type=float,
+                           help='Probability of reverse complementing a training contig (reversing its positions and\n'
+                           'swapping the features of complementary bases) in the input pipeline (default: %(default)s)')
+    parser_g1.add_argument('--augment-max-shift', default=0, type=int,
+                           help='Maximum number of zero positions by which training contigs are randomly shifted to\n'
+                           'the right in the input pipeline (default: %(default)s)')
     parser_g1.add_argument('--weight-factor', default=0, type=int,
                            help='Factor by which contigs are weighted based on their length (default: %(default)s).\n'
                            'w = min(1, contig_len/weight-factor). 0==no weighting')
+    parser_g1.add_argument('--length-buckets', default=0, type=int,
+                           help='Number of contig length buckets; each training batch is filled with contigs of\n'
+                           'similar length from a single bucket, which reduces padding; with --jit-compile, batches\n'
+                           'are padded to the bucket boundaries. 0 disables bucketing (default: %(default)s)')
+    parser_g1.add_argument('--chunk-epochs', default=0, type=int,
+                           help='Number of initial epochs trained on the fixed-length chunks listed in the\n'
+                           '--chunk-toc files (see resmico.chunks) rather than on full contigs; much faster per epoch,\n'
+                           'e.g. for pretraining. 0 disables chunk training (default: %(default)s)')
+    parser_g1.add_argument('--chunk-toc', default='toc_chunked', type=str,
+                           help='Name of the chunk toc files next to the stats files (default: %(default)s)')
+    parser_g1.add_argument('--loader-workers', default=0, type=int,
+                           help='Number of worker processes building the training batches (into shared memory);\n'
+                           '0 builds them in threads of the training process (default: %(default)s)')
+    parser_g1.add_argument('--async-validation-device', default='', type=str,
+                           help='If set ("cpu" or a GPU index), the model is saved after every 2 epochs and validated in\n'
+                           'a separate process on this device while training continues; the learning rate and the\n'
+                           'best model are updated as the results arrive. Empty string validates in the training\n'
+                           'process (default: %(default)s)')
+    parser_g1.add_argument('--resume', dest='resume', action='store_true',
+                           help='If set, training continues from the latest checkpoint in\n'
+                           '<save-path>/<save-name>_checkpoints (model, optimizer, learning rate, epoch, best model,\n'
+                           'data split and random state), which is written after every 2 epochs')
+    parser_g1.add_argument('--worker-hosts', default='', type=str,
+                           help='Comma-separated host:port of all the workers of a multi-worker training; each worker\n'
+                           'trains on a disjoint, length-balanced part of the data and --batch-size is per replica.\n'
+                           'Multi-worker training is also enabled by setting TF_CONFIG (default: %(default)s)')
+    parser_g1.add_argument('--worker-index', default=0, type=int,
+                           help='Index of this worker in --worker-hosts; worker 0 writes the models\n'
+                           '(default: %(default)s)')
+    parser_g1.add_argument('--deterministic', dest='deterministic', action='store_true',
+                           help='If set, training batches are always fed to the network in the same order; otherwise\n'
+                           'batches built in parallel are used as soon as they are ready (same content, faster)')
 
     arguments.add_common_args(parser)
 
@@ -0,0 +1,147 @@
+"""
+In-memory cache of the decoded (normalized and stacked) features of whole contigs, used to avoid reading and decoding
+the same contigs from disk in every epoch. The cache is bounded by a byte budget and evicts the least recently used
+contigs. Optionally, evicted contigs are spilled to a second tier: a memory-mapped file of a fixed size (ideally on a
+local SSD), which is written as a circular log (i.e. the oldest spilled contigs are overwritten first).
+
+Contigs rather than batches are cached, so the cached data stays valid when the batches change (new negative samples,
+new translations, new shuffling).
+"""
+from collections import OrderedDict
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class ContigCache:
+    def __init__(self, capacity_bytes: int, spill_dir: str = '', spill_bytes: int = 0):
+        """
+        Arguments:
+            - capacity_bytes: the maximum total size of the contigs kept in memory
+            - spill_dir: if not empty, contigs evicted from memory are kept in a memory-mapped file in this directory
+            - spill_bytes: the size of the spill file
+        """
+        self.capacity_bytes = capacity_bytes
+        self.size_bytes = 0
+        # maps a contig index to its features, ordered from the least to the most recently used
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = self.spill_hits = self.misses = 0
+        self._lock = threading.Lock()
+
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        self.spill = None
+        # maps a contig index to (offset, dtype, shape) in the spill file, from the oldest to the newest
+        self.spilled: OrderedDict = OrderedDict()
+        self.spill_pos = 0
+        self._create_spill()
+
+    def _create_spill(self):
+        if not self.spill_dir or self.spill_bytes <= 0:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        fd, spill_file = tempfile.mkstemp(dir=self.spill_dir, prefix='contig_cache_', suffix='.bin')
+        os.close(fd)
+        self.spill = np.memmap(spill_file, dtype=np.uint8, mode='w+', shape=(self.spill_bytes,))
+        # the mapping remains valid after the file is removed, and the space is freed when the process exits
+        os.remove(spill_file)
+        logging.info(f'Spilling evicted contigs to a {self.spill_bytes / 1e9:.2f}GB file in {self.spill_dir}')
+
+    def __getstate__(self):
+        # a copy sent to another process (e.g. a batch worker) starts empty and without a spill file (see #share)
+        state = self.__dict__.copy()
+        state['entries'], state['spilled'] = OrderedDict(), OrderedDict()
+        state['size_bytes'] = state['spill_pos'] = 0
+        state['hits'] = state['spill_hits'] = state['misses'] = 0
+        state['spill'] = state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def share(self, count: int):
+        """
+        Makes this copy of the cache (e.g. in a batch worker process) one of #count caches that share the memory and
+        spill budgets; each of them has its own spill file.
+        """
+        self.capacity_bytes //= count
+        self.spill_bytes //= count
+        self._create_spill()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, idx: int) -> Optional[np.ndarray]:
+        """ Returns the cached features of contig #idx, or None if they are not cached """
+        with self._lock:
+            features = self.entries.get(idx)
+            if features is not None:
+                self.entries.move_to_end(idx)
+                self.hits += 1
+                return features
+            location = self.spilled.get(idx)
+            if location is None:
+                self.misses += 1
+                return None
+            self.spill_hits += 1
+            offset, dtype, shape = location
+            size = int(np.prod(shape)) * dtype.itemsize
+            features = np.frombuffer(self.spill[offset:offset + size], dtype=dtype).reshape(shape).copy()
+            self._put_locked(idx, features)
+            return features
+
+    def put(self, idx: int, features: np.ndarray):
+        """ Adds the features of contig #idx to the cache, evicting the least recently used contigs if needed """
+        with self._lock:
+            self._put_locked(idx, np.ascontiguousarray(features))
+
+    def _put_locked(self, idx: int, features: np.ndarray):
+        if idx in self.entries or features.nbytes > self.capacity_bytes:
+            return
+        self.entries[idx] = features
+        self.size_bytes += features.nbytes
+        while self.size_bytes > self.capacity_bytes:
+            evicted_idx, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= evicted.nbytes
+            self._spill(evicted_idx, evicted)
+
+    def _spill(self, idx: int, features: np.ndarray):
+        """ Writes features at the current position of the spill file, overwriting the oldest spilled contigs """
+        if self.spill is None or idx in self.spilled or features.nbytes > len(self.spill):
+            return
+        size = features.nbytes
+        if self.spill_pos + size > len(self.spill):
+            # wrap around; the contigs after the current position are the oldest ones
+            while self.spilled and next(iter(self.spilled.values()))[0] >= self.spill_pos:
+                self.spilled.popitem(last=False)
+            self.spill_pos = 0
+        # the oldest remaining contigs (if written before the last wrap around) start right after the current position
+        while self.spilled and self.spill_pos <= next(iter(self.spilled.values()))[0] < self.spill_pos + size:
+            self.spilled.popitem(last=False)
+        self.spill[self.spill_pos:self.spill_pos + size] = features.reshape(-1).view(np.uint8)
+        self.spilled[idx] = (self.spill_pos, features.dtype, features.shape)
+        self.spill_pos += size
+
+    def stats(self) -> Dict[str, float]:
+        """ Returns the hit/miss counters (since the last reset) and the current size of the cache """
+        with self._lock:
+            lookups = self.hits + self.spill_hits + self.misses
+            return {'hits': self.hits, 'spill_hits': self.spill_hits, 'misses': self.misses,
+                    'hit_rate': (self.hits + self.spill_hits) / lookups if lookups else 0,
+                    'contigs': len(self.entries), 'size_bytes': self.size_bytes, 'spilled_contigs': len(self.spilled)}
+
+    def log_stats(self, reset: bool = True):
+        """ Logs the hit/miss counters and the cache size, and optionally resets the counters """
+        stats = self.stats()
+        logging.info(f'Contig cache: {stats["hits"]} hits, {stats["spill_hits"]} spill hits, {stats["misses"]} misses '
+                     f'(hit rate {100 * stats["hit_rate"]:.1f}%). {stats["contigs"]} contigs in memory '
+                     f'({stats["size_bytes"] / 1e9:.2f}/{self.capacity_bytes / 1e9:.2f}GB), '
+                     f'{stats["spilled_contigs"]} spilled')
+        if reset:
+            with self._lock:
+                self.hits = self.spill_hits = self.misses = 0
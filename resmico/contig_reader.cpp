@@ -1,12 +1,16 @@
 #include "contig_reader.hpp"
 
+#include <algorithm>
 #include <cassert>
+#include <cerrno>
+#include <cmath>
 #include <cstring>
 #include <fstream>
 #include <iostream>
 #include <memory>
 
-#include "zlib.h" // declare the external fns -- uses zconf.h, too
+#include <fcntl.h>
+#include <unistd.h>
 
 int uncompress_data(const char *abSrc, int nLenSrc, uint8_t *abDst,
                     int nLenDst) {
@@ -113,6 +117,272 @@ void read_contig_features_buf(const char *fname, uint64_t offset,
   }
 }
 
+namespace {
+
+/**
+ * Converts #count values of type T starting at #src, applies #conv and writes the result to every #stride-th
+ * element of #dest.
+ */
+template <typename T>
+void convert_feature(const char *src, uint32_t count,
+                     const FeatureConversion &conv, float *dest,
+                     uint32_t stride) {
+  for (uint32_t i = 0; i < count; ++i) {
+    T raw;
+    std::memcpy(&raw, src + i * sizeof(T), sizeof(T)); // data is not aligned
+    float v = static_cast<float>(raw);
+    if (conv.has_nan_value && v == conv.nan_value) {
+      v = NAN;
+    } else if (conv.scale != 1) {
+      v /= conv.scale;
+    }
+    v = (v - conv.mean) / conv.stdev;
+    if (conv.zero_nan && std::isnan(v)) {
+      v = 0;
+    }
+    dest[i * stride] = v;
+  }
+}
+
+/** One-hot encodes the reference bases A, C, G, T into 4 consecutive columns starting at dest */
+void one_hot_bases(const char *src, uint32_t count, float *dest,
+                   uint32_t stride) {
+  for (uint32_t i = 0; i < count; ++i) {
+    float *d = dest + i * stride;
+    d[0] = src[i] == 'A';
+    d[1] = src[i] == 'C';
+    d[2] = src[i] == 'G';
+    d[3] = src[i] == 'T';
+  }
+}
+
+} // namespace
+
+void write_contig_into(const char *data, uint32_t length_bases,
+                       uint32_t num_features, const uint8_t *feature_sizes_bytes,
+                       const FeatureConversion *conversions,
+                       uint32_t piece_count, const uint32_t *starts,
+                       const uint32_t *stops, const uint32_t *rows,
+                       const uint32_t *mask_lengths, BatchBuffer batch) {
+  const uint32_t stride = batch.num_columns;
+  for (uint32_t p = 0; p < piece_count; ++p) {
+    const uint32_t start = std::min(starts[p], length_bases);
+    const uint32_t stop = std::max(start, std::min(stops[p], length_bases));
+    const uint32_t count = std::min(stop - start, batch.max_len);
+    float *row = batch.x + static_cast<uint64_t>(rows[p]) * batch.max_len * stride;
+
+    const char *ptr = data;
+    for (uint32_t i = 0; i < num_features; ++i) {
+      const FeatureConversion &conv = conversions[i];
+      const char *src = ptr + start * feature_sizes_bytes[i];
+      ptr += length_bases * feature_sizes_bytes[i];
+      if (conv.column < 0) {
+        continue;
+      }
+      float *dest = row + conv.column;
+      switch (conv.type) {
+      case UINT8:
+        convert_feature<uint8_t>(src, count, conv, dest, stride);
+        break;
+      case UINT16:
+        convert_feature<uint16_t>(src, count, conv, dest, stride);
+        break;
+      case INT8:
+        convert_feature<int8_t>(src, count, conv, dest, stride);
+        break;
+      case FLOAT32:
+        convert_feature<float>(src, count, conv, dest, stride);
+        break;
+      case ONE_HOT_BASE:
+        one_hot_bases(src, count, dest, stride);
+        break;
+      }
+    }
+    // zero the padding, so that the buffer can be reused between batches
+    std::fill(row + static_cast<uint64_t>(count) * stride,
+              row + static_cast<uint64_t>(batch.max_len) * stride, 0.f);
+    if (batch.mask != nullptr) {
+      uint8_t *mask_row = batch.mask + static_cast<uint64_t>(rows[p]) * batch.mask_width;
+      const uint32_t mask_len = std::min(mask_lengths[p], batch.mask_width);
+      std::fill(mask_row, mask_row + mask_len, 1);
+      std::fill(mask_row + mask_len, mask_row + batch.mask_width, 0);
+    }
+  }
+}
+
+void split_features(const char *data, uint32_t length_bases,
+                    uint32_t num_features, const uint8_t *feature_mask,
+                    const uint8_t *feature_sizes_bytes, char **features) {
+  for (uint32_t i = 0; i < num_features; ++i) {
+    if (feature_mask[i]) {
+      std::memcpy(features[i], data, length_bases * feature_sizes_bytes[i]);
+    }
+    data += length_bases * feature_sizes_bytes[i];
+  }
+}
+
+ContigFileReader::~ContigFileReader() {
+  for (File &file : files_) {
+    if (file.fd >= 0) {
+      close(file.fd);
+    }
+  }
+  for (auto &state : threads_) {
+    if (state->stream_initialized) {
+      inflateEnd(&state->stream);
+    }
+  }
+}
+
+int ContigFileReader::open(const char *fname) {
+  auto it = file_ids_.find(fname);
+  if (it != file_ids_.end()) {
+    return it->second;
+  }
+  int file_id;
+  {
+    std::lock_guard<std::mutex> lock(files_mutex_);
+    file_id = files_.size();
+    files_.emplace_back();
+    files_.back().name = fname;
+  }
+  // make sure the file can be opened; the descriptor stays cached
+  if (acquire(file_id) < 0) {
+    std::lock_guard<std::mutex> lock(files_mutex_);
+    files_.pop_back();
+    return -1;
+  }
+  release(file_id);
+  file_ids_[fname] = file_id;
+  return file_id;
+}
+
+void ContigFileReader::set_max_open_files(uint32_t count) {
+  max_open_files_ = std::max(1u, count);
+}
+
+bool ContigFileReader::close_lru() {
+  for (auto it = lru_.rbegin(); it != lru_.rend(); ++it) {
+    File &file = files_[*it];
+    if (file.readers == 0) {
+      close(file.fd);
+      file.fd = -1;
+      lru_.erase(file.lru);
+      return true;
+    }
+  }
+  return false;
+}
+
+int ContigFileReader::acquire(int file_id) {
+  std::lock_guard<std::mutex> lock(files_mutex_);
+  File &file = files_[file_id];
+  if (file.fd >= 0) {
+    lru_.splice(lru_.begin(), lru_, file.lru);
+  } else {
+    while (lru_.size() >= max_open_files_ && close_lru()) {
+    }
+    file.fd = ::open(file.name.c_str(), O_RDONLY | O_CLOEXEC);
+    // the process may be running out of descriptors because of other files: free the cached ones and retry
+    while (file.fd < 0 && (errno == EMFILE || errno == ENFILE) && close_lru()) {
+      file.fd = ::open(file.name.c_str(), O_RDONLY | O_CLOEXEC);
+    }
+    if (file.fd < 0) {
+      return -1;
+    }
+    lru_.push_front(file_id);
+    file.lru = lru_.begin();
+  }
+  ++file.readers;
+  return file.fd;
+}
+
+void ContigFileReader::release(int file_id) {
+  std::lock_guard<std::mutex> lock(files_mutex_);
+  --files_[file_id].readers;
+}
+
+void ContigFileReader::set_thread_count(uint32_t count) {
+  while (threads_.size() < count) {
+    threads_.emplace_back(new ThreadState());
+  }
+}
+
+const char *ContigFileReader::read_range(int file_id, uint64_t offset,
+                                         uint64_t size, int thread) {
+  std::vector<char> &buf = threads_[thread]->range;
+  if (buf.size() < size) {
+    buf.resize(size);
+  }
+  const int fd = acquire(file_id);
+  if (fd < 0) {
+    return nullptr;
+  }
+  uint64_t total = 0;
+  while (total < size) {
+    ssize_t count = pread(fd, buf.data() + total, size - total, offset + total);
+    if (count < 0 && errno == EINTR) {
+      continue;
+    }
+    if (count <= 0) {
+      break;
+    }
+    total += count;
+  }
+  release(file_id);
+  return total == size ? buf.data() : nullptr;
+}
+
+void ContigFileReader::will_need(int file_id, uint64_t offset, uint64_t size) {
+#ifdef POSIX_FADV_WILLNEED
+  const int fd = acquire(file_id);
+  if (fd >= 0) {
+    posix_fadvise(fd, offset, size, POSIX_FADV_WILLNEED);
+    release(file_id);
+  }
+#endif
+}
+
+const char *ContigFileReader::decompress(const char *compressed,
+                                         uint32_t size_bytes,
+                                         uint32_t length_bases,
+                                         uint32_t bytes_per_base, int thread) {
+  ThreadState &state = *threads_[thread];
+  const uint64_t expected_size = static_cast<uint64_t>(length_bases) * bytes_per_base + 4;
+  if (state.uncompressed.size() < expected_size) {
+    state.uncompressed.resize(expected_size);
+  }
+
+  z_stream &zs = state.stream;
+  if (!state.stream_initialized) {
+    zs.zalloc = Z_NULL;
+    zs.zfree = Z_NULL;
+    zs.opaque = Z_NULL;
+    zs.next_in = Z_NULL;
+    zs.avail_in = 0;
+    // 31 = 15 (max window) + 16 (gzip header)
+    if (inflateInit2(&zs, 31) != Z_OK) {
+      return nullptr;
+    }
+    state.stream_initialized = true;
+  } else if (inflateReset(&zs) != Z_OK) {
+    return nullptr;
+  }
+  zs.next_in = reinterpret_cast<uint8_t *>(const_cast<char *>(compressed));
+  zs.avail_in = size_bytes;
+  zs.next_out = reinterpret_cast<uint8_t *>(state.uncompressed.data());
+  zs.avail_out = expected_size;
+  if (inflate(&zs, Z_FINISH) != Z_STREAM_END || zs.total_out != expected_size) {
+    return nullptr;
+  }
+  uint32_t contig_size;
+  std::memcpy(&contig_size, state.uncompressed.data(), 4);
+  if (contig_size != length_bases) {
+    return nullptr;
+  }
+  return state.uncompressed.data() + 4;
+}
+
 int main() {
   char *data = new char[1071];
   uint8_t feature_mask[] = {1};
@@ -1,5 +1,14 @@
 #pragma once
+#include <atomic>
 #include <cstdint>
+#include <list>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <unordered_map>
+#include <vector>
+
+#include "zlib.h"
 
 void read_contig_features(const char *fname, uint64_t offset, uint32_t size_bytes,
                           uint32_t length_bases, uint32_t num_features,
@@ -13,3 +22,131 @@ void read_contig_features_buf(const char *fname, uint64_t offset,
                               uint8_t *feature_sizes_bytes,
                               char *buf,
                               char **features, int thread);
+
+// How a feature is converted when written into a batch buffer by write_contig_into
+enum FeatureType : uint8_t { UINT8 = 0, UINT16 = 1, INT8 = 2, FLOAT32 = 3, ONE_HOT_BASE = 4 };
+
+struct FeatureConversion {
+  int32_t column; // destination column in the batch buffer, -1 if not needed
+  uint8_t type;   // one of FeatureType
+  uint8_t has_nan_value; // if set, values equal to nan_value are replaced with NaN
+  uint8_t zero_nan; // if set, NaNs are replaced with 0 after normalization
+  float nan_value;
+  float scale; // the value is divided by scale (before normalization)
+  float mean;
+  float stdev;
+};
+
+// A preallocated float32 buffer of shape (rows, max_len, num_columns) and an optional mask of shape (rows, mask_width)
+struct BatchBuffer {
+  float *x;
+  uint32_t max_len;
+  uint32_t num_columns;
+  uint8_t *mask;
+  uint32_t mask_width;
+};
+
+/**
+ * Converts, normalizes and writes the intervals [starts[i], stops[i]) of each feature of a decompressed contig record
+ * to row rows[i] of the batch buffer. The remaining positions of each written row are set to zero and, if the buffer
+ * has a mask, mask[rows[i]] is set to 1 for the first mask_lengths[i] positions and to 0 after that.
+ * @param data the decompressed features of the contig (without the 4-byte length prefix)
+ */
+void write_contig_into(const char *data, uint32_t length_bases,
+                       uint32_t num_features, const uint8_t *feature_sizes_bytes,
+                       const FeatureConversion *conversions,
+                       uint32_t piece_count, const uint32_t *starts,
+                       const uint32_t *stops, const uint32_t *rows,
+                       const uint32_t *mask_lengths, BatchBuffer batch);
+
+/**
+ * Copies the features selected by #feature_mask of a decompressed contig record into #features (one buffer per
+ * feature, NULL for features that are not selected).
+ */
+void split_features(const char *data, uint32_t length_bases,
+                    uint32_t num_features, const uint8_t *feature_mask,
+                    const uint8_t *feature_sizes_bytes, char **features);
+
+/**
+ * Long-lived reader for contig records in features_binary files. File descriptors are cached (at most
+ * #max_open_files of them; the least recently used descriptor that isn't being read from is closed when a new file
+ * is opened), byte ranges are read with pread() (so threads can share a descriptor), and each thread reuses its read
+ * and decompression buffers and its zlib stream across calls. A byte range may contain several consecutive records,
+ * which are then decompressed one by one from memory.
+ * open() and set_thread_count() are not thread safe; the other methods are thread safe as long as each thread passes
+ * its own thread number.
+ */
+class ContigFileReader {
+ public:
+  ContigFileReader() = default;
+  ContigFileReader(const ContigFileReader &) = delete;
+  ContigFileReader &operator=(const ContigFileReader &) = delete;
+  ~ContigFileReader();
+
+  /** Returns the id of the (possibly already known) file #fname, or -1 if the file can't be opened */
+  int open(const char *fname);
+
+  /**
+   * Sets the maximum number of cached file descriptors. Descriptors that are being read from are never closed, so up
+   * to one descriptor per thread may be open in addition. Can be called from any thread.
+   */
+  void set_max_open_files(uint32_t count);
+
+  /** Makes sure that scratch space for at least #count threads is available */
+  void set_thread_count(uint32_t count);
+
+  /**
+   * Reads #size bytes at #offset in the file #file_id.
+   * @return a pointer to the data, valid until the next call to read_range() with the same #thread, or nullptr if
+   * the range could not be read
+   */
+  const char *read_range(int file_id, uint64_t offset, uint64_t size,
+                         int thread);
+
+  /** Tells the kernel that the given range will be read soon, so that it can start reading it ahead */
+  void will_need(int file_id, uint64_t offset, uint64_t size);
+
+  /**
+   * Decompresses the contig record of #size_bytes bytes at #compressed.
+   * @return a pointer to the decompressed features (after the length prefix), valid until the next call to
+   * decompress() with the same #thread, or nullptr if the record is corrupted
+   */
+  const char *decompress(const char *compressed, uint32_t size_bytes,
+                         uint32_t length_bases, uint32_t bytes_per_base,
+                         int thread);
+
+ private:
+  struct ThreadState {
+    std::vector<char> range;
+    std::vector<char> uncompressed;
+    z_stream stream;
+    bool stream_initialized = false;
+  };
+
+  struct File {
+    std::string name;
+    int fd = -1;
+    // the number of reads in progress; the descriptor is only closed when there are none
+    uint32_t readers = 0;
+    // position in #lru_ while the descriptor is open
+    std::list<int>::iterator lru;
+  };
+
+  /**
+   * Returns the descriptor of #file_id, opening it if needed, or -1 if it can't be opened. Each successful call must be
+   * followed by a call to release().
+   */
+  int acquire(int file_id);
+  void release(int file_id);
+  /** Closes the least recently used descriptor that isn't being read from; returns false if there is none */
+  bool close_lru();
+
+  std::vector<File> files_;
+  std::unordered_map<std::string, int> file_ids_;
+  // the ids of the files with an open descriptor, most recently used first
+  std::list<int> lru_;
+  // guards #files_ and #lru_
+  std::mutex files_mutex_;
+  std::atomic<uint32_t> max_open_files_{64};
+  std::vector<std::unique_ptr<ThreadState>> threads_;
+};
@@ -1,38 +1,25 @@
 import csv
-import gzip
 import json
 import logging
 import math
 import mmap
 import os
-import statistics
+import resource
 import struct
+import threading
+import weakref
+import zlib
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from glob import glob
 from timeit import default_timer as timer
-from typing import Dict, List, Tuple
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
+from resmico import catalog
 from resmico import reader
-
-
-def _replace_with_nan(data, feature_name, v):
-    """Replaces all elements in arr that are equal to v with np.nan"""
-    if feature_name not in data:
-        return
-    arr = data[feature_name]
-    arr[arr == v] = np.nan
-
-
-def _read_feature(file: gzip.GzipFile, data, feature_name: str, bytes: int, dtype, feature_names: List[str],
-                  normalize_by: int = 1):
-    if feature_name not in feature_names:
-        file.seek(bytes, os.SEEK_CUR)
-        return
-    # `.astype()` is needed even if dtype already is np.float32, otherwise the array is read-only
-    data[feature_name] = np.frombuffer(file.read(bytes), dtype=dtype).astype(np.float32)
-    if normalize_by != 1:
-        data[feature_name] /= normalize_by
+from resmico import toc
 
 
 def _to_float_and_normalize(features, result, feature_name, normalize_by):
@@ -53,34 +40,32 @@ def _assign(result, orig, feature_names: List[str]):
             result[feature_name] = orig[feature_name]
 
 
+# features stored as fixed point integers, which are divided by the given value when converted to float
+_SCALED_FEATURES = {'num_query_A': 10000, 'num_query_C': 10000, 'num_query_G': 10000, 'num_query_T': 10000,
+                    'num_SNPs': 10000, 'num_discordant': 10000, 'num_proper_Match': 10000,
+                    'num_orphans_Match': 10000, 'num_proper_SNP': 10000}
+# integer features that use a marker value for missing data, which is replaced with NaN when converted to float
+_NAN_VALUES = {'min_insert_size_Match': 65535, 'max_insert_size_Match': 65535, 'min_mapq_Match': 255,
+               'max_mapq_Match': 255, 'min_al_score_Match': 127, 'max_al_score_Match': 127}
+
+
 def _post_process_features(features):
     result = {}
+    # the one-hot encoded reference base is stored as uint8 (it is converted to the feature type when stacked)
     if 'ref_base' in features:
         ref_base = features['ref_base']
-        result['ref_base_A'] = np.where(ref_base == 65, 1, 0)
-        result['ref_base_C'] = np.where(ref_base == 67, 1, 0)
-        result['ref_base_G'] = np.where(ref_base == 71, 1, 0)
-        result['ref_base_T'] = np.where(ref_base == 84, 1, 0)
+        result['ref_base_A'] = (ref_base == 65).view(np.uint8)
+        result['ref_base_C'] = (ref_base == 67).view(np.uint8)
+        result['ref_base_G'] = (ref_base == 71).view(np.uint8)
+        result['ref_base_T'] = (ref_base == 84).view(np.uint8)
 
     # coverage is uint16, but it needs to be cast to flaot32 because it's going to be normalized by mean/stdev later
     if 'coverage' in features:
         result['coverage'] = features['coverage'].astype(np.float32)
-    _to_float_and_normalize(features, result, 'num_query_A', 10000)
-    _to_float_and_normalize(features, result, 'num_query_C', 10000)
-    _to_float_and_normalize(features, result, 'num_query_G', 10000)
-    _to_float_and_normalize(features, result, 'num_query_T', 10000)
-    _to_float_and_normalize(features, result, 'num_SNPs', 10000)
-    _to_float_and_normalize(features, result, 'num_discordant', 10000)
-    _to_float_and_normalize(features, result, 'num_proper_Match', 10000)
-    _to_float_and_normalize(features, result, 'num_orphans_Match', 10000)
-    _to_float_and_normalize(features, result, 'num_proper_SNP', 10000)
-
-    _to_float_and_nan(features, result, 'min_insert_size_Match', 65535)
-    _to_float_and_nan(features, result, 'max_insert_size_Match', 65535)
-    _to_float_and_nan(features, result, 'min_mapq_Match', 255)
-    _to_float_and_nan(features, result, 'max_mapq_Match', 255)
-    _to_float_and_nan(features, result, 'min_al_score_Match', 127)
-    _to_float_and_nan(features, result, 'max_al_score_Match', 127)
+    for feature_name, normalize_by in _SCALED_FEATURES.items():
+        _to_float_and_normalize(features, result, feature_name, normalize_by)
+    for feature_name, nan_value in _NAN_VALUES.items():
+        _to_float_and_nan(features, result, feature_name, nan_value)
 
     _assign(result, features, [
         'mean_insert_size_Match',
@@ -95,62 +80,68 @@ def _post_process_features(features):
     return result
 
 
-def _read_contig_data(input_file, feature_names: List[str]):
+# offset of each feature in a decompressed contig record, in multiples of the contig length (after the 4 byte length)
+_FEATURE_OFFSETS = np.concatenate([[0], np.cumsum(reader.feature_sizes)])
+# the decompressor window bits for gzip-wrapped zlib data
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _decompress(record) -> bytes:
     """
-    Read a binary gzipped file containing the features for a single contig, as written by bam2feat. Features that don't
-    exist are silently ignored.
+    Decompresses a single gzipped contig record. record is either a bytes-like object starting with the record or a
+    file opened at the start of the record (in which case only the bytes belonging to the record are consumed).
+    """
+    if not hasattr(record, 'read'):
+        return zlib.decompress(record, _GZIP_WBITS)
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    parts = []
+    while not decompressor.eof:
+        chunk = record.read(1 << 16)
+        if not chunk:
+            break
+        parts.append(decompressor.decompress(chunk))
+    return b''.join(parts)
+
+
+def _read_contig_data(record, feature_names: List[str]):
+    """
+    Read a binary gzipped record containing the features for a single contig, as written by bam2feat. Features that
+    don't exist are silently ignored. The record is decompressed at once and the features are read from views at
+    precomputed offsets into the decompressed data, so only the requested features are converted.
     Parameters:
-         - input_file: the file to read, opened at the correct offset
+         - record: the compressed record (e.g. a memoryview into a memory-mapped features_binary file) or a file
+           opened at the correct offset
          - feature_names list of feature names to return (e.g. ['coverage', 'num_discordant', 'min_mapq_Match'])
     Returns:
          - a map from feature name to feature data
     """
+    raw = _decompress(record)
+    contig_size = struct.unpack_from('I', raw)[0]
+    offsets = 4 + _FEATURE_OFFSETS * contig_size
+
+    def view(feature_name):
+        idx = reader.feature_names.index(feature_name)
+        return np.frombuffer(raw, dtype=reader.feature_types[idx], count=contig_size, offset=offsets[idx])
+
     data = {}
-    with gzip.open(input_file) as f:
-        contig_size = struct.unpack('I', f.read(4))[0]
-        ref_base = np.frombuffer(f.read(contig_size), dtype=np.uint8)
-        # create the one-hot encoding for the reference base
-        data['ref_base_A'] = np.where(ref_base == 65, 1, 0)
-        data['ref_base_C'] = np.where(ref_base == 67, 1, 0)
-        data['ref_base_G'] = np.where(ref_base == 71, 1, 0)
-        data['ref_base_T'] = np.where(ref_base == 84, 1, 0)
-        data['coverage'] = np.frombuffer(f.read(2 * contig_size), dtype=np.uint16).astype(np.float32)
-        # everything is converted to float32, because frombuffer creates an immutable array, so the int values need to
-        # be made mutable (in order to convert from fixed point back to float) and the float values need to be copied
-        # (in order to make them writeable for normalization)
-        _read_feature(f, data, 'num_query_A', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'num_query_C', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'num_query_G', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'num_query_T', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'num_SNPs', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'num_discordant', 2 * contig_size, np.uint16, feature_names, 10000)
-
-        _read_feature(f, data, 'min_insert_size_Match', 2 * contig_size, np.uint16, feature_names)
-        _read_feature(f, data, 'mean_insert_size_Match', 4 * contig_size, np.float32, feature_names)
-        _read_feature(f, data, 'stdev_insert_size_Match', 4 * contig_size, np.float32, feature_names)
-        _read_feature(f, data, 'max_insert_size_Match', 2 * contig_size, np.uint16, feature_names)
-        _replace_with_nan(data, 'min_insert_size_Match', 65535)
-        _replace_with_nan(data, 'max_insert_size_Match', 65535)
-
-        _read_feature(f, data, 'min_mapq_Match', contig_size, np.uint8, feature_names)
-        _read_feature(f, data, 'mean_mapq_Match', 4 * contig_size, np.float32, feature_names)
-        _read_feature(f, data, 'stdev_mapq_Match', 4 * contig_size, np.float32, feature_names)
-        _read_feature(f, data, 'max_mapq_Match', contig_size, np.uint8, feature_names)
-        _replace_with_nan(data, 'min_mapq_Match', 255)
-        _replace_with_nan(data, 'max_mapq_Match', 255)
-
-        _read_feature(f, data, 'min_al_score_Match', contig_size, np.int8, feature_names)
-        _read_feature(f, data, 'mean_al_score_Match', 4 * contig_size, np.float32, feature_names)
-        _read_feature(f, data, 'stdev_al_score_Match', 4 * contig_size, np.float32, feature_names)
-        _read_feature(f, data, 'max_al_score_Match', contig_size, np.int8, feature_names)
-        _replace_with_nan(data, 'min_al_score_Match', 127)
-        _replace_with_nan(data, 'max_al_score_Match', 127)
-
-        _read_feature(f, data, 'num_proper_Match', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'num_orphans_Match', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'num_proper_SNP', 2 * contig_size, np.uint16, feature_names, 10000)
-        _read_feature(f, data, 'seq_window_perc_gc', 4 * contig_size, np.float32, feature_names)
-        _read_feature(f, data, 'seq_window_entropy', 4 * contig_size, np.float32, feature_names)
+    # create the one-hot encoding for the reference base
+    ref_base = view('ref_base')
+    data['ref_base_A'] = (ref_base == 65).view(np.uint8)
+    data['ref_base_C'] = (ref_base == 67).view(np.uint8)
+    data['ref_base_G'] = (ref_base == 71).view(np.uint8)
+    data['ref_base_T'] = (ref_base == 84).view(np.uint8)
+    # everything is converted to float32, because frombuffer creates an immutable array, so the int values need to
+    # be made mutable (in order to convert from fixed point back to float) and the float values need to be copied
+    # (in order to make them writeable for normalization)
+    data['coverage'] = view('coverage').astype(np.float32)
+    for feature_name in reader.feature_names[2:]:
+        if feature_name not in feature_names:
+            continue
+        data[feature_name] = view(feature_name).astype(np.float32)
+        if feature_name in _SCALED_FEATURES:
+            data[feature_name] /= _SCALED_FEATURES[feature_name]
+        elif feature_name in _NAN_VALUES:
+            data[feature_name][data[feature_name] == _NAN_VALUES[feature_name]] = np.nan
     return data
 
 
@@ -160,7 +151,7 @@ class ContigInfo:
     """
 
     def __init__(self, name: str, file_name: str, length: int, offset: int, size_bytes: int, misassembly_count: int,
-                 breakpoints: List[Tuple[int, int]], avg_coverage: float):
+                 breakpoints: List[Tuple[int, int]], avg_coverage: float, source: str = None):
         self.name: str = name
         self.file: str = file_name
         self.length: int = length
@@ -170,6 +161,249 @@ class ContigInfo:
         self.features: Dict[str:np.array] = {}
         self.breakpoints = breakpoints
         self.avg_coverage = avg_coverage
+        # the directory the contig was originally written to by bam2feat; this differs from the directory of #file
+        # for repacked data sets (see repack.py)
+        self.source: str = os.path.dirname(file_name) if source is None else source
+
+
+class ContigNames:
+    """
+    The names of a set of contigs, stored as utf-8 encoded slices of one or more blobs (e.g. the memory-mapped names of
+    a binary toc); the name of contig i is blobs[blob_ids[i]][offsets[i]:offsets[i] + lengths[i]]. Names are only
+    decoded when accessed, so that loading the metadata of millions of contigs doesn't create millions of Python
+    strings.
+    """
+
+    def __init__(self, blobs: List, blob_ids: np.ndarray, offsets: np.ndarray, lengths: np.ndarray):
+        self.blobs = blobs
+        self.blob_ids = np.asarray(blob_ids, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+
+    @staticmethod
+    def from_list(names: List[str]):
+        encoded = [name.encode('utf-8') for name in names]
+        lengths = np.array([len(name) for name in encoded], dtype=np.int64)
+        return ContigNames([b''.join(encoded)], np.zeros(len(encoded), dtype=np.int32),
+                           np.cumsum(lengths) - lengths, lengths)
+
+    @staticmethod
+    def concatenate(parts: List['ContigNames']):
+        blob_counts = np.cumsum([0] + [len(part.blobs) for part in parts])
+        return ContigNames([blob for part in parts for blob in part.blobs],
+                           np.concatenate([part.blob_ids + blob_count for part, blob_count in zip(parts, blob_counts)]),
+                           np.concatenate([part.offsets for part in parts]),
+                           np.concatenate([part.lengths for part in parts]))
+
+    def subset(self, indices: np.ndarray):
+        return ContigNames(self.blobs, self.blob_ids[indices], self.offsets[indices], self.lengths[indices])
+
+    def __getstate__(self):
+        # memory-mapped blobs (the names of a binary toc) can't be pickled, e.g. when the reader is sent to another
+        # process, so they are copied
+        state = self.__dict__.copy()
+        state['blobs'] = [bytes(blob) for blob in self.blobs]
+        return state
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx: int) -> str:
+        offset = int(self.offsets[idx])
+        return bytes(self.blobs[self.blob_ids[idx]][offset:offset + int(self.lengths[idx])]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ContigMetadata:
+    """
+    Metadata about a set of contigs, stored as numpy columns (struct-of-arrays) so that filtering, sampling and
+    label extraction can be vectorized. Breakpoints are CSR-encoded: the breakpoints of contig i are
+    breakpoints[breakpoint_idx[i]:breakpoint_idx[i + 1]].
+    Each entry of #files has a corresponding entry in #sources (the original directory of the contigs, see
+    ContigInfo.source); a repacked feature file holding contigs of several sources is listed once for each source.
+    Indexing or iterating returns ContigInfo objects that are created on the fly (decoding the contig's name), so the
+    class can be used as a read-only list of ContigInfo.
+    """
+
+    def __init__(self, names: Union[List[str], ContigNames], files: List[str], file_ids: np.ndarray, lengths: np.ndarray,
+                 offsets: np.ndarray, sizes: np.ndarray, misassembly: np.ndarray, avg_coverage: np.ndarray,
+                 breakpoint_idx: np.ndarray, breakpoints: np.ndarray, sources: List[str] = None):
+        self.names: ContigNames = names if isinstance(names, ContigNames) else ContigNames.from_list(names)
+        # the feature files; the feature file of contig i is files[file_ids[i]] and its source is sources[file_ids[i]]
+        self.files: List[str] = files
+        self.sources: List[str] = [os.path.dirname(f) for f in files] if sources is None else sources
+        self.file_ids = np.asarray(file_ids, dtype=np.int32)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.misassembly = np.asarray(misassembly, dtype=np.int32)
+        self.avg_coverage = np.asarray(avg_coverage, dtype=np.float64)
+        self.breakpoint_idx = np.asarray(breakpoint_idx, dtype=np.int64)
+        self.breakpoints = np.asarray(breakpoints, dtype=np.int64).reshape(-1, 2)
+
+    @staticmethod
+    def empty():
+        return ContigMetadata([], [], [], [], [], [], [], [], [0], [])
+
+    @staticmethod
+    def from_contig_infos(contig_infos: List[ContigInfo]):
+        file_sources = list(dict.fromkeys((c.file, c.source) for c in contig_infos))
+        file_idx = {f: i for i, f in enumerate(file_sources)}
+        breakpoint_counts = [len(c.breakpoints) for c in contig_infos]
+        return ContigMetadata([c.name for c in contig_infos], [f[0] for f in file_sources],
+                              [file_idx[(c.file, c.source)] for c in contig_infos],
+                              [c.length for c in contig_infos], [c.offset for c in contig_infos],
+                              [c.size_bytes for c in contig_infos], [c.misassembly for c in contig_infos],
+                              [c.avg_coverage for c in contig_infos], np.cumsum([0] + breakpoint_counts),
+                              [b for c in contig_infos for b in c.breakpoints], [f[1] for f in file_sources])
+
+    @staticmethod
+    def concatenate(parts: List['ContigMetadata']):
+        if not parts:
+            return ContigMetadata.empty()
+        file_sources = list(dict.fromkeys(f for part in parts for f in zip(part.files, part.sources)))
+        file_idx = {f: i for i, f in enumerate(file_sources)}
+        breakpoint_idx = [np.zeros(1, dtype=np.int64)]
+        breakpoint_count = 0
+        for part in parts:
+            breakpoint_idx.append(part.breakpoint_idx[1:] + breakpoint_count)
+            breakpoint_count += part.breakpoint_idx[-1]
+        return ContigMetadata(ContigNames.concatenate([part.names for part in parts]), [f[0] for f in file_sources],
+                              np.concatenate([np.array([file_idx[f] for f in zip(part.files, part.sources)],
+                                                       dtype=np.int32)[part.file_ids] for part in parts]),
+                              np.concatenate([part.lengths for part in parts]),
+                              np.concatenate([part.offsets for part in parts]),
+                              np.concatenate([part.sizes for part in parts]),
+                              np.concatenate([part.misassembly for part in parts]),
+                              np.concatenate([part.avg_coverage for part in parts]),
+                              np.concatenate(breakpoint_idx),
+                              np.concatenate([part.breakpoints for part in parts]), [f[1] for f in file_sources])
+
+    def subset(self, indices):
+        """
+        Returns the metadata for the contigs at the given indices (or where the given boolean mask is True).
+        """
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        counts = self.breakpoint_idx[indices + 1] - self.breakpoint_idx[indices]
+        breakpoint_idx = np.concatenate([[0], np.cumsum(counts)])
+        # position of each selected breakpoint in self.breakpoints
+        bp_pos = np.repeat(self.breakpoint_idx[indices] - breakpoint_idx[:-1], counts) + np.arange(breakpoint_idx[-1])
+        return ContigMetadata(self.names.subset(indices), self.files, self.file_ids[indices],
+                              self.lengths[indices], self.offsets[indices], self.sizes[indices],
+                              self.misassembly[indices], self.avg_coverage[indices], breakpoint_idx,
+                              self.breakpoints[bp_pos], self.sources)
+
+    def contig_breakpoints(self, idx: int) -> List[Tuple[int, int]]:
+        breakpoints = self.breakpoints[self.breakpoint_idx[idx]:self.breakpoint_idx[idx + 1]]
+        return [(int(b[0]), int(b[1])) for b in breakpoints]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'Contig index {idx} out of range')
+        return ContigInfo(self.names[idx], self.files[self.file_ids[idx]], int(self.lengths[idx]),
+                          int(self.offsets[idx]), int(self.sizes[idx]), int(self.misassembly[idx]),
+                          self.contig_breakpoints(idx), float(self.avg_coverage[idx]),
+                          self.sources[self.file_ids[idx]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ChunkInfo:
+    """
+    Contains metadata about a contig chunk, i.e. an interval [start, stop) of a full contig record, as listed in
+    toc_chunked.
+    """
+
+    def __init__(self, contig_idx: int, start: int, stop: int, misassembly_count: int,
+                 breakpoints: List[Tuple[int, int]]):
+        # the position of the contig in ContigReader.contigs
+        self.contig_idx: int = contig_idx
+        self.start: int = start
+        self.stop: int = stop
+        self.misassembly: int = misassembly_count
+        # breakpoints are relative to start
+        self.breakpoints = breakpoints
+
+    @property
+    def length(self):
+        return self.stop - self.start
+
+
+def open_files_limit() -> int:
+    """
+    Returns the number of files that a cache of open files (or memory mappings, which also hold a file descriptor) may
+    keep open: a quarter of the soft RLIMIT_NOFILE, leaving room for the other caches and for the libraries of the
+    process
+    """
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        soft_limit = 1 << 16
+    return max(1, soft_limit // 4)
+
+
+def find_stats_files(input_dirs: str, feature_file_match: str = ''):
+    """
+    Finds the stats files of the feature directories in input_dirs: a directory (or comma separated directories)
+    searched recursively, a file listing the stats files or a dataset catalog.
+    Returns:
+        - the paths of the stats files
+        - the content of the stats files if already known (i.e. when reading from a catalog), None otherwise
+    """
+    file_list = []
+    # the content of the stats files, if already known (i.e. when reading from a catalog)
+    stats_list = None
+    if catalog.is_catalog(input_dirs):
+        logging.info(f'  Reading the feature files from the catalog {input_dirs}')
+        dataset_catalog = catalog.load(input_dirs)
+        file_list = catalog.stats_files(dataset_catalog, input_dirs)
+        stats_list = [d['stats_data'] for d in dataset_catalog['datasets']]
+        if feature_file_match:
+            selected = [i for i, f in enumerate(file_list) if feature_file_match in f]
+            file_list = [file_list[i] for i in selected]
+            stats_list = [stats_list[i] for i in selected]
+            logging.info(f'Filtered for directories matching: {feature_file_match}. {len(file_list)} out of '
+                         f'{len(dataset_catalog["datasets"])} kept')
+    elif os.path.isfile(input_dirs):
+        msg = '  Assuming that the feature files are provided in a file as a list'
+        logging.info(msg)
+        base_dir = os.path.split(input_dirs)[0]
+        with open(input_dirs) as inF:
+            for line in inF:
+                line = line.rstrip().split(' ')[0]
+                if os.path.isfile(line):
+                    file_list.append(line)
+                else:
+                    # appending on the path of the file list
+                    line = os.path.join(base_dir, line)
+                    if os.path.isfile(line):
+                        file_list.append(line)
+    else:
+        logging.info('Looking for stats/toc files...')
+        for input_dir in input_dirs.split(','):
+            fl = list(glob(input_dir + '/**/stats', recursive=True))
+            if feature_file_match:
+                count = len(fl)
+                fl = [f for f in fl if feature_file_match in f]
+                logging.info(
+                    f'Filtered for directories matching: {feature_file_match}. {len(file_list)} out of {count} kept')
+            file_list.extend(fl)        
+            logging.info(f'Processing {len(file_list)} stats/toc files found in {input_dir} ...')
+    return file_list, stats_list
 
 
 class ContigReader:
@@ -179,10 +413,11 @@ class ContigReader:
 
     def __init__(self, input_dirs: str, feature_names: List[str], process_count: int,
                  no_cython: bool = False, stats_file: str = '', min_len: int = 0, min_avg_coverage: int = 0,
-                 feature_file_match: str = ''):
+                 feature_file_match: str = '', max_in_flight: int = 2, load_metadata: bool = True):
         """
         Arguments:
-            - input_dir: location on disk where the feature data is stored
+            - input_dir: location on disk where the feature data is stored: a directory (or comma separated
+              directories) searched recursively, a file listing the stats files or a dataset catalog
             - feature_names: feature names to use in training
             - process_count: number of processes to use for loading data in parallel
             - no_cython: whether to read data from disk using pure Python or using Cython bindings
@@ -190,13 +425,19 @@ class ContigReader:
             - min_len: exclude all contigs shorter than min_len
             - input_dir_match string that the directories for the feature files must match; useful for filtering
               contigs with certain properties, such as sequencing depth, abundance, etc.
+            - max_in_flight: maximum number of asynchronous requests (see #submit) that are processed at the same
+              time; each of them uses up to process_count threads
+            - load_metadata: if False, the metadata of the contigs is not loaded (#metadata stays empty); useful when
+              only looking up a few contigs by name using #find_contigs
         """
         # means and stdevs are a map from feature name to the mean and standard deviation precomputed for that
         # feature across *all* contigs, stored as a tuple
         self.means: Dict[str, float] = {}
         self.stdevs: Dict[str, float] = {}
-        # a list of ContigInfo objects with metadata about all contigs found in #input_dir
-        self.contigs: List[ContigInfo] = []
+        # metadata about all contigs found in #input_dir; #contigs is a list-like view of ContigInfo objects into it
+        self.metadata: ContigMetadata = ContigMetadata.empty()
+        # the stats files for all the data sets that were loaded
+        self.file_list: List[str] = []
 
         self.feature_names = feature_names
         self.process_count = process_count
@@ -210,34 +451,26 @@ class ContigReader:
         self.feature_file_match = feature_file_match
 
         self.feature_mask: List[int] = [1 if feature in feature_names else 0 for feature in reader.feature_names]
+        self.max_in_flight = max_in_flight
+        # the native reader of each thread (keeps file descriptors and buffers across calls); created on first use
+        self._local = threading.local()
+        # all the live native readers, which share the budget of open file descriptors
+        self._feature_readers = weakref.WeakSet()
+        self._feature_readers_lock = threading.Lock()
+        # the background threads used by #submit and the number of free slots; created on first use
+        self._executor = None
+        self._free_slots = None
+        # used when reading with pure Python: the memory-mapped feature files (at most #open_files_limit of them, least
+        # recently used first) and the threads decompressing the contig records (zlib releases the GIL); created on
+        # first use
+        self._mmaps: Dict[str, mmap.mmap] = OrderedDict()
+        self._mmaps_lock = threading.Lock()
+        self._decoder = None
+        # the name index of each feature directory, used by #find_contigs; opened on first use
+        self._name_indexes: Dict[str, toc.NameIndex] = {}
 
-        # getting feature file paths
-        file_list = []
-        if os.path.isfile(input_dirs):
-            msg = '  Assuming that the feature files are provided in a file as a list'
-            logging.info(msg)
-            base_dir = os.path.split(input_dirs)[0]
-            with open(input_dirs) as inF:
-                for line in inF:
-                    line = line.rstrip().split(' ')[0]
-                    if os.path.isfile(line):
-                        file_list.append(line)
-                    else:
-                        # appending on the path of the file list
-                        line = os.path.join(base_dir, line)
-                        if os.path.isfile(line):
-                            file_list.append(line)
-        else:
-            logging.info('Looking for stats/toc files...')
-            for input_dir in input_dirs.split(','):
-                fl = list(glob(input_dir + '/**/stats', recursive=True))
-                if feature_file_match:
-                    count = len(fl)
-                    fl = [f for f in fl if feature_file_match in f]
-                    logging.info(
-                        f'Filtered for directories matching: {feature_file_match}. {len(file_list)} out of {count} kept')
-                file_list.extend(fl)        
-                logging.info(f'Processing {len(file_list)} stats/toc files found in {input_dir} ...')        
+        # getting feature file paths and, for catalogs, the content of the stats files
+        file_list, stats_list = find_stats_files(input_dirs, feature_file_match)
         if not file_list:
             logging.info('Nothing to do.')
             exit(0)
@@ -247,7 +480,12 @@ class ContigReader:
         # stats.json file
         if stats_file == '':
             logging.info('Computing global means and standard deviations...')
-            self._compute_mean_stdev(file_list)
+            if stats_list is None:
+                stats_list = []
+                for fname in file_list:
+                    with open(fname) as f:
+                        stats_list.append(json.load(f))
+            self._compute_mean_stdev(stats_list)
             if ',' not in input_dirs:
                 if os.path.isfile(input_dirs):
                     out_file = os.path.join(os.path.split(input_dirs)[0], 'stats.json')
@@ -262,10 +500,125 @@ class ContigReader:
             means_stdevs = json.load(open(stats_file))
             self.means, self.stdevs = means_stdevs['means'], means_stdevs['stdevs']
 
-        self._load_contigs_metadata(file_list)    
+        self.file_list = file_list
+        if load_metadata:
+            self._load_contigs_metadata(file_list)
         
     def __len__(self):
-        return len(self.contigs)
+        return len(self.metadata)
+
+    @property
+    def contigs(self) -> ContigMetadata:
+        return self.metadata
+
+    @contigs.setter
+    def contigs(self, contig_infos: List[ContigInfo]):
+        self.metadata = contig_infos if isinstance(contig_infos, ContigMetadata) else ContigMetadata.from_contig_infos(
+            contig_infos)
+
+    def __getstate__(self):
+        # the native readers hold open file descriptors and the threads can't be shared, so each process creates its
+        # own
+        state = self.__dict__.copy()
+        state['_local'] = state['_executor'] = state['_free_slots'] = state['_decoder'] = None
+        state['_feature_readers'] = state['_feature_readers_lock'] = None
+        state['_mmaps'] = OrderedDict()
+        state['_name_indexes'] = {}
+        state['_mmaps_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._feature_readers = weakref.WeakSet()
+        self._feature_readers_lock = threading.Lock()
+        self._mmaps_lock = threading.Lock()
+
+    def feature_reader(self) -> reader.FeatureReader:
+        """
+        Returns the long-lived native reader of the current thread used for reading contig data with Cython (a
+        FeatureReader must not be used by multiple threads at the same time). The readers of all the threads share
+        #open_files_limit file descriptors.
+        """
+        if getattr(self._local, 'feature_reader', None) is None:
+            feature_reader = reader.FeatureReader(self.process_count)
+            with self._feature_readers_lock:
+                self._feature_readers.add(feature_reader)
+                max_open_files = max(1, open_files_limit() // len(self._feature_readers))
+                for r in self._feature_readers:
+                    r.set_max_open_files(max_open_files)
+            self._local.feature_reader = feature_reader
+        return self._local.feature_reader
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """
+        Runs fn(*args, **kwargs) in a background thread and returns a Future for the result. At most #max_in_flight
+        requests are processed at the same time; when all slots are taken, the call blocks until a request finishes.
+        Reading with Cython doesn't hold the GIL, so the requests run in parallel with the caller (e.g. with training).
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, self.max_in_flight),
+                                                thread_name_prefix='contig-reader')
+            self._free_slots = threading.BoundedSemaphore(max(1, self.max_in_flight))
+        self._free_slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._free_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._free_slots.release())
+        return future
+
+    def read_contigs_async(self, contig_infos: List[ContigInfo], return_raw=False) -> Future:
+        """ Asynchronous version of #read_contigs; the future's result is the list returned by read_contigs """
+        return self.submit(self.read_contigs, list(contig_infos), return_raw)
+
+    def read_into_async(self, contig_indices, starts, stops, rows, expanded_feature_names: List[str], x: np.ndarray,
+                        mask: np.ndarray = None, mask_lengths=None) -> Future:
+        """
+        Asynchronous version of #read_into; x and mask must not be used until the returned future is done
+        """
+        return self.submit(self.read_into, contig_indices, starts, stops, rows, expanded_feature_names, x, mask,
+                           mask_lengths)
+
+    def find_contigs(self, names: List[str]) -> List[ContigInfo]:
+        """
+        Looks up contigs by name in all the feature directories, without loading their metadata. The name index
+        (toc_index, created by `python -m resmico.toc`) of each directory is used if present and up to date; otherwise
+        the directory's toc is scanned. Length and coverage filters are not applied.
+        Returns:
+            - the ContigInfo of each contig found, in the order of names; a name may match contigs in several
+              directories (e.g. samples assembled separately), and names that are not found are logged and skipped
+        """
+        start = timer()
+        matches: Dict[str, List[ContigInfo]] = {name: [] for name in names}
+        for fname in self.file_list:
+            toc_file = fname[:-len('stats')] + 'toc'
+            contig_fname = fname[:-len('stats')] + 'features_binary'
+            name_index = self._open_name_index(toc_file)
+            if name_index is not None:
+                binary_toc = name_index.binary_toc
+                sources = toc.read_sources(toc_file)
+                for name in matches:
+                    for i in name_index.find(name):
+                        record = binary_toc.records[i]
+                        matches[name].append(
+                            ContigInfo(name, contig_fname, int(record['length']), int(record['offset']),
+                                       int(record['size_bytes']), int(record['misassembly']),
+                                       binary_toc.contig_breakpoints(i), float(record['avg_coverage']),
+                                       None if sources is None else sources[int(record['source'])]))
+            else:
+                part = self._read_toc(toc_file, contig_fname)
+                for i, name in enumerate(part.names):
+                    if name in matches:
+                        matches[name].append(part[i])
+        missing = [name for name, found in matches.items() if not found]
+        if missing:
+            logging.warning(f'{len(missing)} contigs not found: {",".join(missing[:10])}'
+                            f'{",..." if len(missing) > 10 else ""}')
+        result = [c for name in names for c in matches[name]]
+        logging.debug(f'Found {len(result)} contigs in {(timer() - start):5.2f}s')
+        return result
 
     def read_contigs(self, contig_infos: List[ContigInfo], return_raw=False):
         """
@@ -277,8 +630,13 @@ class ContigReader:
         self.read_time = 0
         result = []
         if self.no_cython:
-            for contig_data in map(self._read_and_normalize, contig_infos):
-                result.append(contig_data)
+            if self.process_count > 1 and len(contig_infos) > 1:
+                if self._decoder is None:
+                    self._decoder = ThreadPoolExecutor(max_workers=self.process_count,
+                                                       thread_name_prefix='contig-decoder')
+                result = list(self._decoder.map(self._read_and_normalize, contig_infos))
+            else:
+                result = [self._read_and_normalize(c) for c in contig_infos]
         else:
             file_names: List[bytes] = []
             lengths: List[int] = []
@@ -290,8 +648,7 @@ class ContigReader:
                 offsets.append(c.offset)
                 sizes.append(c.size_bytes)
 
-            features_raw = reader.read_contigs_py(file_names, lengths, offsets, sizes, self.feature_mask,
-                                                  self.process_count)
+            features_raw = self.feature_reader().read_contigs(file_names, lengths, offsets, sizes, self.feature_mask)
             # traverse features for each contig, convert to proper data type and normalize by mean/stdev if needed
             for f in features_raw:
                 features = _post_process_features(f)
@@ -302,7 +659,143 @@ class ContigReader:
                       f'normalize: {self.normalize_time:5.2f}s')
         return result
 
-    def _compute_mean_stdev(self, file_list):
+    def read_into(self, contig_indices, starts, stops, rows, expanded_feature_names: List[str], x: np.ndarray,
+                  mask: np.ndarray = None, mask_lengths=None):
+        """
+        Reads the intervals [starts[i], stops[i]) of the contigs at contig_indices (indices into #metadata) and writes
+        their normalized features to x[rows[i], :stops[i] - starts[i]]; the rest of each written row is set to zero.
+        Each contig is read only once, even if it appears multiple times in contig_indices. With Cython, decoding,
+        normalization and stacking happen in a single native pass, without creating intermediate arrays.
+        Arguments:
+            - contig_indices, starts, stops, rows: the batch plan, one entry per destination row
+            - expanded_feature_names: the features in the order of the columns of x (with ref_base one-hot encoded
+              as ref_base_A/C/G/T)
+            - x: array of shape (batch_size, max_len, len(expanded_feature_names)); float32 is written directly, other
+              types (e.g. float16) are converted from a temporary float32 tensor
+            - mask: if present, mask[rows[i]] is set to 1 for the first mask_lengths[i] positions and to 0 after that
+        """
+        if not self.no_cython and x.dtype != np.float32:
+            # reduced precision batch: read natively into a float32 tensor and convert it
+            x32 = np.empty(x.shape, dtype=np.float32)
+            self.read_into(contig_indices, starts, stops, rows, expanded_feature_names, x32, mask, mask_lengths)
+            rows = np.asarray(rows, dtype=np.int64)
+            x[rows] = x32[rows]
+            return
+        start = timer()
+        contig_indices = np.asarray(contig_indices, dtype=np.int64)
+        if mask_lengths is None:
+            mask_lengths = np.zeros(len(contig_indices), dtype=np.int64)
+        # group the pieces by contig, so that each contig is decompressed once
+        unique_indices, inverse = np.unique(contig_indices, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        piece_idx = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(unique_indices)))])
+        starts, stops, rows, mask_lengths = [np.asarray(a, dtype=np.int64)[order] for a in
+                                             (starts, stops, rows, mask_lengths)]
+        if self.no_cython or x.dtype != np.float32 or not x.flags['C_CONTIGUOUS']:
+            contig_data = self.read_contigs([self.metadata[i] for i in unique_indices])
+            for ctg, features in enumerate(contig_data):
+                for p in range(piece_idx[ctg], piece_idx[ctg + 1]):
+                    # only the rows of the piece are copied, one feature (column of x) at a time
+                    length = 0
+                    for j, f in enumerate(expanded_feature_names):
+                        data = features[f][starts[p]:stops[p]][:x.shape[1]]
+                        x[rows[p], :len(data), j] = data
+                        length = len(data)
+                    x[rows[p], length:] = 0
+                    if mask is not None:
+                        mask[rows[p], :mask_lengths[p]] = 1
+                        mask[rows[p], mask_lengths[p]:] = 0
+        else:
+            metadata = self.metadata
+            self.feature_reader().read_contigs_into(
+                [metadata.files[i].encode('utf-8') for i in metadata.file_ids[unique_indices]],
+                metadata.lengths[unique_indices], metadata.offsets[unique_indices], metadata.sizes[unique_indices],
+                piece_idx, starts, stops, rows, mask_lengths, self._feature_conversions(expanded_feature_names), x,
+                None if mask is None else mask.view(np.uint8))
+        logging.debug(f'Read {len(unique_indices)} contigs into {len(rows)} rows in {(timer() - start):5.2f}s')
+
+    def _feature_conversions(self, expanded_feature_names: List[str]) -> List[tuple]:
+        """
+        Returns, for each feature in reader.feature_names, the (column, nan_value, scale, mean, stdev, zero_nan)
+        tuple used by FeatureReader.read_contigs_into to convert and normalize the feature exactly like
+        _post_process_features followed by _normalize.
+        """
+        normalized = reader.float_feature_names + (
+            ['coverage'] if 'coverage' in self.means and 'coverage' in self.stdevs else [])
+        result = []
+        for feature_name in reader.feature_names:
+            column_name = 'ref_base_A' if feature_name == 'ref_base' else feature_name
+            column = expanded_feature_names.index(column_name) if column_name in expanded_feature_names else -1
+            if feature_name == 'ref_base' and column >= 0 and \
+                    expanded_feature_names[column:column + 4] != ['ref_base_A', 'ref_base_C', 'ref_base_G', 'ref_base_T']:
+                raise ValueError('ref_base_A/C/G/T must be consecutive in the expanded feature names')
+            mean, stdev, zero_nan = 0, 1, False
+            if column >= 0 and feature_name in normalized and feature_name in self.means \
+                    and feature_name in self.stdevs:
+                mean = self.means[feature_name]
+                # same as in _normalize: NaNs are only replaced if the feature is divided by the stdev
+                if self.stdevs[feature_name] > 1e-3:
+                    stdev, zero_nan = self.stdevs[feature_name], True
+            result.append((column, _NAN_VALUES.get(feature_name), _SCALED_FEATURES.get(feature_name, 1), mean, stdev,
+                           zero_nan))
+        return result
+
+    def load_chunks(self, toc_name: str = 'toc_chunked') -> List[ChunkInfo]:
+        """
+        Loads the chunk descriptors in the toc_name files that are next to each stats file. Chunks of contigs that
+        were excluded (e.g. because they are too short) are skipped.
+        """
+        metadata = self.metadata
+        contig_idx: Dict[Tuple[str, str, str], int] = {
+            (metadata.files[file_id], metadata.sources[file_id], name): i for i, (file_id, name) in
+            enumerate(zip(metadata.file_ids.tolist(), metadata.names))}
+        result = []
+        for fname in self.file_list:
+            toc_file = fname[:-len('stats')] + toc_name
+            contig_fname = fname[:-len('stats')] + 'features_binary'
+            sources = toc.read_sources(toc_file)
+            with open(toc_file) as f:
+                rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+                header = next(rd, None)
+                if header is None:
+                    continue
+                if 'SizeBytes' in header:
+                    logging.warning(f'{toc_file} uses the old chunk format (separate chunk binaries), skipping. '
+                                    f'Regenerate it with: python -m resmico.chunks')
+                    continue
+                for row in rd:
+                    # the fields in row are: name, start, stop, misassembly_count, breakpoints (relative to start) and,
+                    # for repacked data sets, the source id
+                    source = os.path.dirname(contig_fname) if sources is None else sources[int(row[5])]
+                    idx = contig_idx.get((contig_fname, source, row[0]))
+                    if idx is None:
+                        continue
+                    breakpoints = []
+                    if row[4] != '-':
+                        for break_point in row[4].split(','):
+                            start_stop = break_point.split('-')
+                            breakpoints.append((int(start_stop[0]), int(start_stop[1])))
+                    result.append(ChunkInfo(idx, int(row[1]), int(row[2]), int(row[3]), breakpoints))
+        logging.info(f'Loaded {len(result)} chunks from {toc_name} files')
+        return result
+
+    def read_chunks(self, chunk_infos: List[ChunkInfo], return_raw=False):
+        """
+        Reads the features for the given chunk_infos by reading each full contig record once and slicing it to the
+        chunk interval. Returns a list of len(chunk_infos) dictionaries of {'feature_name', feature_data}
+        """
+        contig_indices, positions = np.unique([chunk.contig_idx for chunk in chunk_infos], return_inverse=True)
+        contig_data = self.read_contigs([self.contigs[i] for i in contig_indices], return_raw)
+        result = []
+        for chunk, pos in zip(chunk_infos, positions):
+            result.append({k: v[chunk.start:chunk.stop] for k, v in contig_data[pos].items()})
+        return result
+
+    def _compute_mean_stdev(self, stats_list: List[Dict]):
+        """
+        Computes the global means and standard deviations for each feature by adding up the sums and sums of squares
+        in stats_list (the content of the stats file of each data set).
+        """
         mean_count = 0
         stddev_count = 0
         all_count = 0
@@ -313,10 +806,9 @@ class ContigReader:
         # the new bam2feat version was used or because they were added via add_stats.py
         # TODO: remove when all datasets have the new metrics
         has_new_metrics = False
-        with open(file_list[0]) as f:
-            stats = json.load(f)
-            if 'all_count' in stats and 'seq_window_perc_gc' in stats and 'seq_window_entropy' in stats and 'coverage' in stats:
-                has_new_metrics = True
+        stats = stats_list[0]
+        if 'all_count' in stats and 'seq_window_perc_gc' in stats and 'seq_window_entropy' in stats and 'coverage' in stats:
+            has_new_metrics = True
 
         has_new_metrics = False  # TODO: remove
         new_metrics = ['coverage', 'seq_window_entropy', 'seq_window_perc_gc'] if has_new_metrics else []
@@ -325,21 +817,19 @@ class ContigReader:
             self.means[feature_name] = 0
             self.stdevs[feature_name] = 0
 
-        for fname in file_list:
-            with open(fname) as f:
-                stats = json.load(f)
-                if 'all_count' in stats:
-                    all_count += stats['all_count']
-                mean_count += stats['mean_cnt']
-                stddev_count += stats['stdev_cnt']
-                for metric in metrics:
-                    for mtype in metric_types:
-                        feature_name = f'{mtype}_{metric}_Match'
-                        self.means[feature_name] += stats[metric]['sum'][mtype]
-                        self.stdevs[feature_name] += stats[metric]['sum2'][mtype]
-                for metric in new_metrics:
-                    self.means[metric] += stats[metric]['sum']
-                    self.stdevs[metric] += stats[metric]['sum2']
+        for stats in stats_list:
+            if 'all_count' in stats:
+                all_count += stats['all_count']
+            mean_count += stats['mean_cnt']
+            stddev_count += stats['stdev_cnt']
+            for metric in metrics:
+                for mtype in metric_types:
+                    feature_name = f'{mtype}_{metric}_Match'
+                    self.means[feature_name] += stats[metric]['sum'][mtype]
+                    self.stdevs[feature_name] += stats[metric]['sum2'][mtype]
+            for metric in new_metrics:
+                self.means[metric] += stats[metric]['sum']
+                self.stdevs[metric] += stats[metric]['sum2']
 
         for metric in metrics:
             for mtype in metric_types:
@@ -377,73 +867,148 @@ class ContigReader:
     def _load_contigs_metadata(self, file_list):
         contig_count = 0
         contig_count_misassembled = 0
-        total_len = 0
         breakpoint_hist = np.zeros(50, np.int32)
         breakpoint_relpos_hist = np.zeros(20, np.int32)
-        excluded_count = 0
-        contig_lengths = []
+        parts = []
         for fname in file_list:
-            toc_file = fname[:-len('stats')] + 'toc'
-            contig_fname = fname[:-len('stats')] + 'features_binary'
-            offset = 0
-            with open(toc_file) as f:
-#                 logging.info(f'FILE: {toc_file}')
-                rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
-                try: #file is not empty
-                    next(rd)  # skip CSV header: Assembler, Contig_name, MissassembleCount, ContigLen
-                except:
-                    continue
-                for row in rd:
-                    # the fields in row are: name, length (bases), misassembly_count, size_bytes, breakpoints, coverage
-                    contig_name = row[0]
-                    contig_len = int(row[1])
-                    size_bytes = int(row[3])
-                    breakpoints = []
-                    if len(row) >= 5:  # breakpoints is present; TODO: remove this once all datasets have it
-                        if row[4] != '-':
-                            all_breakpoints = row[4].split(',')
-                            for break_point in all_breakpoints:
-                                start_stop = break_point.split('-')
-                                breakpoints.append((int(start_stop[0]), int(start_stop[1])))
-                                mid = (int(start_stop[0]) + int(start_stop[1])) // 2
-                                # since contigs can be reversed, chose the breakpoint closer to the edge
-                                # (or simply duplicate the breakpoint in case of relative position histogram)
-                                breakpoint_relpos_hist[int(mid * 20 / contig_len)] += 1
-                                breakpoint_relpos_hist[int((contig_len - mid) *20 / contig_len)] += 1
-                                if contig_len - mid < mid:
-                                    mid = contig_len - mid
-                                breakpoint_hist[min(49, mid // 200)] += 1
-                    avg_coverage = float(row[5]) if len(row) >= 6 else 100
-
-                    contig_info = ContigInfo(contig_name, contig_fname, contig_len, offset, size_bytes, int(row[2]),
-                                             breakpoints, avg_coverage)
-                    if contig_info.length >= self.min_len and contig_info.avg_coverage >= self.min_avg_coverage:
-                        contig_lengths.append(contig_info.length)
-                        total_len += contig_info.length
-                        self.contigs.append(contig_info)
-                    else:
-                        excluded_count += 1
-                    offset += size_bytes
-                    if contig_info.misassembly:
-                        contig_count_misassembled += 1
-                    contig_count += 1
+            part = self._read_metadata(fname[:-len('stats')] + 'toc', fname[:-len('stats')] + 'features_binary')
+            if len(part) == 0:
+                continue
+
+            # since contigs can be reversed, chose the breakpoint closer to the edge (or simply duplicate the
+            # breakpoint in case of relative position histogram)
+            bp_lengths = np.repeat(part.lengths, np.diff(part.breakpoint_idx))
+            mids = part.breakpoints.sum(axis=1) // 2
+            np.add.at(breakpoint_relpos_hist, mids * 20 // bp_lengths, 1)
+            np.add.at(breakpoint_relpos_hist, (bp_lengths - mids) * 20 // bp_lengths, 1)
+            np.add.at(breakpoint_hist, np.minimum(49, np.minimum(mids, bp_lengths - mids) // 200), 1)
+
+            contig_count += len(part)
+            contig_count_misassembled += int(np.count_nonzero(part.misassembly))
+            keep = (part.lengths >= self.min_len) & (part.avg_coverage >= self.min_avg_coverage)
+            parts.append(part if keep.all() else part.subset(keep))
+        self.metadata = ContigMetadata.concatenate(parts)
+
+        total_len = int(self.metadata.lengths.sum())
         logging.info(
-            f'Found {contig_count} contigs, {contig_count_misassembled} misassembled, {excluded_count} excluded, '
-            f'{total_len} total length, {statistics.median(contig_lengths)} median length, '
+            f'Found {contig_count} contigs, {contig_count_misassembled} misassembled, '
+            f'{contig_count - len(self.metadata)} excluded, {total_len} total length, '
+            f'{np.median(self.metadata.lengths) if len(self.metadata) else 0} median length, '
             f'memory needed (assuming fraq-neg=1) {total_len * reader.bytes_per_base / 1e9:6.2f}GB')
         logging.info(f'Breakpoint location histogram: {",".join([str(x) for x in breakpoint_hist])}')
         logging.info(f'Breakpoint relative position histogram: {",".join([str(x) for x in breakpoint_relpos_hist])}')
 
+    @staticmethod
+    def _read_metadata(toc_file: str, contig_fname: str) -> ContigMetadata:
+        """ Reads the metadata of the contigs in contig_fname from the binary toc if available, or from toc_file """
+        binary_toc = ContigReader._open_binary_toc(toc_file)
+        if binary_toc is None:
+            return ContigReader._read_toc(toc_file, contig_fname)
+        records = binary_toc.records
+        sources = toc.read_sources(toc_file)
+        names = ContigNames([binary_toc.names], np.zeros(len(records), dtype=np.int32), records['name_offset'],
+                            records['name_len'])
+        return ContigMetadata(names,
+                              [contig_fname] * (1 if sources is None else len(sources)),
+                              np.zeros(len(records)) if sources is None else records['source'], records['length'],
+                              records['offset'], records['size_bytes'], records['misassembly'],
+                              records['avg_coverage'],
+                              np.concatenate([[0], np.cumsum(records['breakpoint_cnt'], dtype=np.int64)]),
+                              binary_toc.breakpoints, sources)
+
+    @staticmethod
+    def _read_toc(toc_file: str, contig_fname: str) -> ContigMetadata:
+        """ Reads the metadata of the contigs in a tab-separated toc file, as written by bam2feat (or repack.py) """
+        names, lengths, sizes, misassembly, avg_coverage, breakpoint_counts, breakpoints = [], [], [], [], [], [], []
+        source_ids = []
+        with open(toc_file) as f:
+            rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+            next(rd, None)  # skip CSV header
+            for row in rd:
+                # the fields in row are: name, length (bases), misassembly_count, size_bytes, breakpoints, coverage
+                # and, for repacked data sets, the source id
+                names.append(row[0])
+                lengths.append(int(row[1]))
+                misassembly.append(int(row[2]))
+                sizes.append(int(row[3]))
+                breakpoint_count = 0
+                if len(row) >= 5 and row[4] != '-':  # TODO: remove length check once all datasets have breakpoints
+                    for break_point in row[4].split(','):
+                        start_stop = break_point.split('-')
+                        breakpoints.append((int(start_stop[0]), int(start_stop[1])))
+                        breakpoint_count += 1
+                breakpoint_counts.append(breakpoint_count)
+                avg_coverage.append(float(row[5]) if len(row) >= 6 else 100)
+                source_ids.append(int(row[6]) if len(row) >= 7 else 0)
+        offsets = np.concatenate([[0], np.cumsum(sizes[:-1], dtype=np.int64)])
+        sources = toc.read_sources(toc_file)
+        return ContigMetadata(names, [contig_fname] * (1 if sources is None else len(sources)), source_ids, lengths,
+                              offsets, sizes, misassembly, avg_coverage,
+                              np.concatenate([[0], np.cumsum(breakpoint_counts, dtype=np.int64)]), breakpoints,
+                              sources)
+
+    @staticmethod
+    def _open_binary_toc(toc_file: str):
+        """
+        Returns the memory-mapped toc_binary next to toc_file, or None if it doesn't exist or is older than toc_file
+        (e.g. because toc was re-written by add_stats.py).
+        """
+        binary_toc_file = toc_file + '_binary'
+        if not os.path.exists(binary_toc_file):
+            return None
+        if os.path.exists(toc_file) and os.path.getmtime(binary_toc_file) < os.path.getmtime(toc_file):
+            logging.warning(f'{binary_toc_file} is older than {toc_file}, ignoring it. '
+                            f'Regenerate it with: python -m resmico.toc')
+            return None
+        return toc.BinaryToc(binary_toc_file)
+
+    def _open_name_index(self, toc_file: str):
+        """
+        Returns the name index (toc_index) next to toc_file, or None if it doesn't exist or if the binary toc it was
+        created from can't be used
+        """
+        if toc_file in self._name_indexes:
+            return self._name_indexes[toc_file]
+        index_file = toc_file + '_index'
+        name_index = None
+        if os.path.exists(index_file):
+            binary_toc = self._open_binary_toc(toc_file)
+            if binary_toc is None:
+                pass
+            elif os.path.getmtime(index_file) < os.path.getmtime(toc_file + '_binary'):
+                logging.warning(f'{index_file} is older than {toc_file}_binary, ignoring it. '
+                                f'Regenerate it with: python -m resmico.toc')
+            else:
+                name_index = toc.NameIndex(index_file, binary_toc)
+        self._name_indexes[toc_file] = name_index
+        return name_index
+
+    def _record(self, fname: str, offset: int, size_bytes: int) -> memoryview:
+        """ Returns a zero-copy view of the compressed contig record at offset in the (memory-mapped) file fname """
+        # the view is created under the lock, so that the mapping can't be closed in between
+        with self._mmaps_lock:
+            mm = self._mmaps.get(fname)
+            if mm is None:
+                while len(self._mmaps) >= open_files_limit():
+                    _, evicted = self._mmaps.popitem(last=False)
+                    try:
+                        evicted.close()
+                    except BufferError:
+                        pass  # a record is still being decoded: the mapping is closed when its last view is released
+                with open(fname, 'rb') as f:
+                    # memory-map the file, size 0 means whole file
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mmaps[fname] = mm
+            else:
+                self._mmaps.move_to_end(fname)
+            return memoryview(mm)[offset:offset + size_bytes]
+
     def read_file(self, fname):
         toc_file = fname[:-len('stats')] + 'toc'
         contig_fname = fname[:-len('stats')] + 'features_binary'
         offset = 0
         result = []
-        with open(toc_file) as f, open(contig_fname) as binary_file:
-            binary_file = open(contig_fname, 'rb')
-            # memory-map the file, size 0 means whole file
-            mm = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
-
+        with open(toc_file) as f:
             rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
             try:
                 next(rd)  # skip CSV header: Assembler, Contig_name, MissassembleCount, ContigLen
@@ -451,9 +1016,7 @@ class ContigReader:
                 return
             for row in rd:
                 size_bytes = int(row[3])
-                # the gzip reader reads ahead and messes up the current position, so we need to re-seek
-                mm.seek(offset)
-                features = _read_contig_data(mm, self.feature_names)
+                features = _read_contig_data(self._record(contig_fname, offset, size_bytes), self.feature_names)
                 self._normalize(features)
                 result.append(features)
                 offset += size_bytes
@@ -471,10 +1034,8 @@ class ContigReader:
         start = timer()
 
         # features is a map from feature name (e.g. 'coverage') to a numpy array containing the feature
-
-        input_file = open(contig_info.file, mode='rb')
-        input_file.seek(contig_info.offset)
-        features = _read_contig_data(input_file, self.feature_names)
+        record = self._record(contig_info.file, contig_info.offset, contig_info.size_bytes)
+        features = _read_contig_data(record, self.feature_names)
 
         self.read_time += (timer() - start)
         self._normalize(features)
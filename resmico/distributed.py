@@ -0,0 +1,113 @@
+"""
+Multi-worker training. A training runs on a single host with tf.distribute.MirroredStrategy, or on several hosts with
+tf.distribute.MultiWorkerMirroredStrategy when TF_CONFIG is set (or --worker-hosts, which sets it). In the latter case:
+  - every worker computes the same train/validation split and trains on its own shard of the training contigs; the
+    shards are disjoint and have (nearly) the same number of positive and negative contigs and the same total length
+  - the workers run the same number of steps per epoch (the minimum over the workers), as the gradients are reduced
+    after every step
+  - each worker predicts its shard of the validation contigs and the predictions are gathered, so that all the workers
+    compute the same scores and update the learning rate the same way
+  - worker 0 (the chief) writes the models; each worker writes its own training checkpoints
+"""
+import json
+import logging
+import os
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+
+def make_strategy(args) -> Tuple[tf.distribute.Strategy, int, int]:
+    """
+    Creates the distribution strategy of the training; returns the strategy, the number of workers and the index of
+    this worker. Must be called before any other Tensorflow operation.
+    """
+    if args.worker_hosts:
+        hosts = args.worker_hosts.split(',')
+        if not 0 <= args.worker_index < len(hosts):
+            raise ValueError(f'--worker-index must be between 0 and {len(hosts) - 1}, got {args.worker_index}')
+        os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': hosts},
+                                              'task': {'type': 'worker', 'index': args.worker_index}})
+    if 'TF_CONFIG' not in os.environ:
+        return tf.distribute.MirroredStrategy(), 1, 0
+    config = json.loads(os.environ['TF_CONFIG'])
+    if set(config['cluster']) != {'worker'}:
+        raise ValueError(f'TF_CONFIG must only define workers (worker 0 is the chief), got: {list(config["cluster"])}')
+    worker_count, worker_index = len(config['cluster']['worker']), config['task']['index']
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    logging.info(f'Multi-worker training: worker {worker_index} of {worker_count}, '
+                 f'{strategy.num_replicas_in_sync} replicas in total')
+    return strategy, worker_count, worker_index
+
+
+def shard_indices(indices: np.ndarray, lengths: np.ndarray, is_positive: np.ndarray, shard_count: int) \
+        -> List[np.ndarray]:
+    """
+    Splits #indices into #shard_count disjoint shards with the same number (+-1) of positive and of negative contigs
+    and approximately the same total length. The contigs of each class are sorted by decreasing length and dealt in
+    a snake order (0, 1, ..., n-1, n-1, ..., 1, 0, 0, 1, ...), so the result only depends on the arguments.
+    Arguments:
+        - indices: the positions of the contigs in the ContigReader
+        - lengths: the lengths (or the cost) of the contigs, in the same order as #indices
+        - is_positive: whether each contig is misassembled, in the same order as #indices
+        - shard_count: the number of shards
+    """
+    indices, lengths, is_positive = np.asarray(indices), np.asarray(lengths), np.asarray(is_positive, dtype=bool)
+    shards = [[] for _ in range(shard_count)]
+    for selected in [is_positive, ~is_positive]:
+        class_indices = indices[selected][np.argsort(-lengths[selected], kind='stable')]
+        position = np.arange(len(class_indices))
+        turn = position % shard_count
+        shard = np.where(position // shard_count % 2 == 0, turn, shard_count - 1 - turn)
+        for i in range(shard_count):
+            shards[i].append(class_indices[shard == i])
+    return [np.sort(np.concatenate(shard)) for shard in shards]
+
+
+def worker_dataset(dataset: tf.data.Dataset) -> tf.keras.utils.experimental.DatasetCreator:
+    """
+    Wraps the training batches of this worker for Keras' fit, which would otherwise shard them between the workers
+    (and split them between the replicas); each replica of the worker gets whole batches.
+    """
+    return tf.keras.utils.experimental.DatasetCreator(lambda input_context: dataset)
+
+
+def save_model(model: tf.keras.Model, path: str, is_chief: bool):
+    """
+    Saves #model to #path on the chief. Must be called by all the workers, as reading the synchronized variables
+    involves collectives; the other workers save to a temporary directory that is removed right away.
+    """
+    if is_chief:
+        model.save(path)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model.save(os.path.join(tmp_dir, os.path.basename(path)))
+
+
+def all_gather(strategy: tf.distribute.Strategy, values: np.ndarray, max_rows: int) -> np.ndarray:
+    """
+    Returns the concatenation (in worker order) of the #values of all the workers, which must have at most #max_rows
+    rows and must not contain NaN. Must be called by all the workers.
+    """
+    padded = np.full((max_rows,) + values.shape[1:], np.nan, dtype=np.float32)
+    padded[:len(values)] = values
+    gathered = strategy.gather(strategy.run(lambda: tf.constant(padded)[tf.newaxis]), axis=0).numpy()
+    # all the replicas of a worker contribute the same values
+    rows = gathered[::len(strategy.extended.worker_devices)].reshape((-1,) + values.shape[1:])
+    return rows[~np.isnan(rows.reshape(len(rows), -1)).any(axis=1)]
+
+
+def global_min(strategy: tf.distribute.Strategy, value: int) -> int:
+    """ Returns the minimum of #value over all the workers. Must be called by all the workers. """
+    return int(all_gather(strategy, np.array([value]), 1).min())
+
+
+def predict_local(model: tf.keras.Model, dataset: tf.data.Dataset) -> np.ndarray:
+    """
+    Predicts the batches of #dataset with #model on this worker only (Keras' predict would shard #dataset between
+    the workers)
+    """
+    predict_step = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+    return np.concatenate([predict_step(x).numpy() for x, _ in dataset])
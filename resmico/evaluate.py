@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 from pathlib import Path
@@ -12,6 +13,7 @@ from tensorflow.keras.models import Model
 from sklearn.metrics import recall_score, average_precision_score
 
 from resmico import contig_reader
+from resmico import histograms
 from resmico import models_fl as Models
 from resmico import utils
 
@@ -27,7 +29,8 @@ def predict_bin_data(model: tf.keras.Model, num_gpus: int, args):
     logging.info('Loading contig data...')
     reader = contig_reader.ContigReader(args.feature_files_path, args.features, args.n_procs,
                                         args.no_cython, args.stats_file, args.min_contig_len,
-                                        min_avg_coverage=args.min_avg_coverage)
+                                        min_avg_coverage=args.min_avg_coverage,
+                                        max_in_flight=max(1, args.prefetch_batches))
 
     if args.val_ind_f:
         eval_idx = list(pd.read_csv(args.val_ind_f)['val_ind'])
@@ -44,34 +47,31 @@ def predict_bin_data(model: tf.keras.Model, num_gpus: int, args):
     predict_data = Models.BinaryDatasetEval(reader, eval_idx, args.features, args.max_len, max(250, args.max_len - 500),
                                             int(args.gpu_eval_mem_gb * 1e9 * 0.8), cache_results=False,
                                             show_progress=True, convoluted_size=convoluted_size,
-                                            pad_to_max_len=is_fixed_length)
+                                            pad_to_max_len=is_fixed_length, tensor_cache_dir=args.tensor_cache_dir,
+                                            tensor_cache_dtype=args.tensor_cache_dtype, fused_read=args.fused_reader,
+                                            prefetch=args.prefetch_batches, feature_dtype=args.feature_dtype)
 
-    eval_data_y = np.array([0 if reader.contigs[idx].misassembly == 0 else 1 for idx in predict_data.indices])
+    eval_data_y = (reader.metadata.misassembly[np.asarray(predict_data.indices, dtype=np.int64)] != 0).astype(int)
 
-    # convert the slow Keras predict_data of type Sequence to a tf.data object
-    data_iter = lambda: (s for s in predict_data)
-
-    predict_data_tf = tf.data.Dataset.from_generator(
-        data_iter,
+    # build the batches in parallel in a tf.data pipeline; the predictions are grouped by contig in batch order,
+    # so the batches must stay in order
+    predict_data_tf = Models.make_tf_dataset(
+        predict_data,
         output_signature=(
             # first dimension is batch size, second is contig length, third is number of features
-            (tf.TensorSpec(shape=(None, None, len(predict_data.expanded_feature_names)), dtype=tf.float32),
+            (tf.TensorSpec(shape=(None, None, len(predict_data.expanded_feature_names)),
+                           dtype=tf.as_dtype(predict_data.dtype)),
              # first dimension is batch size, second is contig length (no third dimension,
              # as all features are masked the same way)
              tf.TensorSpec(shape=(None, None), dtype=tf.bool)),
             tf.TensorSpec(shape=(None), dtype=tf.bool)
-        ))
+        ), parallel_calls=max(1, args.n_procs), deterministic=True)
 
-    predict_data_tf = predict_data_tf.prefetch(4 * num_gpus)
     options = tf.data.Options()
     options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
     predict_data_tf = predict_data_tf.with_options(options)  # avoids Tensorflow ugly console barf
 
-    eval_data_flat_y = model.predict(x=predict_data_tf,
-                                     workers=args.n_procs,
-                                     use_multiprocessing=True,
-                                     max_queue_size=max(args.n_procs, 10),
-                                     verbose=0)
+    eval_data_flat_y = model.predict(x=predict_data_tf, verbose=0)
     eval_data_predicted_min = predict_data.group(eval_data_flat_y, min)
     eval_data_predicted_mean = predict_data.group(eval_data_flat_y, np.mean)
     eval_data_predicted_std = predict_data.group(eval_data_flat_y, np.std)
@@ -92,11 +92,7 @@ def predict_bin_data(model: tf.keras.Model, num_gpus: int, args):
     out_file = os.path.join(args.save_path, args.save_name + '.csv')    
     if args.embeddings:
         middle_output = Model(inputs=model.input, outputs=model.layers[args.emb_ind].output)
-        eval_data_emb = middle_output.predict(x=predict_data_tf,
-                                                 workers=args.n_procs,
-                                                 use_multiprocessing=True,
-                                                 max_queue_size=max(args.n_procs, 10),
-                                                 verbose=1)
+        eval_data_emb = middle_output.predict(x=predict_data_tf, verbose=1)
 
         eval_data_emb = predict_data.group_emb(eval_data_emb, np.mean)
         
@@ -104,7 +100,7 @@ def predict_bin_data(model: tf.keras.Model, num_gpus: int, args):
             outF.write('cont_name,length,label,embedding,score,min,mean,std,max\n')
             for idx in range(len(eval_idx)):
                 contig = reader.contigs[predict_data.indices[idx]]
-                outF.write(f'{os.path.join(os.path.dirname(contig.file), contig.name)},{contig.length},'
+                outF.write(f'{os.path.join(contig.source, contig.name)},{contig.length},'
                            f'{contig.misassembly},{eval_data_emb[idx]},{eval_data_predicted_score[idx]},'
                            f'{eval_data_predicted_min[idx]},{eval_data_predicted_mean[idx]},'
                            f'{eval_data_predicted_std[idx]},{eval_data_predicted_max[idx]}\n')        
@@ -113,7 +109,7 @@ def predict_bin_data(model: tf.keras.Model, num_gpus: int, args):
             outF.write('cont_name,length,label,score,min,mean,std,max\n')
             for idx in range(len(eval_idx)):
                 contig = reader.contigs[predict_data.indices[idx]]
-                outF.write(f'{os.path.join(os.path.dirname(contig.file), contig.name)},{contig.length},'
+                outF.write(f'{os.path.join(contig.source, contig.name)},{contig.length},'
                            f'{contig.misassembly},{eval_data_predicted_score[idx]},'
                            f'{eval_data_predicted_min[idx]},{eval_data_predicted_mean[idx]},'
                            f'{eval_data_predicted_std[idx]},{eval_data_predicted_max[idx]}\n')
@@ -121,33 +117,45 @@ def predict_bin_data(model: tf.keras.Model, num_gpus: int, args):
     logging.info(f'Predictions saved to: {out_file}')
 
 def verify_insert_size(args):
-    
-    logging.info('Loading contig data...')
-    reader = contig_reader.ContigReader(args.feature_files_path, ['mean_insert_size_Match'], args.n_procs, args.chunks,
-                                        args.no_cython, args.stats_file, args.min_len,
-                                        min_avg_coverage=args.min_avg_coverage)
-
-    contig_data = [reader.contigs[i] for i in range(0, len(reader), 10)] ##10% of the data
-    
-    features_data = reader.read_contigs(contig_data, return_raw=True)
-
-    insert_size_data = []
-    for cont in features_data:
-        insert_size_data.extend(cont['mean_insert_size_Match'])
+    """
+    Checks whether the distribution of the mean insert size lies within that of the training data. The quantiles are
+    computed from the insert size histograms in the stats files; for stats files written by older bam2feat versions
+    (without histograms), 10% of the contigs are read instead.
+    """
+    file_list, stats_list = contig_reader.find_stats_files(args.feature_files_path, args.feature_file_match)
+    if stats_list is None:
+        stats_list = []
+        for fname in file_list:
+            with open(fname) as f:
+                stats_list.append(json.load(f))
+    insert_size_histogram = histograms.merge(stats_list).get('mean_insert_size_Match')
+
+    if insert_size_histogram is not None:
+        logging.info(f'Using the insert size histograms of {len(file_list)} stats files')
+        quantile = insert_size_histogram.quantile
+    else:
+        logging.info('No insert size histograms in the stats files. Loading contig data...')
+        reader = contig_reader.ContigReader(args.feature_files_path, ['mean_insert_size_Match'], args.n_procs,
+                                            args.no_cython, args.stats_file, args.min_contig_len,
+                                            min_avg_coverage=args.min_avg_coverage,
+                                            feature_file_match=args.feature_file_match)
+        contig_data = [reader.contigs[i] for i in range(0, len(reader), 10)]  # 10% of the data
+        features_data = reader.read_contigs(contig_data, return_raw=True)
+        insert_size_data = np.concatenate([cont['mean_insert_size_Match'] for cont in features_data])
+        quantile = lambda q: np.nanquantile(insert_size_data, q)
 
-        
     low_train, high_train = 178, 372 #0.05 and 0.95 quantiles of the n9k-train dataset
-     
-    lowq = np.nanquantile(insert_size_data, 0.06)
-    hiq = np.nanquantile(insert_size_data, 0.94)
+
+    lowq = quantile(0.06)
+    hiq = quantile(0.94)
     if lowq >= low_train and  hiq <= high_train:
-        if np.nanquantile(insert_size_data, 0.05) >= low_train and np.nanquantile(insert_size_data, 0.95) <= high_train:
+        if quantile(0.05) >= low_train and quantile(0.95) <= high_train:
             logging.info('The insert size distribution lies inside the training one. It is safe to apply ResMiCo.')
         else:
             logging.info('The insert size distribution lies close to the border of the training one. ResMiCo can be applied.')
     else:
         logging.info('The insert size distribution is dissimilar to the training data. ResMiCo predictions are not reliable.')
-        
+
 def main(args):
     """
     Main interface
@@ -165,9 +173,12 @@ def main(args):
     strategy = tf.distribute.MirroredStrategy()
     logging.info(f'Number of devices: {strategy.num_replicas_in_sync}')
     logging.info(f'Loading model: {args.model}')
+    tf.keras.mixed_precision.set_global_policy(args.precision)
     with strategy.scope():
         model = load_model(args.model, custom_objects=custom_obj)
-    logging.info('Model loaded')
+        model = Models.apply_global_policy(model, custom_obj)
+    model.jit_compile = args.jit_compile
+    logging.info(f'Model loaded (precision: {args.precision}, XLA: {args.jit_compile})')
     # predict
     predict_bin_data(model, strategy.num_replicas_in_sync, args)
     # exit
@@ -0,0 +1,103 @@
+"""
+Mergeable fixed-bin histograms of the feature values, written by bam2feat (and add_stats.py) into the 'histograms'
+entry of the stats file of each feature directory. All histograms of a feature use the same range and bins (see
+HISTOGRAM_RANGES, which must match histogram_ranges in ResMiCo-SM/feature_extractor/stats_writer.cpp), so the
+histograms of many directories are merged exactly by adding up the counts. Quantiles (e.g. for robust normalization
+parameters or for checking that a data set resembles the training data) can then be computed from the stats files
+alone, without reading the features.
+"""
+import logging
+from typing import Dict, List
+
+import numpy as np
+
+# feature name -> (min, max, bin count); values outside [min, max) are counted in the first/last bin
+HISTOGRAM_RANGES = {
+    'min_insert_size_Match': (0, 2000, 400), 'mean_insert_size_Match': (0, 2000, 400),
+    'stdev_insert_size_Match': (0, 2000, 400), 'max_insert_size_Match': (0, 2000, 400),
+    'min_mapq_Match': (0, 256, 256), 'mean_mapq_Match': (0, 256, 256),
+    'stdev_mapq_Match': (0, 256, 256), 'max_mapq_Match': (0, 256, 256),
+    'min_al_score_Match': (-128, 128, 256), 'mean_al_score_Match': (-128, 128, 256),
+    'stdev_al_score_Match': (-128, 128, 256), 'max_al_score_Match': (-128, 128, 256),
+    'seq_window_perc_gc': (0, 1, 100), 'seq_window_entropy': (0, 2, 100),
+    'coverage': (0, 1024, 512),
+}
+
+
+class Histogram:
+    def __init__(self, min_value: float, max_value: float, counts: np.ndarray):
+        self.min = min_value
+        self.max = max_value
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    @staticmethod
+    def empty(feature_name: str) -> 'Histogram':
+        min_value, max_value, bins = HISTOGRAM_RANGES[feature_name]
+        return Histogram(min_value, max_value, np.zeros(bins, dtype=np.int64))
+
+    @staticmethod
+    def from_json(data: Dict) -> 'Histogram':
+        return Histogram(data['min'], data['max'], data['counts'])
+
+    def to_json(self) -> Dict:
+        return {'min': self.min, 'max': self.max, 'counts': self.counts.tolist()}
+
+    def __len__(self):
+        """ The number of values in the histogram """
+        return int(self.counts.sum())
+
+    def add(self, values: np.ndarray):
+        """ Adds the non-NaN values to the histogram, in the same way as bam2feat """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        bins = np.floor((values - self.min) / (self.max - self.min) * len(self.counts)).astype(np.int64)
+        self.counts += np.bincount(np.clip(bins, 0, len(self.counts) - 1), minlength=len(self.counts))
+
+    def merge(self, other: 'Histogram'):
+        """ Adds the counts of other (which must have the same range and bins) to self """
+        if (self.min, self.max, len(self.counts)) != (other.min, other.max, len(other.counts)):
+            raise ValueError(f'Cannot merge histograms over [{self.min}, {self.max}) with {len(self.counts)} bins and '
+                             f'over [{other.min}, {other.max}) with {len(other.counts)} bins')
+        self.counts += other.counts
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the q-quantile of the values in the histogram, assuming the values are spread uniformly within each
+        bin (so the result is accurate to a bin width), or NaN for an empty histogram.
+        """
+        total = len(self)
+        if total == 0:
+            return np.nan
+        cumulative = np.cumsum(self.counts)
+        target = q * total
+        idx = min(int(np.searchsorted(cumulative, target, side='left')), len(self.counts) - 1)
+        previous = cumulative[idx - 1] if idx > 0 else 0
+        fraction = (target - previous) / self.counts[idx] if self.counts[idx] > 0 else 0
+        bin_width = (self.max - self.min) / len(self.counts)
+        return float(self.min + (idx + fraction) * bin_width)
+
+    def median_iqr(self):
+        """ Returns the median and the inter-quartile range, robust alternatives to the mean and stdev """
+        return self.quantile(0.5), self.quantile(0.75) - self.quantile(0.25)
+
+
+def merge(stats_list: List[Dict]) -> Dict[str, Histogram]:
+    """
+    Merges the histograms in stats_list (the content of the stats file of each data set). Features that don't have a
+    histogram in all the stats files (e.g. because some were created by an older bam2feat) are left out.
+    """
+    result: Dict[str, Histogram] = {}
+    for i, stats in enumerate(stats_list):
+        histograms = stats.get('histograms', {})
+        for feature_name in list(result.keys()) if i > 0 else histograms.keys():
+            if feature_name not in histograms:
+                del result[feature_name]
+                continue
+            histogram = Histogram.from_json(histograms[feature_name])
+            if i == 0:
+                result[feature_name] = histogram
+            else:
+                result[feature_name].merge(histogram)
+    if stats_list and not result:
+        logging.debug('No feature histograms found in the stats files')
+    return result
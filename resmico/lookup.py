@@ -0,0 +1,74 @@
+"""
+Prints the features of individual contigs, looked up by name, e.g. to inspect why a contig was flagged:
+
+    python -m resmico.lookup --feature-files-path <dir> contig_1 contig_2
+
+The name index (toc_index) of each feature directory is used, so only the requested contigs are read; create the
+indexes with `python -m resmico.toc`. Directories without an index are scanned (slow for large data sets).
+"""
+import argparse
+import logging
+import os
+import sys
+from typing import List
+
+import numpy as np
+
+from resmico import contig_reader
+from resmico import reader
+
+
+def lookup(ctg_reader: contig_reader.ContigReader, names: List[str], return_raw: bool = False):
+    """
+    Returns a list of (ContigInfo, features) for the contigs with the given names, where features is a dictionary of
+    {'feature_name': feature_data}. The features are normalized unless return_raw is set.
+    """
+    contig_infos = ctg_reader.find_contigs(names)
+    return list(zip(contig_infos, ctg_reader.read_contigs(contig_infos, return_raw)))
+
+
+def write_tsv(contigs, out):
+    """ Writes one line per contig position, with the contig name, feature file, position and the features """
+    feature_names = list(contigs[0][1].keys()) if contigs else []
+    out.write('\t'.join(['contig', 'feature_file', 'position'] + feature_names) + '\n')
+    for contig_info, features in contigs:
+        columns = np.column_stack([features[f] for f in feature_names])
+        for pos, row in enumerate(columns):
+            out.write(f'{contig_info.name}\t{contig_info.file}\t{pos}\t' + '\t'.join(f'{v:g}' for v in row) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the features of contigs looked up by name')
+    parser.add_argument('--feature-files-path', default='.', type=str,
+                        help='Path to the feature files produced by ResMiCo-SM, a file listing the stats files or a '
+                             'dataset catalog (default: %(default)s)')
+    parser.add_argument('--stats-file', default='', type=str,
+                        help='File with the feature means/stdevs used for normalization; if empty, they are computed '
+                             'from the stats files (default: %(default)s)')
+    parser.add_argument('--features', nargs='+', default=reader.feature_names,
+                        help='Features to print; pass the contig names before this option (default: all features)')
+    parser.add_argument('--raw', action='store_true',
+                        help='If set, the features are printed as stored, without normalization')
+    parser.add_argument('--output', default='-', type=str,
+                        help='Output file, - for stdout (default: %(default)s)')
+    parser.add_argument('--log-level', default='WARNING',
+                        choices=['CRITICAL', 'FATAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help='Logging level (default: %(default)s)')
+    parser.add_argument('names', nargs='+', help='Names of the contigs to look up')
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging._nameToLevel[args.log_level.upper()])
+
+    ctg_reader = contig_reader.ContigReader(args.feature_files_path, args.features, 1, stats_file=args.stats_file,
+                                            load_metadata=False)
+    contigs = lookup(ctg_reader, args.names, args.raw)
+    if args.output == '-':
+        write_tsv(contigs, sys.stdout)
+    else:
+        with open(args.output, 'w') as out:
+            write_tsv(contigs, out)
+        logging.info(f'Features of {len(contigs)} contigs written to {os.path.abspath(args.output)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 import logging
 import math
+from concurrent.futures import Future
 import time
-import random
 from timeit import default_timer as timer
 
 import numpy as np
@@ -16,13 +16,22 @@ from tensorflow.keras.layers import Bidirectional, LSTM, GRU
 from tensorflow.python.ops import array_ops
 
 from toolz import itertoolz
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from resmico.contig_reader import ContigReader
 from resmico.contig_reader import ContigInfo
-from resmico import reader
+from resmico.contig_cache import ContigCache
+from resmico.tensor_cache import TensorCache
 from resmico import utils
 
+# the types in which the datasets store and return the feature tensors (see --feature-dtype); the model converts them
+# to float32 at its input
+FEATURE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': tf.bfloat16.as_numpy_dtype}
+
+# the layers that always compute in float32 when a mixed precision policy is used (see --precision): the (masked)
+# pooling layers, which reduce over thousands of positions, and the sigmoid output layer
+FLOAT32_LAYERS = ['GlobalAveragePooling1D', 'AveragePooling1D', 'GlobalMaskedMaxPooling1D', 'ArgMaxSumPooling']
+
 
 @tf.keras.utils.register_keras_serializable()
 class GlobalMaskedMaxPooling1D(GlobalMaxPooling1D):
@@ -76,17 +85,41 @@ class ArgMaxSumPooling(Layer):
         return None
 
 
-def construct_convolution_lambda(model: Model):
+class ConvolutionSize:
     """
-    Builds and returns a lambda that computes the size of the padded/unpadded convolution layer output 
-    for the given model. The function traverses the model layer by layer, and updates the lambda function 
-    whenever it sees a 1D convolution.
-    The returned lambda has two parameters:
-      - the contig length (int). The lambda will return the convolved contig length
+    Computes the size of the padded/unpadded output of a stack of 1D convolutions for an input of a given size. Unlike
+    a lambda, it can be pickled, e.g. to send a dataset to the batch worker processes (see batch_workers).
+    Instances are called with two parameters:
+      - the contig length (int); the convolved contig length is returned
       - pad (bool): If true, positions that needed padding in order to be convolved are not masked out.
         If false, any position that needed padding in order to be computed will be masked out.
     """
-    result = lambda contig_len, pad: contig_len
+
+    def __init__(self, layers: List[tuple] = (), constant: Optional[int] = None):
+        """
+        Arguments:
+            - layers: the (kernel_size, stride, dilation_rate, output_reduction) of each convolution, in order
+            - constant: if set, the output size regardless of the input size
+        """
+        self.layers = list(layers)
+        self.constant = constant
+
+    def __call__(self, contig_len, pad: bool):
+        if self.constant is not None:
+            return self.constant
+        for kernel_size, stride, dilation_rate, output_reduction in self.layers:
+            contig_len = math.ceil((contig_len - output_reduction) / stride) if pad \
+                else 1 + (contig_len - kernel_size * dilation_rate) // stride
+        return contig_len
+
+
+def construct_convolution_lambda(model: Model) -> ConvolutionSize:
+    """
+    Builds and returns a function that computes the size of the padded/unpadded convolution layer output
+    for the given model (see ConvolutionSize). The function traverses the model layer by layer, and adds a step to the
+    function whenever it sees a 1D convolution.
+    """
+    layers = []
     for layer in model.layers:
         if isinstance(layer, Conv1D):
             if layer.kernel_size[0] == 1:  # the strided convolution in the residual layer, doesn't affect output size
@@ -97,12 +130,26 @@ def construct_convolution_lambda(model: Model):
             stride = layer.strides[0]
             dilation_rate = layer.dilation_rate[0]
             output_reduction = (kernel_size - 1) * dilation_rate if layer.padding == 'valid' else 0
-            result_n = \
-                lambda x, pad, f=result, stride=stride, kernel_size=kernel_size, \
-                        dilation_rate=dilation_rate, output_reduction=output_reduction: \
-                    math.ceil((f(x, pad) - output_reduction) / stride) if pad \
-                        else 1 + (f(x, pad) - kernel_size * dilation_rate) // stride
-            result = result_n
+            layers.append((kernel_size, stride, dilation_rate, output_reduction))
+    return ConvolutionSize(layers)
+
+
+def apply_global_policy(model: Model, custom_objects: Dict = None) -> Model:
+    """
+    Returns #model rebuilt with the global mixed precision policy (see tf.keras.mixed_precision.set_global_policy).
+    Loaded models keep the policy they were saved with, so their configuration is changed to use the global policy
+    for all layers except the inputs, the outputs and #FLOAT32_LAYERS, and the weights are copied over.
+    """
+    policy = tf.keras.mixed_precision.global_policy().name
+    if policy == 'float32':
+        return model
+    config = model.get_config()
+    output_layers = {layer[0] for layer in config['output_layers']}
+    for layer in config['layers']:
+        if layer['class_name'] not in FLOAT32_LAYERS + ['InputLayer'] and layer['name'] not in output_layers:
+            layer['config']['dtype'] = policy
+    result = Model.from_config(config, custom_objects=custom_objects)
+    result.set_weights(model.get_weights())
     return result
 
 
@@ -126,6 +173,8 @@ class Resmico(object):
         self.num_blocks = config.num_blocks
         self.ker_size = config.ker_size
         self.seed = config.seed
+        # the layers are created with the global policy set by the caller (see --precision)
+        self.precision = tf.keras.mixed_precision.global_policy().name
         mask = None
 
         tf.random.set_seed(self.seed)
@@ -167,14 +216,14 @@ class Resmico(object):
             x = Bidirectional(LSTM(8, return_sequences=True), merge_mode="concat")(inlayer, mask=mask)
             x = Bidirectional(LSTM(8, return_sequences=True, dropout=self.dropout), merge_mode="ave")(x)
             x = Bidirectional(LSTM(16, return_sequences=False, dropout=self.dropout), merge_mode="concat")(x)
-            self.convoluted_size = lambda x, pad: x
+            self.convoluted_size = ConvolutionSize()
             
         elif self.net_type == 'gru':
             mask = Input(shape=(None,), name='mask', dtype='bool')
             x = Bidirectional(GRU(8, return_sequences=True), merge_mode="ave")(inlayer, mask=mask)
             x = Bidirectional(GRU(16, return_sequences=False, dropout=self.dropout), merge_mode="concat")(x)
             
-            self.convoluted_size = lambda x, pad: x
+            self.convoluted_size = ConvolutionSize()
             
         elif self.net_type == 'cnn_lstm':
             x = Conv1D(self.filters, kernel_size=(10),
@@ -214,7 +263,7 @@ class Resmico(object):
             mask_size = self.convoluted_size(self.max_len, True) if self.fixed_length else None
             mask = Input(shape=(mask_size,), name='mask', dtype='bool')
 
-            x = GlobalAveragePooling1D()(x, mask=mask)
+            x = GlobalAveragePooling1D(dtype='float32')(x, mask=mask)
         
         elif self.net_type == 'transformer':
         
@@ -227,7 +276,7 @@ class Resmico(object):
             
             mask_size = self.convoluted_size(self.max_len, True) if self.fixed_length else None
             mask = Input(shape=(mask_size,), name='mask', dtype='bool')
-            x = GlobalAveragePooling1D()(x, mask=mask)
+            x = GlobalAveragePooling1D(dtype='float32')(x, mask=mask)
             
         elif self.net_type in ['cnn_resnet', 'cnn_resnet_argmax', 'cnn_resnet_avg', 'cnn_resnet_brnn']:
             x = BatchNormalization()(inlayer)
@@ -254,18 +303,18 @@ class Resmico(object):
             mask = Input(shape=(mask_size,), name='mask', dtype='bool')
 
             if self.net_type == 'cnn_resnet':
-                avgP = GlobalAveragePooling1D()(x, mask=mask)
-                maxP = GlobalMaskedMaxPooling1D()(x, mask=mask)
+                avgP = GlobalAveragePooling1D(dtype='float32')(x, mask=mask)
+                maxP = GlobalMaskedMaxPooling1D(dtype='float32')(x, mask=mask)
                 x = concatenate([maxP, avgP])
             elif self.net_type == 'cnn_resnet_argmax':
-                x = ArgMaxSumPooling()(x, mask=(mask))  # shape (batch_size, steps)
+                x = ArgMaxSumPooling(dtype='float32')(x, mask=(mask))  # shape (batch_size, steps)
                 x = utils.residual_block(x, downsample=False, filters=16, kernel_size=self.ker_size)
                 x = GlobalMaxPooling1D()(x)
             elif self.net_type == 'cnn_resnet_brnn':
                 x = Bidirectional(LSTM(16, return_sequences=False), 
                                   merge_mode="concat")(x, mask=mask)
             else:  # cnn_resnet_avg
-                x = GlobalAveragePooling1D()(x, mask=mask)
+                x = GlobalAveragePooling1D(dtype='float32')(x, mask=mask)
 
         elif self.net_type == 'fixlen_cnn_resnet':
             x = BatchNormalization()(inlayer)
@@ -280,7 +329,7 @@ class Resmico(object):
                                              kernel_size=self.ker_size)
                 num_filters *= 2
 
-            avgP = AveragePooling1D(pool_size=100, padding='valid')(x)
+            avgP = AveragePooling1D(pool_size=100, padding='valid', dtype='float32')(x)
             maxP = MaxPooling1D(pool_size=100, padding='valid')(x)
             x = concatenate([maxP, avgP])
             x = Flatten()(x)
@@ -299,7 +348,7 @@ class Resmico(object):
                 num_filters *= 2
                 # this is needed only to avoid errors, mask is not used later
             tmp_model = Model(inputs=inlayer, outputs=x)  # dummy model used only in next line
-            self.convoluted_size = lambda x, pad: 1
+            self.convoluted_size = ConvolutionSize(constant=1)
             
             mask_size = self.convoluted_size(self.max_len, True) if self.fixed_length else None
             mask = Input(shape=(mask_size,), name='mask', dtype='bool')
@@ -321,26 +370,29 @@ class Resmico(object):
                 num_filters *= 2
                 # this is needed only to avoid errors, mask is not used later
             tmp_model = Model(inputs=inlayer, outputs=x)  # dummy model used only in next line
-            self.convoluted_size = lambda x, pad: 1
+            self.convoluted_size = ConvolutionSize(constant=1)
             mask_size = self.convoluted_size(self.max_len, True) if self.fixed_length else None
             mask = Input(shape=(mask_size,), name='mask', dtype='bool')
             ###
-            x = AveragePooling1D(pool_size=1205, padding='valid')(x)
+            x = AveragePooling1D(pool_size=1205, padding='valid', dtype='float32')(x)
             x = Flatten()(x)
 
         for _ in range(self.n_fc):
             x = Dense(self.n_hid, activation='relu')(x)
             x = Dropout(rate=self.dropout)(x)
 
-        x = Dense(1, activation='sigmoid')(x)
+        x = Dense(1, activation='sigmoid', dtype='float32')(x)
 
         # need to clip the gradient for cnn_resnet_avg, otherwise we get NaNs in the weights
         optimizer = tf.keras.optimizers.Adam(lr=self.lr_init, clipnorm=1.0, clipvalue=0.5)
+        if self.precision == 'mixed_float16':  # scale the loss, so that small float16 gradients don't underflow
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
         inputs = [inlayer, mask]
         self.net = Model(inputs=inputs, outputs=x)
         self.net.compile(loss='binary_crossentropy',
                          optimizer=optimizer,
-                         metrics=[utils.class_recall_0, utils.class_recall_1])
+                         metrics=[utils.class_recall_0, utils.class_recall_1],
+                         jit_compile=config.jit_compile)
 
     @staticmethod
     def _get_blocks(num_blocks: int):
@@ -435,11 +487,22 @@ class BinaryDataset(tf.keras.utils.Sequence):
     (as opposed to the old CSV files)
     """
 
-    def __init__(self, reader: ContigReader, feature_names: List[str], convoluted_size, pad_to_max_len: bool):
+    def __init__(self, reader: ContigReader, feature_names: List[str], convoluted_size, pad_to_max_len: bool,
+                 tensor_cache_dir: str = '', tensor_cache_dtype: str = 'float32', fused_read: bool = False,
+                 prefetch: int = 0, feature_dtype: str = 'float32'):
         """
        Arguments:
            - reader: ContigReader instance with all the contig metadata
            - feature_names: the names of the features to read and use for training
+           - tensor_cache_dir: if not empty, the normalized features are cached on disk in this directory and reused
+             across epochs and runs (see tensor_cache.py)
+           - tensor_cache_dtype: the type used for storing the cached features (float32 or float16)
+           - fused_read: if True (and the tensor cache is disabled), the features are decoded, normalized and
+             written directly into the batch tensor by ContigReader.read_into
+           - prefetch: number of batches that are read in the background (see ContigReader.submit) ahead of the
+             requested batch, assuming batches are requested in order
+           - feature_dtype: the type of the returned feature tensors, one of #FEATURE_DTYPES (also used for the
+             in-memory caches)
         """
         self.reader = reader
         self.feature_names = feature_names
@@ -449,16 +512,105 @@ class BinaryDataset(tf.keras.utils.Sequence):
         if 'ref_base' in self.expanded_feature_names:
             pos = self.expanded_feature_names.index('ref_base')
             self.expanded_feature_names[pos: pos + 1] = ['ref_base_A', 'ref_base_C', 'ref_base_G', 'ref_base_T']
+        self.tensor_cache = None
+        if tensor_cache_dir:
+            self.tensor_cache = TensorCache(tensor_cache_dir, reader, self.expanded_feature_names, tensor_cache_dtype)
+        self.fused_read = fused_read and self.tensor_cache is None
+        self.prefetch = prefetch
+        self.dtype = np.dtype(FEATURE_DTYPES[feature_dtype])
+        # in-memory cache of the stacked features of whole contigs (see contig_cache.py), set by subclasses
+        self.contig_cache: Optional[ContigCache] = None
+        # maps the index of a batch whose data is being read in the background to the result of _prepare()
+        self._pending: Dict[int, tuple] = {}
+
+    def read_stacked_features(self, indices, starts: List[int] = None, stops: List[int] = None) -> List[np.ndarray]:
+        """
+        Returns the normalized features for the contigs at the given indices in #reader, each as a matrix of shape
+        (contig_len, len(expanded_feature_names)), or only its rows starts[i]:stops[i] if #starts and #stops are given.
+        The matrices come from the contig cache and the tensor cache if enabled, which hold whole contigs; otherwise
+        only the requested rows are stacked.
+        """
+        if self.contig_cache is None and self.tensor_cache is None:
+            return self._read_stacked_features(indices, starts, stops)
+        if self.contig_cache is None:
+            result = self._read_stacked_features(indices)
+        else:
+            result = [self.contig_cache.get(i) for i in indices]
+            missing = [pos for pos, features in enumerate(result) if features is None]
+            for pos, features in zip(missing, self._read_stacked_features([indices[pos] for pos in missing])):
+                self.contig_cache.put(indices[pos], features)
+                result[pos] = features
+        if starts is None:
+            return result
+        return [features[start:stop] for features, start, stop in zip(result, starts, stops)]
+
+    def _read_stacked_features(self, indices, starts: List[int] = None, stops: List[int] = None) \
+            -> List[np.ndarray]:
+        if self.tensor_cache is not None:
+            return self.tensor_cache.read(indices)
+        contig_data: List[ContigInfo] = [self.reader.contigs[i] for i in indices]
+        features_data = self.reader.read_contigs(contig_data)
+        if starts is None:
+            starts, stops = [0] * len(contig_data), [contig.length for contig in contig_data]
+        result = []
+        for features, start, stop in zip(features_data, starts, stops):
+            # each feature becomes a column, converted while copied
+            stacked = np.empty((stop - start, len(self.expanded_feature_names)), dtype=self.dtype)
+            for j, feature_name in enumerate(self.expanded_feature_names):
+                stacked[:, j] = features[feature_name][start:stop]
+            result.append(stacked)
+        return result
+
+    def _start(self, fn, *args, background: bool = True) -> Future:
+        """ Runs fn(*args) in the background if prefetching is enabled and background is set, else synchronously """
+        if self.prefetch > 0 and background:
+            return self.reader.submit(fn, *args)
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def _take(self, index: int):
+        """
+        Returns the prepared (see _prepare) batch #index and starts reading the next #prefetch batches. The batches
+        are prepared in order, so random choices made in _prepare are the same as without prefetching.
+        """
+        prepared = self._pending.pop(index, None)
+        if prepared is None:
+            prepared = self._prepare(index)
+        for ahead in range(index + 1, min(len(self), index + 1 + self.prefetch)):
+            if ahead not in self._pending and not self._is_cached(ahead):
+                self._pending[ahead] = self._prepare(ahead)
+        return prepared
+
+    def _is_cached(self, index: int) -> bool:
+        return False
+
+    def _prepare(self, index: int):
+        raise NotImplementedError()
+
+    def get_batch(self, index: int, repeat: int = 0, with_lengths: bool = False):
+        """
+        Returns the mini-batch #index like __getitem__, but without reading ahead and without depending on the order
+        in which batches are requested, so it can be called concurrently from multiple threads (see make_tf_dataset).
+        Random choices are made with a generator seeded by the batch index, the epoch and #repeat (the number of times
+        the batches were iterated over in the current epoch), so the result doesn't depend on thread scheduling.
+        If #with_lengths is set, the number of contig positions in each row of x (0 for the empty rows of incomplete
+        batches) is returned as a fourth element, e.g. for make_augmentation.
+        """
+        raise NotImplementedError()
 
     def get_bytes_per_base(self):
-        return sum(
-            [np.dtype(reader.feature_np_types[reader.feature_names.index(f)]).itemsize for f in self.feature_names])
+        return len(self.expanded_feature_names) * self.dtype.itemsize
 
 
 class BinaryDatasetTrain(BinaryDataset):
     def __init__(self, reader: ContigReader, indices: List[int], batch_size: int, feature_names: List[str],
                  max_len: int, num_translations: int, max_translation_bases: int, fraq_neg: float, do_cache: bool,
-                 show_progress: bool, convoluted_size, pad_to_max_len: bool, weight_factor: int):
+                 show_progress: bool, convoluted_size, pad_to_max_len: bool, weight_factor: int,
+                 tensor_cache_dir: str = '', tensor_cache_dtype: str = 'float32', fused_read: bool = False,
+                 prefetch: int = 0, feature_dtype: str = 'float32', length_buckets: int = 0,
+                 cache_bytes: int = int(4e9), cache_spill_dir: str = '', cache_spill_bytes: int = 0,
+                 pad_to_buckets: bool = False):
 
         """
         Arguments:
@@ -470,15 +622,30 @@ class BinaryDatasetTrain(BinaryDataset):
             - num_translations: how many variations to select around the breaking point for positive samples
             - max_translation_bases: maximum number of bases to translate left or right
             - fraq_neg: fraction of samples to keep in the overrepresented class (contigs with no misassembly)
-            - do_cahe: if True, the generator will cache the features in memory the first time they are
-              read from disk
+            - do_cache: if True, the features of each contig are cached in memory (see ContigCache) the first time
+              they are read from disk; the fused reader is not used in this case
             - show_progress - if true, a progress bar will show the evaluation progress
             - convoluted_size - function that computes the size of the convoluted output for an input of size n
             - pad_to_max_len - if true, all batches will be padded to max-len, even if the longest contig in the batch
               is shorter (this guarantees fixed-length input)
             - weight_factor - if different than 0, contigs are weighed by min(1, contig_len/factor) during training
+            - tensor_cache_dir - if not empty, normalized features are cached on disk in this directory
+            - tensor_cache_dtype - storage type of the cached features (float32 or float16)
+            - fused_read - if true, features are read directly into the batch tensor (see ContigReader.read_into)
+            - prefetch - number of batches read in the background ahead of the current one
+            - feature_dtype - type of the returned (and cached) feature tensors: float32, float16 or bfloat16
+            - length_buckets - if greater than 0, the contigs are split into this many length buckets (with boundaries
+              at the length quantiles) and each batch is filled from a single bucket, so that the contigs in a batch
+              have similar lengths and few positions are padded
+            - cache_bytes - the maximum size of the contig features cached in memory
+            - cache_spill_dir - if not empty, contigs evicted from the memory cache are kept in a memory-mapped file
+              (of size cache_spill_bytes) in this directory, preferably on a local SSD
+            - pad_to_buckets - if true (and length_buckets > 0), batches are padded to the boundary of the bucket of
+              their longest contig rather than to the longest contig, so there are at most length_buckets distinct
+              batch lengths (e.g. for XLA, which compiles each of them separately)
         """
-        BinaryDataset.__init__(self, reader, feature_names, convoluted_size, pad_to_max_len)
+        BinaryDataset.__init__(self, reader, feature_names, convoluted_size, pad_to_max_len, tensor_cache_dir,
+                               tensor_cache_dtype, fused_read and not do_cache, prefetch, feature_dtype)
         logging.info(
             f'Creating training data generator. Batch size: {batch_size}, Max length: {max_len} Frac neg: {fraq_neg}, '
             f'Features: {len(self.expanded_feature_names)}, Contigs: {len(indices)},  Caching: {do_cache}')
@@ -491,34 +658,35 @@ class BinaryDatasetTrain(BinaryDataset):
         self.do_cache = do_cache
         self.show_progress = show_progress
         self.weight_factor = weight_factor
+        # the base seed of the per-batch random generators used by get_batch and the number of completed epochs
+        self.seed = np.random.randint(2 ** 31)
+        self.epoch = -1
 
         if self.do_cache:
-            # the cache maps a batch index to feature_name:feature_data pairs
-            self.cache: Dict[int, Dict[str, np.array]] = {}
-        self.negative_idx = [i for i in indices if reader.contigs[i].misassembly == 0]
-        self.positive_idx = [i for i in indices if reader.contigs[i].misassembly != 0]
+            self.contig_cache = ContigCache(cache_bytes, cache_spill_dir, cache_spill_bytes)
+        indices = np.asarray(indices, dtype=np.int64)
+        is_negative = reader.metadata.misassembly[indices] == 0
+        self.negative_idx = indices[is_negative].tolist()
+        self.positive_idx = indices[~is_negative].tolist()
+        # the (increasing) upper length boundaries of the buckets; the last one is the longest (clipped) length
+        self.length_boundaries = None
+        self.pad_to_buckets = pad_to_buckets
+        if length_buckets > 0 and len(indices) > 0:
+            clipped_lengths = np.minimum(reader.metadata.lengths[indices], max_len)
+            quantiles = np.quantile(clipped_lengths, np.arange(1, length_buckets + 1) / length_buckets)
+            self.length_boundaries = np.unique(np.ceil(quantiles).astype(np.int64))
+            logging.info(f'Length bucket boundaries: {self.length_boundaries.tolist()}')
 
         self.on_epoch_end()  # select negative samples and shuffle indices
 
-        total_length = sum([self.reader.contigs[i].length for i in self.indices])
+        total_length = int(self.reader.metadata.lengths[np.asarray(self.indices, dtype=np.int64)].sum())
         mem_gb = total_length * self.get_bytes_per_base() / 1e9
-        logging.info(f'Batch count: {int(np.ceil(len(self.indices) / self.batch_size))}')
+        logging.info(f'Batch count: {int(np.ceil(len(self.indices) / self.batch_size))}. '
+                     f'Padded positions: {100 * self.padding_fraction():.1f}%')
         logging.info(
             f'Pos samples: {len(self.positive_idx)}. Neg samples: {len(self.negative_idx) * self.fraq_neg:.0f}. '
             f'Total length: {total_length}. Bytes per base: {self.get_bytes_per_base()}. Req memory: {mem_gb:.2f}GB')
 
-        # determine the position of the num_query_A/C/G/T fields, so that we can apply inversion
-        self.pos_A = self.pos_C = self.pos_G = self.pos_T = -1
-        self.pos_ref = -1
-        if 'ref_base_A' in self.expanded_feature_names:
-            self.pos_ref = self.expanded_feature_names.index('ref_base_A')
-        if 'num_query_A' in self.expanded_feature_names and 'num_query_T' in self.expanded_feature_names:
-            self.pos_A = self.expanded_feature_names.index('num_query_A')
-            self.pos_T = self.expanded_feature_names.index('num_query_T')
-        if 'num_query_G' in self.expanded_feature_names and 'num_query_C' in self.expanded_feature_names:
-            self.pos_G = self.expanded_feature_names.index('num_query_G')
-            self.pos_C = self.expanded_feature_names.index('num_query_C')
-
         # used for testing; contains the interval selected from each contig longer than #self.max_len
         self.intervals = []
         # used for testing; tests set this to false in order to make the interval predictable for contigs
@@ -531,10 +699,14 @@ class BinaryDatasetTrain(BinaryDataset):
 
     def on_epoch_end(self):
         """
-        Re-shuffle the training data on each epoch. When data is being cached in memory, the class will always use
-        the same negative samples (to avoid loading new samples from disk). When data is loaded from disk, the negative
-        samples will change at the end of each epoch (assuming fraq_neg < 1).
+        Re-shuffle the training data on each epoch. The negative samples change at the end of each epoch (assuming
+        fraq_neg < 1), whether or not the contig features are cached.
         """
+        self._pending.clear()  # batches read ahead for the old order are no longer valid
+        # (with BatchWorkerPool, the contigs are cached and the statistics are logged by the worker processes)
+        if self.contig_cache is not None and self.epoch >= 0 and len(self.contig_cache) > 0:
+            self.contig_cache.log_stats()
+        self.epoch += 1
         np.random.shuffle(self.negative_idx)
         negative_count = int(self.fraq_neg * len(self.negative_idx))
         negative_idx = self.negative_idx[:negative_count]
@@ -544,20 +716,67 @@ class BinaryDatasetTrain(BinaryDataset):
             self.indices += negative_idx
 
         np.random.shuffle(self.indices)
-        if self.do_cache:
-            self.cache_indices = np.arange(len(self))
-            np.random.shuffle(self.cache_indices)
+        if self.length_boundaries is not None:
+            self.indices = self._bucket(self.indices)
+
+    def get_state(self) -> Dict:
+        """ Returns the state that changes from one epoch to the next, used for resuming training """
+        return {'seed': self.seed, 'epoch': self.epoch, 'indices': list(self.indices),
+                'negative_idx': list(self.negative_idx)}
+
+    def set_state(self, state: Dict):
+        """ Restores the state returned by get_state """
+        self._pending.clear()
+        self.seed, self.epoch = state['seed'], state['epoch']
+        self.indices, self.negative_idx = list(state['indices']), list(state['negative_idx'])
+
+    def _bucket(self, indices: List[int]) -> List[int]:
+        """
+        Reorders the (shuffled) indices such that each batch contains contigs from a single length bucket, and
+        shuffles the order of the batches. The remainders of the buckets (which don't fill a batch) are grouped
+        together at the end, so there is at most one incomplete batch, as without buckets. The classes are not
+        separated, so each bucket keeps the mix of positive and (sub-sampled) negative samples of its length range.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        buckets = np.searchsorted(self.length_boundaries,
+                                  np.minimum(self.reader.metadata.lengths[indices], self.max_len))
+        batches, remainders = [], []
+        for bucket in range(len(self.length_boundaries)):
+            bucket_indices = indices[buckets == bucket]
+            full_count = len(bucket_indices) // self.batch_size * self.batch_size
+            if full_count > 0:
+                batches += np.split(bucket_indices[:full_count], full_count // self.batch_size)
+            remainders.append(bucket_indices[full_count:])
+        np.random.shuffle(batches)
+        return np.concatenate(batches + remainders).tolist()
+
+    def _batch_len(self, batch_lengths: np.ndarray) -> int:
+        """ Returns the length to which the contigs of a batch with the given lengths are padded (or clipped) """
+        if self.pad_to_max_len:
+            return self.max_len
+        batch_len = min(int(batch_lengths.max()), self.max_len)
+        if self.pad_to_buckets and self.length_boundaries is not None:
+            return int(self.length_boundaries[np.searchsorted(self.length_boundaries, batch_len)])
+        return batch_len
+
+    def padding_fraction(self) -> float:
+        """ Returns the fraction of padded positions in the batches of the current epoch """
+        lengths = self.reader.metadata.lengths[np.asarray(self.indices, dtype=np.int64)]
+        total = sum(self.batch_size * self._batch_len(lengths[i:i + self.batch_size])
+                    for i in range(0, len(lengths), self.batch_size))
+        return 1 - np.minimum(lengths, self.max_len).sum() / total if total > 0 else 0
 
     def __len__(self):
         return int(np.ceil(len(self.indices) / self.batch_size))
 
     def select_intervals(contig_data: List[ContigInfo], max_len: int, translate_short_contigs: bool,
-                         max_translation_bases: int):
+                         max_translation_bases: int, rng=np.random):
         """
         Selects intervals from contigs such that the breakpoints are within the interval.
         For contigs shorter than #max_len, the entire contig is selected.
         For contigs with no mis-assemblies, a random interval is selected.
         For contigs with mis-assemblies, an interval is selected such that the first breakpoint is within the interval.
+        The random choices are made using rng (np.random or a np.random.RandomState).
         Returns: a list of intervals, one per contig
         """
         result = []
@@ -572,14 +791,14 @@ class BinaryDatasetTrain(BinaryDataset):
                 # when no breakpoints are present, we can choose any segment within the contig
                 # however, if the contig contains a breakpoint, we must choose a segment that includes the breakpoint
                 if not cd.breakpoints:
-                    start_idx = np.random.randint(cd.length - min_size + 1)
+                    start_idx = rng.randint(cd.length - min_size + 1)
                 else:  # select an interval that contains the random breakpoint
                     # TODO: add one item for each breakpoint
-                    lo, hi = random.choice(cd.breakpoints)
+                    lo, hi = cd.breakpoints[rng.randint(len(cd.breakpoints))]
                     if max_len >= min_padding + (hi - lo):
                         start_lo = max(0, hi - max_len + min_padding)
                         start_hi = min(cd.length - min_size, lo - min_padding)
-                        start_idx = np.random.randint(start_lo, start_hi)
+                        start_idx = rng.randint(start_lo, start_hi)
                     else:
                         pass  # corner case for tiny tiny max-len, probably never reached
                 end_idx = min(start_idx + max_len, end_idx)
@@ -590,17 +809,17 @@ class BinaryDatasetTrain(BinaryDataset):
                     lo, hi = cd.breakpoints[0]
                     if True:  # np.random.randint(0, 2) == 0:  # flip a coin for left/right shift
                         # in this case, the contig will be left-truncated
-                        start_idx = np.random.randint(0, min(max_translation_bases + 1, max(1, lo - min_padding)))
+                        start_idx = rng.randint(0, min(max_translation_bases + 1, max(1, lo - min_padding)))
                     else:
                         # end_idx will be larger than cd.length, which signals that the contig needs to be padded with
                         # start_idx zeros to the left
-                        start_idx = np.random.randint(0, max(1, min(lo - min_padding, max_len - cd.length)))
+                        start_idx = rng.randint(0, max(1, min(lo - min_padding, max_len - cd.length)))
                         end_idx = start_idx + cd.length
                 # # we need to also shift negative samples, otherwise the network learns that samples starting with zero
                 # #  (or ending with zero) are the positive samples and reach perfect training scores and horrible
                 # validation scores
                 else:
-                    start_idx = np.random.randint(0, max_translation_bases + 1)
+                    start_idx = rng.randint(0, max_translation_bases + 1)
             result.append((start_idx, end_idx))
         return result
 
@@ -613,64 +832,195 @@ class BinaryDatasetTrain(BinaryDataset):
         """
         start = timer()
         self.intervals.clear()
-        if self.do_cache and index in self.cache:
-            if self.show_progress:
-                utils.update_progress(index + 1, len(self), 'Training: ', '')
-            return self.cache[self.cache_indices[index]]
-        batch_indices = self.indices[self.batch_size * index:  self.batch_size * (index + 1)]
+        (x, mask), y, weights = self._assemble(index, self._take(index), start)
+        self.last_mask = mask
+        self.last_idx = index
+        return (x, mask), y, weights
+
+    def get_batch(self, index: int, repeat: int = 0, with_lengths: bool = False):
+        return self.build_batch(index, self.batch_indices(index), self.epoch, repeat, with_lengths)
+
+    def batch_indices(self, index: int) -> List[int]:
+        """ Returns the indices of the contigs in the mini-batch #index of the current epoch """
+        return self.indices[self.batch_size * index:  self.batch_size * (index + 1)]
+
+    def build_batch(self, index: int, batch_indices: List[int], epoch: int, repeat: int, with_lengths: bool = False):
+        """
+        Builds the mini-batch #index of #epoch made of the contigs at batch_indices (see get_batch). Used by the
+        worker processes of BatchWorkerPool, whose copy of #indices is not updated when the epoch changes.
+        """
+        rng = np.random.RandomState([self.seed, epoch, repeat, index])
+        prepared = self._prepare(index, rng, background=False, batch_indices=batch_indices)
+        batch = self._assemble(index, prepared, timer())
+        if not with_lengths:
+            return batch
+        # the selected interval of each contig is copied to the start of its row (see _assemble)
+        starts, stops = prepared[4], prepared[5]
+        lengths = np.zeros(self.batch_size, dtype=np.int32)
+        lengths[:len(starts)] = np.subtract(stops, starts)
+        return batch + (lengths,)
+
+    def max_batch_bytes(self) -> int:
+        """ Returns an upper bound for the size of x and mask of a mini-batch """
+        return self.batch_size * (self.max_len * self.get_bytes_per_base() + self.convoluted_size(self.max_len, True))
+
+    def _assemble(self, index: int, prepared, start: float):
+        """ Waits for the read started by _prepare and copies the selected intervals into the batch tensor """
+        x, mask, y, weights, starts, stops, mask_lengths, future = prepared
+        if self.fused_read:
+            future.result()
+        else:
+            for i, stacked_features in enumerate(future.result()):
+                # stacked_features holds the selected interval, each feature is a column in x[i]
+                x[i][:stops[i] - starts[i], :] = stacked_features
+                mask[i][mask_lengths[i]:] = 0
+        if self.show_progress:
+            utils.update_progress(index + 1, self.__len__(), 'Training: ', f' {(timer() - start):5.2f}s')
+        return (x, mask), y, weights
+
+    def _prepare(self, index: int, rng=np.random, background: bool = True, batch_indices: List[int] = None):
+        """
+        Selects the contig intervals for the mini-batch #index, allocates its tensors and starts reading the data.
+        Returns: x, mask, y, weights, the selected intervals and masked lengths, and the future of the read
+        """
+        if batch_indices is None:
+            batch_indices = self.batch_indices(index)
         # files to process
         contig_data: List[ContigInfo] = [self.reader.contigs[i] for i in batch_indices]
-        y = np.zeros(self.batch_size)
+        batch_lengths = self.reader.metadata.lengths[np.asarray(batch_indices, dtype=np.int64)]
+        y = np.zeros(self.batch_size, dtype=np.uint8)
         weights = np.ones(self.batch_size, dtype=np.float32)
-        for i in range(len(batch_indices)):
-            y[i] = 0 if contig_data[i].misassembly == 0 else 1
+        y[:len(batch_indices)] = self.reader.metadata.misassembly[np.asarray(batch_indices, dtype=np.int64)] != 0
         if self.weight_factor > 0:
-            for i in range(len(batch_indices)):
-                weights[i] = min(1, (contig_data[i].length/self.weight_factor)**2)
+            weights[:len(batch_indices)] = np.minimum(1, (batch_lengths / self.weight_factor) ** 2)
 #                 weights[i] = min(100, (contig_data[i].length/self.weight_factor)**4)
 
-        features_data = self.reader.read_contigs(contig_data)
-        max_contig_len = max([self.reader.contigs[i].length for i in batch_indices])
-        max_len = self.max_len if self.pad_to_max_len else min(max_contig_len, self.max_len)
+        max_len = self._batch_len(batch_lengths)
 #         #TODO
 #         max_len += 50
         
         # Create the numpy array storing all the features for all the contigs in #batch_indices
-        x = np.zeros((self.batch_size, max_len, len(features_data[0])), dtype=np.float32)
+        x = np.zeros((self.batch_size, max_len, len(self.expanded_feature_names)), dtype=self.dtype)
         # it's important to initialize the mask to all ones and then set to zero the padded values rather than the
         # other way around, otherwise we create a mask of all zeros for incomplete batches -> NaN in averaging
         mask = np.ones((self.batch_size, self.convoluted_size(max_len, True)), dtype=np.bool)
 
         contig_intervals = BinaryDatasetTrain.select_intervals(contig_data, max_len, self.translate_short_contigs,
-                                                               self.max_translation_bases)
-        for i, contig_features in enumerate(features_data):
+                                                               self.max_translation_bases, rng)
+        # the interval of each contig that is copied to x[i] and the length of the unmasked part of mask[i]
+        starts, stops, mask_lengths = [], [], []
+        for i, (start_idx, end_idx) in enumerate(contig_intervals):
             contig_len = contig_data[i].length
-            to_merge = [None] * len(self.expanded_feature_names)
-            start_idx, end_idx = contig_intervals[i]
-            length = end_idx - start_idx
-            for j, feature_name in enumerate(self.expanded_feature_names):
-                if end_idx <= contig_len:
-                    to_merge[j] = contig_features[feature_name][start_idx:end_idx]
-                else:  # contig will be left-padded with zeros
-                    assert contig_len == end_idx - start_idx, f'Contig len is {contig_len}, ' \
-                                                              f'st-end are {start_idx}-{end_idx}'
-                    to_merge[j] = contig_features[feature_name][0:min(max_len - start_idx, contig_len)]
-            stacked_features = np.stack(to_merge, axis=-1)  # each feature becomes a column in x[i]
-            x[i][:length, :] = stacked_features
-            mask[i][self.convoluted_size(length, False):] = 0
-        self.last_mask = mask
-        self.last_idx = index
-        if self.do_cache:
-            self.cache[index] = (x, mask), y, weights
-        if self.show_progress:
-            utils.update_progress(index + 1, self.__len__(), 'Training: ', f' {(timer() - start):5.2f}s')
-        return (x, mask), y, weights
+            if end_idx <= contig_len:
+                starts.append(start_idx)
+                stops.append(end_idx)
+            else:  # contig will be left-padded with zeros
+                assert contig_len == end_idx - start_idx, f'Contig len is {contig_len}, ' \
+                                                          f'st-end are {start_idx}-{end_idx}'
+                starts.append(0)
+                stops.append(min(max_len - start_idx, contig_len))
+            mask_lengths.append(self.convoluted_size(end_idx - start_idx, False))
+        if self.fused_read:
+            future = self._start(self.reader.read_into, batch_indices, starts, stops, np.arange(len(batch_indices)),
+                                 self.expanded_feature_names, x, mask, mask_lengths, background=background)
+        else:
+            future = self._start(self.read_stacked_features, batch_indices, starts, stops, background=background)
+        return x, mask, y, weights, starts, stops, mask_lengths, future
+
+
+class BinaryDatasetChunks(BinaryDataset):
+    """
+    Training dataset made of the fixed-length chunks listed in the toc_chunked files (see chunks.py), i.e. intervals
+    around a breakpoint of the misassembled contigs and at a random position of the other contigs. All the batches
+    have the same shape (batch_size, chunk length, features) and the same mask, so nothing is padded; this makes
+    training much faster than on full contigs, e.g. for pretraining (see --chunk-epochs).
+    """
+
+    def __init__(self, reader: ContigReader, indices: List[int], batch_size: int, feature_names: List[str],
+                 fraq_neg: float, convoluted_size, toc_name: str = 'toc_chunked', do_cache: bool = False,
+                 tensor_cache_dir: str = '', tensor_cache_dtype: str = 'float32', feature_dtype: str = 'float32',
+                 cache_bytes: int = int(4e9)):
+        """
+        Arguments:
+            - reader: ContigReader instance with all the contig metadata
+            - indices: positions of the contigs in #reader whose chunks are used for training
+            - batch_size: training batch size; the last incomplete batch of each epoch is dropped
+            - feature_names: the names of the features to read and use for training
+            - fraq_neg: fraction of samples to keep in the overrepresented class (chunks with no misassembly)
+            - convoluted_size - function that computes the size of the convoluted output for an input of size n
+            - toc_name: the name of the chunk toc files next to the stats files
+            - do_cache: if True, the features of the contigs the chunks are sliced from are cached in memory (see
+              ContigCache), up to cache_bytes
+        """
+        BinaryDataset.__init__(self, reader, feature_names, convoluted_size, False, tensor_cache_dir,
+                               tensor_cache_dtype, False, 0, feature_dtype)
+        index_set = set(np.asarray(indices).tolist())
+        chunks = [chunk for chunk in reader.load_chunks(toc_name) if chunk.contig_idx in index_set]
+        # chunks of contigs shorter than the chunk size are shorter, these are skipped to avoid padding
+        self.chunk_len = max(chunks, key=lambda chunk: chunk.length).length if chunks else 0
+        self.chunks = [chunk for chunk in chunks if chunk.length == self.chunk_len]
+        self.batch_size = batch_size
+        self.fraq_neg = fraq_neg
+        self.seed = np.random.randint(2 ** 31)
+        self.epoch = -1
+        if do_cache:
+            self.contig_cache = ContigCache(cache_bytes)
+        self.negative_idx = [i for i, chunk in enumerate(self.chunks) if chunk.misassembly == 0]
+        self.positive_idx = [i for i, chunk in enumerate(self.chunks) if chunk.misassembly != 0]
+        # the mask is the same for all the chunks: only the positions computed without padding are used
+        self.mask = np.ones(self.convoluted_size(self.chunk_len, True), dtype=bool)
+        self.mask[self.convoluted_size(self.chunk_len, False):] = False
+        logging.info(f'Creating chunk training data generator. Chunk length: {self.chunk_len}, '
+                     f'Chunks: {len(self.chunks)} ({len(chunks) - len(self.chunks)} shorter chunks skipped), '
+                     f'Pos samples: {len(self.positive_idx)}, Neg samples: {len(self.negative_idx) * fraq_neg:.0f}')
+        self.on_epoch_end()
+
+    def on_epoch_end(self):
+        """ Selects the negative samples and re-shuffles the chunks """
+        if self.contig_cache is not None and self.epoch >= 0 and len(self.contig_cache) > 0:
+            self.contig_cache.log_stats()
+        self.epoch += 1
+        np.random.shuffle(self.negative_idx)
+        self.indices = self.positive_idx + self.negative_idx[:int(self.fraq_neg * len(self.negative_idx))]
+        np.random.shuffle(self.indices)
+
+    get_state = BinaryDatasetTrain.get_state
+    set_state = BinaryDatasetTrain.set_state
+
+    def __len__(self):
+        return len(self.indices) // self.batch_size
+
+    def __getitem__(self, index):
+        return self.get_batch(index)
+
+    def get_batch(self, index: int, repeat: int = 0, with_lengths: bool = False):
+        return self.build_batch(index, self.batch_indices(index), self.epoch, repeat, with_lengths)
+
+    def batch_indices(self, index: int) -> List[int]:
+        """ Returns the indices of the chunks in the mini-batch #index of the current epoch """
+        return self.indices[self.batch_size * index:  self.batch_size * (index + 1)]
+
+    def build_batch(self, index: int, batch_indices: List[int], epoch: int, repeat: int, with_lengths: bool = False):
+        """ Builds the mini-batch #index made of the chunks at batch_indices (no random choices are involved) """
+        chunks = [self.chunks[i] for i in batch_indices]
+        x = np.stack(self.read_stacked_features([chunk.contig_idx for chunk in chunks],
+                                                [chunk.start for chunk in chunks], [chunk.stop for chunk in chunks]))
+        mask = np.broadcast_to(self.mask, (len(chunks), len(self.mask)))
+        y = np.array([chunk.misassembly != 0 for chunk in chunks], dtype=np.uint8)
+        batch = (x, mask), y, np.ones(len(chunks), dtype=np.float32)
+        return batch + (np.full(len(chunks), self.chunk_len, dtype=np.int32),) if with_lengths else batch
+
+    def max_batch_bytes(self) -> int:
+        """ Returns the size of x and mask of a mini-batch """
+        return self.batch_size * (self.chunk_len * len(self.expanded_feature_names) * self.dtype.itemsize
+                                  + len(self.mask))
 
 
 class BinaryDatasetEval(BinaryDataset):
     def __init__(self, reader: ContigReader, indices: List[int], feature_names: List[str], window: int, step: int,
                  total_memory_bytes: int, cache_results: bool, show_progress: bool, convoluted_size,
-                 pad_to_max_len: bool):
+                 pad_to_max_len: bool, tensor_cache_dir: str = '', tensor_cache_dtype: str = 'float32',
+                 fused_read: bool = False, prefetch: int = 0, feature_dtype: str = 'float32'):
 
         """
         Arguments:
@@ -687,26 +1037,34 @@ class BinaryDatasetEval(BinaryDataset):
             convoluted_size - lambda that computes the size of the convoluted output for an input of size n
             pad_to_max_len - if true, all batches will be padded to max-len, even if the longest contig in the batch
               is shorter (this guarantees fixed-length input)
+            tensor_cache_dir - if not empty, normalized features are cached on disk in this directory
+            tensor_cache_dtype - storage type of the cached features (float32 or float16)
+            fused_read - if true, features are read directly into the batch tensor (see ContigReader.read_into)
+            prefetch - number of batches read in the background ahead of the current one
+            feature_dtype - type of the returned (and cached) feature tensors: float32, float16 or bfloat16
         """
         logging.info(f'Creating evaluation data generator. Window: {window}, Step: {step}, Caching: {cache_results}')
-        BinaryDataset.__init__(self, reader, feature_names, convoluted_size, pad_to_max_len)
+        BinaryDataset.__init__(self, reader, feature_names, convoluted_size, pad_to_max_len, tensor_cache_dir,
+                               tensor_cache_dtype, fused_read, prefetch, feature_dtype)
         self.indices = indices  # sorted(indices, key=lambda x: reader.contigs[x].length)
         self.window = window
         self.step = step
         # creates batches of contigs such that the total memory used by features in each batch is < total_memory_bytes
         # chunk_counts[batch_count][idx] represents the number of chunks for the contig number #idx
         # in the batch #batch_count
-        self.batch_list, self.chunk_counts = self._create_batch_list(reader.contigs, self.indices, total_memory_bytes)
+        self.batch_list, self.chunk_counts = self._create_batch_list(reader.metadata.lengths, self.indices,
+                                                                     total_memory_bytes)
 
         # flattened ground truth for each eval contig
-        self.y = [0 if self.reader.contigs[i].misassembly == 0 else 1 for b in self.batch_list for i in b]
+        flat_indices = np.array([i for b in self.batch_list for i in b], dtype=np.int64)
+        self.y = (self.reader.metadata.misassembly[flat_indices] != 0).astype(int).tolist()
         # the cached results
         self.cache_results = cache_results
         self.show_progress = show_progress
         if cache_results:
             self.data = [None] * len(self.batch_list)
 
-    def _create_batch_list(self, contig_data: List[ContigInfo], indices: List[int], total_memory_bytes: int):
+    def _create_batch_list(self, lengths: np.ndarray, indices: List[int], total_memory_bytes: int):
         """ Divide the validation indices into mini-batches of total size < #total_memory_bytes """
         # there seems to be an overhead for each position; 10 is just a guess to avoid running out of memory
         # on the GPU
@@ -717,10 +1075,10 @@ class BinaryDatasetEval(BinaryDataset):
         batch_chunk_count = 0  # total number of contig chunks in the current batch
         chunk_counts = []  # number of chunks in each batch
         counts = []
-        for idx in indices:
-            contig_len = contig_data[idx].length
-            # number of chunks for the current contig
-            curr_chunk_count = 1 + max(0, math.ceil((contig_len - self.window) / self.step))
+        # number of chunks for each contig
+        contig_lengths = np.asarray(lengths)[np.asarray(indices, dtype=np.int64)]
+        all_chunk_counts = 1 + np.maximum(0, np.ceil((contig_lengths - self.window) / self.step)).astype(np.int64)
+        for idx, curr_chunk_count in zip(indices, all_chunk_counts.tolist()):
             batch_chunk_count += curr_chunk_count
             # check if the new contig still fits in memory; create a new batch if not
             if len(current_indices) > 300 or current_indices and batch_chunk_count * self.window * bytes_per_base > total_memory_bytes:
@@ -818,73 +1176,229 @@ class BinaryDatasetEval(BinaryDataset):
         convolutional layer are not affected by padding (and should thus be considered by the maxpool and average pool
         layers). The y value, representing the labels) is in this case unused and is a zero array of size batch_size.
         """
-        start = timer()
+        return self._assemble(batch_idx, self._take(batch_idx), timer())
+
+    def get_batch(self, batch_idx: int, repeat: int = 0):
+        return self._assemble(batch_idx, self._prepare(batch_idx, background=False), timer())
+
+    def _assemble(self, batch_idx: int, prepared, start: float):
+        """ Waits for the read started by _prepare and copies the windows into the batch tensor """
+        windows, max_len, future = prepared
+        batch_size = len(windows)
+
+        start_stack = timer()
+        data = future.result()
+        stack_time = timer() - start_stack
+        if self.cache_results:
+            self.data[batch_idx] = data
+        if self.fused_read:
+            x, mask = data
+        else:
+            all_stacked_features = data
+            x = np.zeros((batch_size, max_len, len(self.expanded_feature_names)), dtype=self.dtype)
+            # the size of the convoluted output (the output that goes into the max/avg global pooling layer)
+            # for the longest contig (including positions that needed partial padding)
+            mask = np.zeros((batch_size, self.convoluted_size(max_len, pad=True)), dtype=np.bool)
+            # create a numpy 3D array of shape (batch_size, max_len, num_features) to be used for evaluation
+            for idx, (pos, start_idx, end_idx, mask_len) in enumerate(windows):
+                x[idx][:end_idx - start_idx] = all_stacked_features[pos][start_idx:end_idx]
+                mask[idx][:mask_len] = 1
+
+        if self.show_progress:
+            utils.update_progress(batch_idx + 1, self.__len__(), 'Evaluating: ',
+                                  f' {(timer() - start):5.2f}s  {stack_time:5.2f}s')
+        return (x, mask), np.zeros(batch_size, dtype=np.bool)
+
+    def _is_cached(self, batch_idx: int) -> bool:
+        return self.cache_results and self.data[batch_idx] is not None
+
+    def _prepare(self, batch_idx: int, background: bool = True):
+        """
+        Computes the windows of the contigs in the mini-batch #batch_idx and starts reading their data.
+        Returns: the windows, the window length and the future of the read, whose result is (x, mask) for fused reads
+        and the stacked features of each contig otherwise
+        """
         # files to process
         indices = self.batch_list[batch_idx]
 
-        stack_time = 0
-        if self.cache_results and self.data[batch_idx] is not None:
-            all_stacked_features = self.data[batch_idx]
-        else:
-            contig_data: List[ContigInfo] = [self.reader.contigs[i] for i in indices]
-            all_stacked_features = [None] * len(contig_data)
-            features_data = self.reader.read_contigs(contig_data)
-            assert len(features_data) == len(contig_data)
-            to_merge = [None] * len(self.expanded_feature_names)
-
-            start_stack = timer()
-            for i, contig_features in enumerate(features_data):
-                contig_len = contig_data[i].length
-                assert contig_len == len(contig_features[self.expanded_feature_names[0]])
-                # each feature in features_data becomes o column in x
-                for j, feature_name in enumerate(self.expanded_feature_names):
-                    to_merge[j] = contig_features[feature_name]
-                stacked_features = np.column_stack(to_merge)
-                all_stacked_features[i] = stacked_features.astype(np.float32)  # otherwise it's float64, too much RAM
-            stack_time += (timer() - start_stack)
-            if self.cache_results:
-                self.data[batch_idx] = all_stacked_features
-
-        max_contig_len = max([self.reader.contigs[i].length for i in indices])
+        max_contig_len = int(self.reader.metadata.lengths[np.asarray(indices, dtype=np.int64)].max())
         max_len = self.window if self.pad_to_max_len else min(max_contig_len, self.window)
 #         #TODO
 #         max_len += 50
-        
+        # break down contigs into multiple windows if too long
+        windows = self._windows(self.reader.metadata.lengths[np.asarray(indices, dtype=np.int64)], max_len)
         # the evaluation data for all contigs in this batch
-        batch_size = sum(self.chunk_counts[batch_idx])
-        x = np.zeros((batch_size, max_len, len(self.expanded_feature_names)), dtype=np.float32)
-        # the size of the convoluted output (the output that goes into the max/avg global pooling layer)
-        # for the longest contig (including positions that needed partial padding)
-        mask = np.zeros((batch_size, self.convoluted_size(max_len, pad=True)), dtype=np.bool)
-        # traverse all contig features, break down into multiple contigs if too long, and create a numpy 3D array
-        # of shape (batch_size, max_len, num_features) to be used for evaluation
-        idx = 0
-        for stacked_features in all_stacked_features:
-            contig_len = stacked_features.shape[0]
+        assert sum(self.chunk_counts[batch_idx]) == len(windows)
+
+        if self.cache_results and self.data[batch_idx] is not None:
+            future = Future()
+            future.set_result(self.data[batch_idx])
+        elif self.fused_read:
+            future = self._start(self._read_windows, indices, windows, max_len, background=background)
+        else:
+            # each feature becomes a column in the stacked features
+            future = self._start(self.read_stacked_features, indices, background=background)
+        return windows, max_len, future
+
+    def _read_windows(self, indices, windows, max_len: int):
+        """ Reads the given windows directly into a new batch tensor and mask """
+        x = np.zeros((len(windows), max_len, len(self.expanded_feature_names)), dtype=self.dtype)
+        mask = np.zeros((len(windows), self.convoluted_size(max_len, pad=True)), dtype=np.bool)
+        self.reader.read_into([indices[w[0]] for w in windows], [w[1] for w in windows], [w[2] for w in windows],
+                              np.arange(len(windows)), self.expanded_feature_names, x, mask, [w[3] for w in windows])
+        return x, mask
+
+    def _windows(self, contig_lengths, max_len: int):
+        """
+        Breaks down the contigs of the given lengths into windows of size #window at #step intervals.
+        Returns:
+            - a list of (contig position, start, end, mask length) tuples, one per window, where mask length is the
+              number of positions in the convoluted output that didn't need padding in order to be computed
+        """
+        result = []
+        for pos, contig_len in enumerate(contig_lengths.tolist()):
             start_idx = 0
             while True:
                 end_idx = start_idx + self.window
                 if end_idx < contig_len:
-                    x[idx] = stacked_features[start_idx:end_idx] #[:end_idx - start_idx]
                     assert max_len == self.window #+50
                     # keep only positions that didn't need padding in order to be computed (pad=False)
-                    mask[idx][:self.convoluted_size(max_len, pad=False)] = 1
-                    idx += 1
+                    result.append((pos, start_idx, end_idx, self.convoluted_size(max_len, pad=False)))
                 else:
 #                     ###force at least 5000 bases in the last chunk, as the network hasn't seen contigs shorter than 1K
                     if self.window > 5000 and contig_len > self.window and contig_len - start_idx < 5000:
                         start_idx = contig_len - 5000
 #                     if self.window > 1000 and contig_len > self.window and contig_len - start_idx < 1000:
 #                         start_idx = contig_len - 1000
-                    x[idx][:contig_len - start_idx] = stacked_features[start_idx:contig_len]
-                    mask[idx][:self.convoluted_size(contig_len - start_idx, pad=False)] = 1
-                    idx += 1
+                    result.append((pos, start_idx, contig_len, self.convoluted_size(contig_len - start_idx, pad=False)))
                     break
 
                 start_idx += self.step
+        return result
 
-        if self.show_progress:
-            utils.update_progress(batch_idx + 1, self.__len__(), 'Evaluating: ',
-                                  f' {(timer() - start):5.2f}s  {stack_time:5.2f}s')
-        return (x, mask), np.zeros(batch_size, dtype=np.bool)
-    
\ No newline at end of file
+
+# the pairs of complementary feature channels swapped when a contig is reverse complemented
+COMPLEMENT_FEATURES = [('num_query_A', 'num_query_T'), ('num_query_C', 'num_query_G'), ('ref_base_A', 'ref_base_T'),
+                       ('ref_base_C', 'ref_base_G')]
+
+
+def make_augmentation(expanded_feature_names: List[str], convoluted_size, max_len: int, pad_to_max_len: bool,
+                      reverse_prob: float = 0.5, max_shift: int = 0):
+    """
+    Builds a function that augments a training batch ((x, mask), y, weights) with TensorFlow ops, so that the
+    augmentation runs in the tf.data pipeline rather than in the (Python) batch loader:
+      - with probability reverse_prob, the contig in each row is reverse complemented: its positions are reversed and
+        the channels of complementary bases (see COMPLEMENT_FEATURES) are swapped
+      - each contig is shifted to the right by a random number (up to max_shift) of zero positions; as for the
+        contigs that select_intervals pads on the left, the added positions are not masked. Unless pad_to_max_len is
+        set, the batch is extended by max_shift positions, otherwise contigs are only shifted into the padding.
+    The returned function takes the batch, the number of contig positions in each row of x (see the with_lengths
+    argument of BinaryDataset.get_batch; all-zero positions can't be told apart from padding, e.g. at uncovered contig
+    ends) and a seed (an int64 tensor of shape (2,)) for the stateless random ops, so the augmentation of a batch only
+    depends on the seed.
+    Arguments:
+        - expanded_feature_names: the names of the channels of x (see BinaryDataset.expanded_feature_names)
+        - convoluted_size: the function computing the size of the convolved output (see construct_convolution_lambda)
+        - max_len: the maximum length of the contigs in a batch
+        - pad_to_max_len: true if the batches have a fixed length of max_len
+        - reverse_prob: the probability of reverse complementing a contig
+        - max_shift: the maximum number of positions by which a contig is shifted
+    """
+    permutation = list(range(len(expanded_feature_names)))
+    for first, second in COMPLEMENT_FEATURES:
+        if first in expanded_feature_names and second in expanded_feature_names:
+            i, j = expanded_feature_names.index(first), expanded_feature_names.index(second)
+            permutation[i], permutation[j] = j, i
+    # the unpadded/padded convolved sizes of all the possible contig lengths
+    lengths = range(max_len + max_shift + 1)
+    unpadded_sizes = tf.constant([max(0, convoluted_size(n, False)) for n in lengths], dtype=tf.int32)
+    padded_sizes = tf.constant([max(0, convoluted_size(n, True)) for n in lengths], dtype=tf.int32)
+
+    def augment(batch, contig_lengths, seed):
+        (x, mask), y, weights = batch
+        x_shape, mask_shape = x.shape, mask.shape
+        batch_size, length = tf.shape(x)[0], tf.shape(x)[1]
+        reverse_seed, shift_seed = tf.unstack(tf.random.experimental.stateless_split(seed, 2))
+        contig_lengths = tf.cast(contig_lengths, tf.int32)
+        if reverse_prob > 0:
+            reverse = tf.random.stateless_uniform([batch_size], reverse_seed) < reverse_prob
+            reversed_x = tf.gather(tf.reverse_sequence(x, contig_lengths, seq_axis=1, batch_axis=0), permutation,
+                                   axis=2)
+            x = tf.where(reverse[:, None, None], reversed_x, x)
+        if max_shift > 0:
+            if not pad_to_max_len:
+                x = tf.pad(x, [[0, 0], [0, max_shift], [0, 0]])
+                mask = tf.pad(mask, [[0, 0], [0, padded_sizes[length + max_shift] - tf.shape(mask)[1]]])
+                length += max_shift
+            max_shifts = tf.minimum(max_shift, length - contig_lengths)
+            shifts = tf.cast(tf.random.stateless_uniform([batch_size], shift_seed)
+                             * tf.cast(max_shifts + 1, tf.float32), tf.int32)
+            shifts = tf.minimum(shifts, max_shifts)
+            positions = tf.range(length)[None, :] - shifts[:, None]
+            shifted_x = tf.gather(x, tf.maximum(positions, 0), batch_dims=1)
+            x = tf.where((positions >= 0)[:, :, None], shifted_x, tf.zeros_like(shifted_x))
+            shifted_mask = tf.range(tf.shape(mask)[1])[None, :] < tf.gather(unpadded_sizes,
+                                                                             contig_lengths + shifts)[:, None]
+            # empty rows (in incomplete batches) keep their mask of all ones
+            mask = tf.where(((shifts > 0) & (contig_lengths > 0))[:, None], shifted_mask, mask)
+        if pad_to_max_len:
+            x.set_shape(x_shape)
+            mask.set_shape(mask_shape)
+        else:
+            x.set_shape([x_shape[0], None, x_shape[2]])
+            mask.set_shape([mask_shape[0], None])
+        return (x, mask), y, weights
+
+    return augment
+
+
+def make_tf_dataset(dataset: BinaryDataset, output_signature, repeat: int = 1,
+                    parallel_calls: int = tf.data.AUTOTUNE, deterministic: bool = True,
+                    prefetch: int = tf.data.AUTOTUNE, augment=None) -> tf.data.Dataset:
+    """
+    Creates a tf.data pipeline returning the mini-batches of dataset #repeat times. The pipeline maps over the batch
+    indices and builds the batches with parallel calls to dataset.get_batch; the expensive parts of building a batch
+    (reading, decompressing and decoding the contig records) don't hold the GIL, so batch production scales with the
+    number of parallel calls.
+    Arguments:
+        - dataset: the BinaryDataset, or the BatchWorkerPool building its batches in worker processes
+        - output_signature: nested structure of tf.TensorSpec describing a batch returned by dataset.get_batch
+        - parallel_calls: the number of batches built concurrently, tf.data.AUTOTUNE lets tf.data choose
+        - deterministic: if False, batches are returned as soon as they are ready rather than in order; the content of
+          each batch is the same either way
+        - prefetch: the number of batches prepared ahead of the one being used, tf.data.AUTOTUNE lets tf.data choose
+        - augment: if given, the function (see make_augmentation) applied to each batch and the lengths of its contigs;
+          its random seed only depends on the dataset seed, the epoch and the position of the batch in the pipeline
+    """
+    batch_count = len(dataset)
+    flat_signature = tf.nest.flatten(output_signature)
+
+    def load(element: np.int64):
+        repeat_idx, index = divmod(int(element), batch_count)
+        if augment is None:
+            batch = dataset.get_batch(index, repeat_idx)
+        else:
+            *batch, lengths = dataset.get_batch(index, repeat_idx, with_lengths=True)
+        result = [np.asarray(t, dtype=spec.dtype.as_numpy_dtype)
+                  for t, spec in zip(tf.nest.flatten(batch), flat_signature)]
+        if augment is not None:
+            result.append(np.asarray(lengths, dtype=np.int32))
+            result.append(np.array([dataset.seed, dataset.epoch * batch_count * repeat + int(element)], dtype=np.int64))
+        return result
+
+    def tf_load(element):
+        types = [spec.dtype for spec in flat_signature] + ([tf.int32, tf.int64] if augment is not None else [])
+        tensors = tf.numpy_function(load, [element], types, stateful=True)
+        for tensor, spec in zip(tensors, flat_signature):
+            tensor.set_shape(spec.shape)
+        batch = tf.nest.pack_sequence_as(output_signature, tensors[:len(flat_signature)])
+        if augment is None:
+            return batch
+        lengths, seed = tensors[len(flat_signature):]
+        lengths.set_shape(tensors[len(flat_signature) - 1].shape)  # one per row, like the weights
+        seed.set_shape([2])
+        return augment(batch, lengths, seed)
+
+    result = tf.data.Dataset.range(batch_count * repeat)
+    result = result.map(tf_load, num_parallel_calls=parallel_calls, deterministic=deterministic)
+    return result.prefetch(prefetch)
@@ -7,6 +7,11 @@ from libc.stdint cimport uint32_t
 from libc.stdint cimport uint64_t
 from libc.stdint cimport uint16_t
 from libc.stdint cimport uint8_t
+from libc.stdint cimport int32_t
+from libc.stdint cimport int64_t
+from libcpp cimport bool
+
+import logging
 
 import numpy as np
 from cython.parallel import parallel, prange
@@ -57,6 +62,11 @@ feature_np_sizes = [np.dtype(feature_types[i]).itemsize for i in range(N_FEATURE
 
 bytes_per_base = sum(feature_sizes)
 
+# how each feature is converted to float32 by read_contigs_into_py (see FeatureType in contig_reader.hpp); ref_base is
+# one-hot encoded into 4 columns
+_type_codes = {np.uint8: 0, np.uint16: 1, np.int8: 2, np.float32: 3}
+feature_type_codes = [4 if f[0] == 'ref_base' else _type_codes[f[1]] for f in feature_tuples]
+
 assert len(feature_names) == N_FEATURES
 assert len(feature_sizes) == N_FEATURES
 assert len(feature_types) == N_FEATURES
@@ -70,7 +80,36 @@ cdef extern from 'contig_reader.hpp':
                                    uint32_t length_bases, uint32_t num_features,
                                    uint16_t b_per_base, uint8_t *feature_mask,
                                    uint8_t *feature_sizes_bytes, char *buf, char ** features, int thread) nogil
-
+    ctypedef struct FeatureConversion:
+        int32_t column
+        uint8_t type
+        uint8_t has_nan_value
+        uint8_t zero_nan
+        float nan_value
+        float scale
+        float mean
+        float stdev
+    ctypedef struct BatchBuffer:
+        float *x
+        uint32_t max_len
+        uint32_t num_columns
+        uint8_t *mask
+        uint32_t mask_width
+    cdef void write_contig_into(const char *data, uint32_t length_bases, uint32_t num_features,
+                                const uint8_t *feature_sizes_bytes, const FeatureConversion *conversions,
+                                uint32_t piece_count, const uint32_t *starts, const uint32_t *stops,
+                                const uint32_t *rows, const uint32_t *mask_lengths, BatchBuffer batch) nogil
+    cdef void split_features(const char *data, uint32_t length_bases, uint32_t num_features,
+                             const uint8_t *feature_mask, const uint8_t *feature_sizes_bytes, char **features) nogil
+    cdef cppclass ContigFileReader:
+        ContigFileReader() except +
+        int open(const char *fname)
+        void set_max_open_files(uint32_t count)
+        void set_thread_count(uint32_t count) except +
+        const char *read_range(int file_id, uint64_t offset, uint64_t size, int thread) nogil
+        void will_need(int file_id, uint64_t offset, uint64_t size) nogil
+        const char *decompress(const char *compressed, uint32_t size_bytes, uint32_t length_bases,
+                               uint32_t bytes_per_base, int thread) nogil
 
 @cython.boundscheck(False)
 cdef read_contig_cpp(const char* file_name, uint32_t length, uint64_t offset, uint32_t size, uint8_t[:] feature_mask):
@@ -99,77 +138,322 @@ def read_contig_py(str file_name, int length, int offset, int size, py_feature_n
     result = read_contig_cpp(file_name.encode('utf-8'), length, offset, size, feature_mask)
     return {key: result[key] for key in py_feature_names}
 
+def _log_failed_read(file_name: bytes, offset: int):
+    logging.warning(f'Could not read the contig record at offset {offset} in {file_name.decode("utf-8")}, '
+                    f'using zeros instead')
+
+
+cdef class FeatureReader:
+    """
+    Long-lived reader for the contig records in features_binary files. Keeps up to #max_open_files file descriptors
+    open (closing the least recently used ones), reuses the per-thread read/decompression buffers and zlib streams
+    across calls and reads with pread(), so the per-call overhead is small even for batches of short contigs. The OpenMP thread team is kept alive by the OpenMP runtime
+    between calls.
+    The requested records are sorted by (file, offset) and records that are close to each other are merged into a
+    single sequential read (see #plan), independently of the order in which the caller lists them; the results are
+    always returned in the caller's order.
+    Files are identified by name: if a features_binary file is replaced, a new FeatureReader must be created.
+    """
+    cdef ContigFileReader *c_reader
+    cdef readonly int num_threads
+    cdef readonly uint64_t max_gap_bytes
+    cdef readonly uint64_t max_run_bytes
+    cdef object __weakref__
+
+    def __cinit__(self, int num_threads, uint64_t max_gap_bytes=64 * 1024, uint64_t max_run_bytes=4 * 1024 * 1024,
+                  uint32_t max_open_files=64):
+        """
+        Arguments:
+            - num_threads: number of threads used for reading and decompressing
+            - max_gap_bytes: records separated by at most this many (unneeded) bytes are read together
+            - max_run_bytes: maximum size of a merged read
+            - max_open_files: maximum number of cached file descriptors (see #set_max_open_files)
+        """
+        self.c_reader = new ContigFileReader()
+        self.num_threads = max(1, num_threads)
+        self.max_gap_bytes = max_gap_bytes
+        self.max_run_bytes = max_run_bytes
+        self.c_reader.set_thread_count(self.num_threads)
+        self.c_reader.set_max_open_files(max_open_files)
+
+    def set_max_open_files(self, uint32_t count):
+        """
+        Sets the maximum number of cached file descriptors; the descriptors of the files being read are kept open in
+        addition (at most one per thread). May be called while another thread is reading.
+        """
+        self.c_reader.set_max_open_files(count)
+
+    def __dealloc__(self):
+        del self.c_reader
+
+    def _file_ids(self, file_names: List[bytes]):
+        file_ids = np.empty(len(file_names), dtype=np.int32)
+        cdef int file_id
+        for i, file_name in enumerate(file_names):
+            file_id = self.c_reader.open(file_name)
+            if file_id < 0:
+                raise IOError(f'Could not open {file_name.decode("utf-8")}')
+            file_ids[i] = file_id
+        return file_ids
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def plan(self, file_ids, offsets, sizes):
+        """
+        Groups the records at the given (file id, offset, size) into runs of records that are read with a single
+        sequential read. Runs are capped at #max_run_bytes and at the total size divided by the thread count, so that
+        all threads get work even if all records are adjacent.
+        Returns:
+            - order: the record indices sorted by (file, offset); the records of run i are order[run_idx[i]:run_idx[i+1]]
+            - run_idx, run_file, run_start, run_end: the records, file id and byte range [run_start, run_end) of each run
+        """
+        order_np = np.lexsort((np.asarray(offsets, dtype=np.uint64), np.asarray(file_ids, dtype=np.int32)))
+        cdef int64_t[:] order = order_np.astype(np.int64)
+        cdef int[:] file_ids_c = np.asarray(file_ids, dtype=np.int32)
+        cdef uint64_t[:] offsets_c = np.asarray(offsets, dtype=np.uint64)
+        cdef uint64_t[:] sizes_c = np.asarray(sizes, dtype=np.uint64)
+        cdef Py_ssize_t count = len(order_np)
+        cdef uint64_t max_run = min(self.max_run_bytes, max(1, int(np.sum(sizes_c)) // self.num_threads))
+        run_idx, run_file, run_start, run_end = [], [], [], []
+        cdef Py_ssize_t i, rec
+        cdef uint64_t start = 0, end = 0
+        cdef int file_id = -1
+        for i in range(count):
+            rec = order[i]
+            if i == 0 or file_ids_c[rec] != file_id or offsets_c[rec] > end + self.max_gap_bytes \
+                    or offsets_c[rec] + sizes_c[rec] - start > max_run:
+                if i > 0:
+                    run_file.append(file_id)
+                    run_start.append(start)
+                    run_end.append(end)
+                run_idx.append(i)
+                file_id, start, end = file_ids_c[rec], offsets_c[rec], offsets_c[rec] + sizes_c[rec]
+            else:  # extend the current run (duplicate records may overlap it)
+                end = max(end, offsets_c[rec] + sizes_c[rec])
+        if count > 0:
+            run_file.append(file_id)
+            run_start.append(start)
+            run_end.append(end)
+        run_idx.append(count)
+        return (order_np.astype(np.int64), np.array(run_idx, dtype=np.int64), np.array(run_file, dtype=np.int32),
+                np.array(run_start, dtype=np.uint64), np.array(run_end, dtype=np.uint64))
+
+    # Reads contig features from #file_names and returns a list of {'feature_name', 'feature_data'} dictionaries, for
+    # each contig. Data is read in parallel. For each feature, the data of all contigs is stored in a single array, so
+    # the returned arrays are views into it. Records that can't be decompressed (e.g. because of a wrong size in the
+    # toc) are logged and filled with zeros; files that can't be opened raise an IOError.
+    # Parameters:
+    #   file_names: names of the binary files to read data from, one per contig; file names are not necessarily
+    #           distinct, since each file contains data for many (hundreds) of contigs
+    #   py_lengths: the length of each contig
+    #   py_offsets: the position in the file where the contig data begins
+    #   py_sizes: the size of data in bytes, for each contig
+    #   py_feature_mask: 0/1 mask denoting the features that need to be read
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def read_contigs(self, file_names: List[bytes], py_lengths, py_offsets, py_sizes, py_feature_mask):
+        assert len(file_names) == len(py_lengths) == len(py_offsets) == len(py_sizes)
+        cdef uint32_t contig_count = len(file_names)
+        if contig_count == 0:
+            return []
+        cdef int[:] file_ids = self._file_ids(file_names)
+        cdef uint32_t[:] lengths = np.asarray(py_lengths, dtype=np.uint32)
+        cdef uint64_t[:] offsets = np.asarray(py_offsets, dtype=np.uint64)
+        cdef uint32_t[:] sizes = np.asarray(py_sizes, dtype=np.uint32)
+        cdef uint8_t[:] feature_mask = np.asarray(py_feature_mask, dtype=np.uint8)
+        contig_starts_np = np.concatenate([[0], np.cumsum(py_lengths, dtype=np.int64)])
+        cdef int64_t[:] contig_starts = contig_starts_np
+
+        # one array per feature for all contigs, and a table with the destination of each (contig, feature) pair
+        feature_data = [None] * N_FEATURES
+        cdef char **all_data = <char **> PyMem_Malloc(sizeof(char *) * contig_count * N_FEATURES)
+        cdef char[:] view
+        cdef char *base
+        cdef int feature_size
+        cdef Py_ssize_t feat_idx_c, ctg_idx_c
+        for feat_idx_c in range(N_FEATURES):
+            base = NULL
+            feature_size = feature_sizes[feat_idx_c]
+            if feature_mask[feat_idx_c]:
+                # the extra element avoids taking the address of an empty array
+                feature_data[feat_idx_c] = np.empty(contig_starts[contig_count] + 1, dtype=feature_types[feat_idx_c])
+                view = feature_data[feat_idx_c].view(np.int8)
+                base = &view[0]
+            for ctg_idx_c in range(contig_count):
+                all_data[ctg_idx_c * N_FEATURES + feat_idx_c] = \
+                    base + contig_starts[ctg_idx_c] * feature_size if base != NULL else NULL
+
+        cdef uint8_t feature_sizes_bytes[N_FEATURES]
+        feature_sizes_bytes[:] = feature_sizes
+
+        cdef uint32_t bytes_per_base_c = bytes_per_base
+        cdef const char *data
+        cdef const char *run_data
+        cdef Py_ssize_t run, k
+        cdef int thread
+        failed_np = np.zeros(contig_count, dtype=np.uint8)
+        cdef uint8_t[:] failed = failed_np
+        order_np, run_idx_np, run_file_np, run_start_np, run_end_np = self.plan(file_ids, offsets, sizes)
+        cdef int64_t[:] order = order_np
+        cdef int64_t[:] run_idx = run_idx_np
+        cdef int[:] run_file = run_file_np
+        cdef uint64_t[:] run_start = run_start_np
+        cdef uint64_t[:] run_end = run_end_np
+        cdef Py_ssize_t run_count = len(run_file_np)
+        with nogil:
+            for run in range(run_count):
+                self.c_reader.will_need(run_file[run], run_start[run], run_end[run] - run_start[run])
+        with nogil, parallel(num_threads=self.num_threads):
+            for run in prange(run_count, schedule='dynamic'):
+                thread = cython.parallel.threadid()
+                run_data = self.c_reader.read_range(run_file[run], run_start[run], run_end[run] - run_start[run],
+                                                    thread)
+                for k in range(run_idx[run], run_idx[run + 1]):
+                    ctg_idx_c = order[k]
+                    data = NULL
+                    if run_data != NULL:
+                        data = self.c_reader.decompress(run_data + (offsets[ctg_idx_c] - run_start[run]),
+                                                        sizes[ctg_idx_c], lengths[ctg_idx_c], bytes_per_base_c,
+                                                        thread)
+                    if data == NULL:
+                        failed[ctg_idx_c] = 1
+                    else:
+                        split_features(data, lengths[ctg_idx_c], N_FEATURES, &feature_mask[0],
+                                       &feature_sizes_bytes[0], &all_data[ctg_idx_c * N_FEATURES])
+        PyMem_Free(all_data)
+
+        results = []
+        for ctg_idx in range(contig_count):
+            start, stop = contig_starts_np[ctg_idx], contig_starts_np[ctg_idx + 1]
+            if failed[ctg_idx]:
+                _log_failed_read(file_names[ctg_idx], py_offsets[ctg_idx])
+                for arr in feature_data:
+                    if arr is not None:
+                        arr[start:stop] = 0
+            results.append({feature_name: arr[start:stop] for feature_name, arr in zip(feature_names, feature_data)
+                            if arr is not None})
+        return results
+
+    # Reads the contigs in #file_names and writes the normalized features of the requested intervals directly into the
+    # preallocated batch buffer #x (and #mask), in parallel and without holding the GIL. Decoding, type conversion,
+    # normalization and stacking happen in a single pass over the decompressed data, so no per-feature arrays are
+    # created. The rows of records that can't be decompressed are logged and zeroed.
+    # Parameters:
+    #   file_names, py_lengths, py_offsets, py_sizes: location of each contig, as in read_contigs
+    #   piece_idx: the pieces of contig i are piece_idx[i]:piece_idx[i+1] (so each contig is decompressed only once)
+    #   starts, stops, rows, mask_lengths: for each piece, the interval [start, stop) of the contig is written to
+    #           x[row, :stop-start], the rest of the row is zeroed, and mask[row] is set to 1 for mask_length positions
+    #   conversions: for each feature in #feature_names, a tuple (column, nan_value, scale, mean, stdev, zero_nan),
+    #           where column is -1 for features that are not needed and nan_value is None if the feature has no NaN
+    #           marker
+    #   x: float32 array of shape (rows, max_len, columns)
+    #   mask: uint8 array of shape (rows, mask_width), or None
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def read_contigs_into(self, file_names: List[bytes], py_lengths, py_offsets, py_sizes, piece_idx, starts, stops,
+                          rows, mask_lengths, conversions: List[tuple], float[:, :, ::1] x, uint8_t[:, ::1] mask):
+        assert len(file_names) == len(py_lengths) == len(py_offsets) == len(py_sizes) == len(piece_idx) - 1
+        assert len(starts) == len(stops) == len(rows) == len(mask_lengths) == piece_idx[len(piece_idx) - 1]
+        assert len(conversions) == N_FEATURES
+        if len(rows) and np.max(rows) >= x.shape[0]:
+            raise ValueError(f'Row {np.max(rows)} is out of bounds for a batch of {x.shape[0]} rows')
+        if mask is not None and mask.shape[0] != x.shape[0]:
+            raise ValueError(f'Mask has {mask.shape[0]} rows, expected {x.shape[0]}')
+        cdef uint32_t contig_count = len(file_names)
+        if contig_count == 0:
+            return
+        cdef int[:] file_ids = self._file_ids(file_names)
+        cdef uint32_t[:] lengths = np.asarray(py_lengths, dtype=np.uint32)
+        cdef uint64_t[:] offsets = np.asarray(py_offsets, dtype=np.uint64)
+        cdef uint32_t[:] sizes = np.asarray(py_sizes, dtype=np.uint32)
+        cdef uint64_t[:] piece_idx_c = np.asarray(piece_idx, dtype=np.uint64)
+        # the extra element avoids taking the address of an empty array
+        cdef uint32_t[:] starts_c = np.append(np.asarray(starts, dtype=np.uint32), 0).astype(np.uint32)
+        cdef uint32_t[:] stops_c = np.append(np.asarray(stops, dtype=np.uint32), 0).astype(np.uint32)
+        cdef uint32_t[:] rows_c = np.append(np.asarray(rows, dtype=np.uint32), 0).astype(np.uint32)
+        cdef uint32_t[:] mask_lengths_c = np.append(np.asarray(mask_lengths, dtype=np.uint32), 0).astype(np.uint32)
+
+        cdef FeatureConversion conv[N_FEATURES]
+        for i, (column, nan_value, scale, mean, stdev, zero_nan) in enumerate(conversions):
+            conv[i].column = column
+            conv[i].type = feature_type_codes[i]
+            conv[i].has_nan_value = nan_value is not None
+            conv[i].nan_value = nan_value if nan_value is not None else 0
+            conv[i].scale = scale
+            conv[i].mean = mean
+            conv[i].stdev = stdev
+            conv[i].zero_nan = zero_nan
+
+        cdef BatchBuffer batch
+        batch.x = &x[0, 0, 0] if x.shape[0] * x.shape[1] * x.shape[2] > 0 else NULL
+        batch.max_len = x.shape[1]
+        batch.num_columns = x.shape[2]
+        batch.mask = NULL
+        batch.mask_width = 0
+        if mask is not None and mask.shape[1] > 0:
+            batch.mask = &mask[0, 0]
+            batch.mask_width = mask.shape[1]
+
+        cdef uint8_t feature_sizes_bytes[N_FEATURES]
+        feature_sizes_bytes[:] = feature_sizes
+
+        cdef uint64_t first
+        cdef uint32_t bytes_per_base_c = bytes_per_base
+        cdef const char *data
+        cdef const char *run_data
+        cdef Py_ssize_t run, k, ctg_idx_c
+        cdef int thread
+        failed_np = np.zeros(contig_count, dtype=np.uint8)
+        cdef uint8_t[:] failed = failed_np
+        order_np, run_idx_np, run_file_np, run_start_np, run_end_np = self.plan(file_ids, offsets, sizes)
+        cdef int64_t[:] order = order_np
+        cdef int64_t[:] run_idx = run_idx_np
+        cdef int[:] run_file = run_file_np
+        cdef uint64_t[:] run_start = run_start_np
+        cdef uint64_t[:] run_end = run_end_np
+        cdef Py_ssize_t run_count = len(run_file_np)
+        with nogil:
+            for run in range(run_count):
+                self.c_reader.will_need(run_file[run], run_start[run], run_end[run] - run_start[run])
+        with nogil, parallel(num_threads=self.num_threads):
+            for run in prange(run_count, schedule='dynamic'):
+                thread = cython.parallel.threadid()
+                run_data = self.c_reader.read_range(run_file[run], run_start[run], run_end[run] - run_start[run],
+                                                    thread)
+                for k in range(run_idx[run], run_idx[run + 1]):
+                    ctg_idx_c = order[k]
+                    data = NULL
+                    if run_data != NULL:
+                        data = self.c_reader.decompress(run_data + (offsets[ctg_idx_c] - run_start[run]),
+                                                        sizes[ctg_idx_c], lengths[ctg_idx_c], bytes_per_base_c,
+                                                        thread)
+                    if data == NULL:
+                        failed[ctg_idx_c] = 1
+                    else:
+                        first = piece_idx_c[ctg_idx_c]
+                        write_contig_into(data, lengths[ctg_idx_c], N_FEATURES, &feature_sizes_bytes[0], &conv[0],
+                                          piece_idx_c[ctg_idx_c + 1] - first, &starts_c[first], &stops_c[first],
+                                          &rows_c[first], &mask_lengths_c[first], batch)
+
+        for ctg_idx in np.flatnonzero(failed_np):
+            _log_failed_read(file_names[ctg_idx], py_offsets[ctg_idx])
+            for piece in range(piece_idx[ctg_idx], piece_idx[ctg_idx + 1]):
+                x[rows_c[piece], :, :] = 0
+                if mask is not None:
+                    mask[rows_c[piece], :] = 0
+                    mask[rows_c[piece], :mask_lengths_c[piece]] = 1
+
+
 # Reads contig features from #file_names and returns a list of {'feature_name', 'feature_data'} dictionaries, for each
-# contig. Data is read in parallel (using Cython bindings).
-# Parameters:
-#   file_names: names of the binary files to read data from, one per contig; file names are not necessarily distinct,
-#           since each file contains data for many (hundreds) of contigs
-#   py_lengths: the length of each contig
-#   py_offsets: the position in the file where the contig data begins
-#   py_sizes: the size of data in bytes, for each contig (used to allocate memory in the C code)
-#   py_feature_mask: 0/1 mask denoting the features that need to be read
-#   num_threads: how many threads to use to read the data
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def read_contigs_py(file_names:List[bytes], py_lengths: List[int],  py_offsets: List[int],  py_sizes: List[int],
+# contig, using a temporary FeatureReader with #num_threads threads. See FeatureReader.read_contigs.
+def read_contigs_py(file_names: List[bytes], py_lengths: List[int], py_offsets: List[int], py_sizes: List[int],
                     py_feature_mask: List[int], int num_threads):
-    assert len(file_names) == len(py_lengths) == len(py_offsets) == len(py_sizes)
-    cdef uint32_t contig_count = len(file_names)
-    cdef int max_len = max(py_lengths)
-    cdef int[:] lengths = array('i', py_lengths)
-    cdef uint64_t[:] offsets = array('L', py_offsets)
-    cdef int[:] sizes = array('i', py_sizes)
-    cdef uint8_t[:] feature_mask = array('B', py_feature_mask)
-    # the buffer used by the C++ code to write the features into; one buffer per contig; for each contig one buffer
-    # per feature
-    cdef char ***all_data = <char ***> PyMem_Malloc(sizeof(char **) * contig_count)
-
-    py_all_data = [None] * contig_count
-    cdef uint32_t[2] arr_len
-    cdef char[:] view
-    views = [] # keep all views in a list to avoid garbage collection
-    for ctg_idx in range(contig_count):
-        np_data = [None] * N_FEATURES
-        np_data_int8 = [None] * N_FEATURES
-        all_data[ctg_idx] = <char **> PyMem_Malloc(sizeof(char **) * N_FEATURES)
-        for feat_idx in range(N_FEATURES):
-            if feature_mask[feat_idx]:
-                np_data[feat_idx] = np.empty(lengths[ctg_idx], dtype=feature_types[feat_idx])
-                view = np_data[feat_idx].view(np.int8)
-                views.append(view)
-                all_data[ctg_idx][feat_idx] = &view[0]
-            else:
-                all_data[ctg_idx][feat_idx] = NULL
-        py_all_data[ctg_idx] = np_data
-
-    cdef uint8_t feature_sizes_bytes[N_FEATURES]
-    feature_sizes_bytes[:] = feature_sizes
+    return FeatureReader(num_threads).read_contigs(file_names, py_lengths, py_offsets, py_sizes, py_feature_mask)
 
 
-    cdef char ** c_file_names = <char **>PyMem_Malloc(sizeof(char*) * contig_count)
-    for i in range(contig_count):
-        c_file_names[i] = PyBytes_AS_STRING(file_names[i])
-
-    # This is the code that is actually parallelized
-    cdef Py_ssize_t ctg_idx_c
-    cdef uint32_t bytes_per_base_c = bytes_per_base
-    cdef char * buf
-    with nogil, parallel(num_threads = num_threads):
-        # the buffer used by the C++ code to unzip the data (one buffer for each thread)
-        buf = <char *> malloc(sizeof(char) * max_len * bytes_per_base_c + 4)
-        for ctg_idx_c in prange(contig_count, schedule='guided'):
-            read_contig_features_buf(c_file_names[ctg_idx_c], offsets[ctg_idx_c], sizes[ctg_idx_c], lengths[ctg_idx_c],
-                                 N_FEATURES, bytes_per_base_c, &feature_mask[0], &feature_sizes_bytes[0],
-                                 buf, all_data[ctg_idx_c], cython.parallel.threadid())
-        free(buf)
-
-    results = []
-    for ctg_idx in range(contig_count):
-        results.append({feature_name: data for feature_name, data in zip(feature_names, py_all_data[ctg_idx])
-                        if data is not None })
-
-    for feat_idx in range(contig_count):
-        PyMem_Free(all_data[feat_idx])
-    PyMem_Free(all_data)
-    PyMem_Free(c_file_names)
-    return results
+# Writes the normalized features of the given contig intervals into #x using a temporary FeatureReader with
+# #num_threads threads. See FeatureReader.read_contigs_into.
+def read_contigs_into_py(file_names: List[bytes], py_lengths, py_offsets, py_sizes, piece_idx, starts, stops, rows,
+                         mask_lengths, conversions: List[tuple], x, mask, int num_threads):
+    FeatureReader(num_threads).read_contigs_into(file_names, py_lengths, py_offsets, py_sizes, piece_idx, starts,
+                                                 stops, rows, mask_lengths, conversions, x, mask)
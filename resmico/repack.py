@@ -0,0 +1,241 @@
+"""
+Repacks a data set made of many small feature directories (each with its own features_binary, toc and stats files, as
+written by bam2feat) into a few large shards, so that training opens few files and reads long sequential ranges.
+
+Each shard is a regular feature directory (shard_00000, shard_00001, ...) containing:
+    - features_binary: the compressed contig records, copied as they are (without re-encoding)
+    - toc, toc_binary, toc_index, toc_chunked: as for bam2feat output, with an additional source column
+    - sources: the original directories of the contigs in the shard (one per line); contig names and original
+      directories are preserved, so the output of `resmico evaluate` is the same as for the original data set
+    - stats: the stats of the original directories, apportioned to the shards by the number of bases, so that the
+      totals (and thus the global means/stdevs) are the same as for the original data set
+The output directory also contains a catalog of the shards (catalog.json, which can be passed to
+--feature-files-path) and the merged feature means/stdevs (stats.json, which can be passed to --stats-file).
+"""
+import copy
+import csv
+import json
+import logging
+import os
+import shutil
+from timeit import default_timer as timer
+from typing import Dict, List
+
+import numpy as np
+
+from resmico import catalog
+from resmico import contig_reader
+from resmico import reader
+from resmico import toc
+from resmico.contig_reader import ContigMetadata, ContigReader
+
+# the maximum number of bytes copied at once from a source file
+_COPY_BYTES = 1 << 26
+TOC_HEADER = 'Contig\tLengthBases\tMisassemblCnt\tSizeBytes\tBreaking_points\tAvg_Coverage\tSource\n'
+TOC_CHUNKED_HEADER = 'Contig\tStart\tStop\tMisassemblyCnt\tBreakingPoints\tSource\n'
+
+
+def _split_stats(stats, weights: np.ndarray) -> List:
+    """
+    Splits the numbers in stats (the content of a stats file) proportionally to weights. The parts of each number add
+    up to the original value, and integers stay integers (histogram counts are apportioned bin by bin).
+    """
+    if isinstance(stats, dict) and 'counts' in stats:  # a histogram: only the counts are split, bin by bin
+        return [dict(stats, counts=counts) for counts in _split_stats(stats['counts'], weights)]
+    if isinstance(stats, dict):
+        parts = [{} for _ in weights]
+        for key, value in stats.items():
+            for part, value_part in zip(parts, _split_stats(value, weights)):
+                part[key] = value_part
+        return parts
+    if isinstance(stats, list):
+        return [list(part) for part in zip(*[_split_stats(value, weights) for value in stats])] if stats else \
+            [[] for _ in weights]
+    if isinstance(stats, bool) or not isinstance(stats, (int, float)):
+        return [copy.deepcopy(stats) for _ in weights]
+    fractions = weights / weights.sum()
+    if isinstance(stats, int):
+        # rounding the cumulative sums keeps the parts non-negative and adding up exactly to stats
+        cumulative = [0] + [int(round(stats * f)) for f in np.cumsum(fractions[:-1])] + [stats]
+        return [b - a for a, b in zip(cumulative[:-1], cumulative[1:])]
+    parts = [stats * f for f in fractions[:-1]]
+    # the last part gets the remainder, so that no rounding error is introduced in the totals
+    return parts + [stats - sum(parts)]
+
+
+def _add_stats(total, stats):
+    """ Adds the numbers in stats to total (missing entries count as zero) and returns the result """
+    if total is None:
+        return copy.deepcopy(stats)
+    if isinstance(stats, dict) and 'counts' in stats:
+        return dict(total, counts=[t + s for t, s in zip(total['counts'], stats['counts'])])
+    if isinstance(stats, dict):
+        for key, value in stats.items():
+            total[key] = _add_stats(total.get(key), value)
+        return total
+    if isinstance(stats, bool) or not isinstance(stats, (int, float)):
+        return total
+    return total + stats
+
+
+def _format_breakpoints(breakpoints) -> str:
+    return '-' if len(breakpoints) == 0 else ','.join(f'{b[0]}-{b[1]}' for b in breakpoints)
+
+
+def _read_chunks(toc_file: str, contig_fname: str) -> Dict[tuple, List[List[str]]]:
+    """ Returns the rows of the toc_chunked file toc_file, grouped by (source, contig name) """
+    result: Dict[tuple, List[List[str]]] = {}
+    if not os.path.exists(toc_file):
+        return result
+    sources = toc.read_sources(toc_file)
+    with open(toc_file) as f:
+        rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = next(rd, None)
+        if header is None or 'SizeBytes' in header:  # old chunk format, see ContigReader.load_chunks
+            return result
+        for row in rd:
+            source = os.path.dirname(contig_fname) if sources is None else sources[int(row[5])]
+            result.setdefault((source, row[0]), []).append(row[:5])
+    return result
+
+
+def _order(metadata: ContigMetadata, order: str) -> np.ndarray:
+    """ Returns the order in which the contigs are written to the shards """
+    if order == 'source':
+        return np.arange(len(metadata))
+    if order == 'length':
+        return np.argsort(metadata.lengths, kind='stable')
+    if order == 'class':  # contigs with no misassemblies first, ordered by length within each class
+        return np.lexsort((metadata.lengths, metadata.misassembly != 0))
+    raise ValueError(f'Unknown order: {order}')
+
+
+def _copy_records(metadata: ContigMetadata, indices: np.ndarray, out_file: str):
+    """
+    Copies the records of the contigs at indices to out_file, merging adjacent records into a single read. Only one
+    source file is open at a time, as a shard can draw from thousands of source directories (e.g. with order=length).
+    """
+    f, f_name = None, None
+    try:
+        with open(out_file, 'wb') as out:
+            pos = 0
+            while pos < len(indices):
+                idx = indices[pos]
+                file_name = metadata.files[metadata.file_ids[idx]]
+                start = end = int(metadata.offsets[idx])
+                # extend the range with the following records as long as they are adjacent in the same file
+                while pos < len(indices) and metadata.files[metadata.file_ids[indices[pos]]] == file_name and \
+                        metadata.offsets[indices[pos]] == end:
+                    end += int(metadata.sizes[indices[pos]])
+                    pos += 1
+                if file_name != f_name:
+                    if f is not None:
+                        f.close()
+                    f, f_name = open(file_name, 'rb'), file_name
+                f.seek(start)
+                while start < end:
+                    data = f.read(min(_COPY_BYTES, end - start))
+                    if not data:
+                        raise IOError(f'{file_name} is shorter than listed in its toc')
+                    out.write(data)
+                    start += len(data)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def _write_shard(shard_dir: str, metadata: ContigMetadata, indices: np.ndarray, chunks: Dict[tuple, List[List[str]]],
+                 stats):
+    """ Writes the contigs at indices (in this order) and their chunks and stats to a new feature directory """
+    tmp_dir = shard_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    _copy_records(metadata, indices, os.path.join(tmp_dir, 'features_binary'))
+
+    sources = list(dict.fromkeys(metadata.sources[metadata.file_ids[i]] for i in indices))
+    source_ids = {s: i for i, s in enumerate(sources)}
+    with open(os.path.join(tmp_dir, 'sources'), 'w') as f:
+        f.writelines(s + '\n' for s in sources)
+    with open(os.path.join(tmp_dir, 'toc'), 'w') as toc_out, \
+            open(os.path.join(tmp_dir, 'toc_chunked'), 'w') as chunk_out:
+        toc_out.write(TOC_HEADER)
+        chunk_out.write(TOC_CHUNKED_HEADER)
+        for i in indices:
+            contig = metadata[i]
+            source_id = source_ids[contig.source]
+            toc_out.write(f'{contig.name}\t{contig.length}\t{contig.misassembly}\t{contig.size_bytes}\t'
+                          f'{_format_breakpoints(contig.breakpoints)}\t{contig.avg_coverage}\t{source_id}\n')
+            for row in chunks.get((contig.source, contig.name), []):
+                chunk_out.write('\t'.join(row + [str(source_id)]) + '\n')
+    toc.write_binary_toc(os.path.join(tmp_dir, 'toc'), os.path.join(tmp_dir, 'toc_binary'))
+    toc.write_name_index(os.path.join(tmp_dir, 'toc_binary'), os.path.join(tmp_dir, 'toc_index'))
+    with open(os.path.join(tmp_dir, 'stats'), 'w') as f:
+        json.dump(stats, f, indent=2)
+    os.replace(tmp_dir, shard_dir)
+
+
+def repack(input_dirs: str, out_dir: str, shard_size_bytes: int, order: str = 'source', feature_file_match: str = ''):
+    """
+    Repacks the feature directories found in input_dirs (see contig_reader.find_stats_files) into shards of about
+    shard_size_bytes each in out_dir.
+    Arguments:
+        - order: the order of the contigs in the shards: 'source' keeps the original order, 'length' orders by contig
+          length, 'class' puts the contigs without misassemblies first (each class ordered by length)
+    Returns:
+        - the number of shards written
+    """
+    start = timer()
+    if os.path.isdir(out_dir) and os.listdir(out_dir):
+        raise ValueError(f'Output directory {out_dir} is not empty')
+    os.makedirs(out_dir, exist_ok=True)
+    file_list, stats_list = contig_reader.find_stats_files(input_dirs, feature_file_match)
+    if stats_list is None:
+        stats_list = []
+        for fname in file_list:
+            with open(fname) as f:
+                stats_list.append(json.load(f))
+
+    parts = []
+    chunks: Dict[tuple, List[List[str]]] = {}
+    for fname in file_list:
+        base = fname[:-len('stats')]
+        parts.append(ContigReader._read_metadata(base + 'toc', base + 'features_binary'))
+        chunks.update(_read_chunks(base + 'toc_chunked', base + 'features_binary'))
+    metadata = ContigMetadata.concatenate(parts)
+    # the position in file_list of the directory containing each contig
+    input_ids = np.repeat(np.arange(len(parts)), [len(p) for p in parts])
+    logging.info(f'Found {len(metadata)} contigs in {len(file_list)} directories')
+
+    ordered = _order(metadata, order)
+    # a new shard starts at the first record that starts after the shard size is reached
+    record_starts = np.cumsum(metadata.sizes[ordered]) - metadata.sizes[ordered]
+    _, shard_ids = np.unique(record_starts // shard_size_bytes, return_inverse=True)
+    shard_count = int(shard_ids.max()) + 1 if len(ordered) else 0
+
+    # apportion the stats of each input directory to the shards by the number of bases
+    shard_stats = [None] * shard_count
+    bases = np.zeros((len(parts), shard_count))
+    np.add.at(bases, (input_ids[ordered], shard_ids), metadata.lengths[ordered])
+    for input_id, stats in enumerate(stats_list):
+        shards = np.flatnonzero(bases[input_id])
+        if len(shards) == 0:
+            logging.warning(f'No contigs found for {file_list[input_id]}, its stats are dropped')
+            continue
+        for shard, stats_part in zip(shards, _split_stats(stats, bases[input_id][shards])):
+            shard_stats[shard] = _add_stats(shard_stats[shard], stats_part)
+
+    for shard in range(shard_count):
+        shard_dir = os.path.join(out_dir, f'shard_{shard:05d}')
+        _write_shard(shard_dir, metadata, ordered[shard_ids == shard], chunks, shard_stats[shard])
+        logging.info(f'Wrote {shard_dir}')
+
+    catalog.register(os.path.join(out_dir, 'catalog.json'), [out_dir])
+    # computes the global means/stdevs of the shards and saves them to out_dir/stats.json
+    ContigReader(out_dir, reader.feature_names, 1, load_metadata=False)
+    logging.info(f'Repacked {len(metadata)} contigs into {shard_count} shards in {(timer() - start):5.2f}s')
+    return shard_count
+
+
+def main(args):
+    repack(args.feature_files_path, args.outdir, int(args.shard_size_gb * 1e9), args.order, args.feature_file_match)
@@ -0,0 +1,149 @@
+"""
+Persistent on-disk cache of normalized feature tensors. For each features_binary file, the stacked and normalized
+feature matrix of every contig is materialized once into a memory-mapped .npy file (e.g. on a local SSD); subsequent
+reads (in the same or in later runs) are zero-copy slices into the mapping.
+
+A cache entry is keyed by the (expanded) feature names, the storage dtype, the feature means/stdevs (i.e. the content
+of the stats file used for normalization) and the identity (path, size, modification time) of the source
+features_binary file, so changing any of them creates a new entry rather than returning stale data.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from timeit import default_timer as timer
+from typing import Dict, List
+
+import numpy as np
+
+from resmico.contig_reader import ContigMetadata, ContigReader, open_files_limit
+
+# number of contigs that are read at once when populating the cache
+_READ_BATCH = 256
+
+
+class TensorCache:
+    def __init__(self, cache_dir: str, reader: ContigReader, expanded_feature_names: List[str],
+                 dtype: str = 'float32'):
+        """
+        Arguments:
+            - cache_dir: directory where the cached tensors are stored (preferably on a local SSD)
+            - reader: the reader used to load (and normalize) the contig features that are not yet cached
+            - expanded_feature_names: the feature names in the order of the columns of the cached matrices
+            - dtype: storage type of the cached features, float32 or float16
+        """
+        if dtype not in ('float32', 'float16'):
+            raise ValueError(f'Unsupported tensor cache dtype: {dtype}')
+        self.cache_dir = cache_dir
+        self.reader = reader
+        self.expanded_feature_names = expanded_feature_names
+        self.dtype = np.dtype(dtype)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.feature_key = json.dumps({'features': expanded_feature_names, 'dtype': dtype, 'means': reader.means,
+                                       'stdevs': reader.stdevs}, sort_keys=True)
+        # maps a file id in reader.metadata.files to (data, contig offsets in features_binary, row starts); each
+        # memory-mapped data file holds a file descriptor, so at most #open_files_limit of them are kept (least
+        # recently used first)
+        self.stores: Dict[int, tuple] = OrderedDict()
+        # guards #stores and #_file_locks
+        self._lock = threading.Lock()
+        # serialize opening (and populating) the entry of each file when batches are built concurrently (see
+        # make_tf_dataset), without blocking the reads from other files
+        self._file_locks: Dict[int, threading.Lock] = {}
+
+    def __getstate__(self):
+        # the memory-mapped files and the locks are not shared with other processes (e.g. the batch workers)
+        state = self.__dict__.copy()
+        state['stores'] = OrderedDict()
+        state['_file_locks'] = {}
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _key(self, source_file: str):
+        stat = os.stat(source_file)
+        source_id = f'{os.path.abspath(source_file)}:{stat.st_size}:{stat.st_mtime_ns}'
+        return hashlib.sha1((self.feature_key + source_id).encode('utf-8')).hexdigest()
+
+    def _open(self, file_id: int):
+        with self._lock:
+            store = self.stores.get(file_id)
+            if store is not None:
+                self.stores.move_to_end(file_id)
+                return store
+            file_lock = self._file_locks.setdefault(file_id, threading.Lock())
+        with file_lock:
+            with self._lock:
+                store = self.stores.get(file_id)
+            if store is None:
+                store = self._load(file_id)
+                with self._lock:
+                    # evicted mappings are closed once the arrays returned by #read are released
+                    while len(self.stores) >= open_files_limit():
+                        self.stores.popitem(last=False)
+                    self.stores[file_id] = store
+        return store
+
+    def _load(self, file_id: int):
+        source_file = self.reader.metadata.files[file_id]
+        base = os.path.join(self.cache_dir, self._key(source_file))
+        # the index is written last, so its presence means that the entry is complete
+        if not os.path.exists(base + '.idx.npy'):
+            self._populate(source_file, base)
+        index = np.load(base + '.idx.npy')
+        return np.load(base + '.npy', mmap_mode='r'), index[0], index[1]
+
+    def _populate(self, source_file: str, base: str):
+        """ Reads all contigs in source_file and writes their normalized, stacked features to the cache """
+        start = timer()
+        toc_file = os.path.join(os.path.dirname(source_file), 'toc')
+        binary_toc = self.reader._open_binary_toc(toc_file)
+        if binary_toc is not None:
+            records = binary_toc.records
+            contigs = ContigMetadata([''] * len(records), [source_file], np.zeros(len(records)), records['length'],
+                                     records['offset'], records['size_bytes'], records['misassembly'],
+                                     records['avg_coverage'], np.zeros(len(records) + 1), [])
+        else:
+            contigs = self.reader._read_toc(toc_file, source_file)
+        row_starts = np.concatenate([[0], np.cumsum(contigs.lengths)]).astype(np.int64)
+
+        tmp_data = f'{base}.{os.getpid()}.tmp.npy'
+        data = np.lib.format.open_memmap(tmp_data, mode='w+', dtype=self.dtype,
+                                         shape=(int(row_starts[-1]), len(self.expanded_feature_names)))
+        for batch_start in range(0, len(contigs), _READ_BATCH):
+            batch = contigs[batch_start:batch_start + _READ_BATCH]
+            for i, features in enumerate(self.reader.read_contigs(batch), start=batch_start):
+                rows = data[row_starts[i]:row_starts[i + 1]]
+                for j, feature_name in enumerate(self.expanded_feature_names):
+                    column = features[feature_name]
+                    if self.dtype == np.float16:  # avoid overflowing to inf
+                        column = np.clip(column, np.finfo(np.float16).min, np.finfo(np.float16).max)
+                    rows[:, j] = column
+        data.flush()
+        del data
+        os.replace(tmp_data, base + '.npy')
+
+        tmp_index = f'{base}.{os.getpid()}.tmp.idx.npy'
+        np.save(tmp_index, np.stack([contigs.offsets, row_starts[:-1]]))
+        os.replace(tmp_index, base + '.idx.npy')
+        logging.info(f'Cached {len(contigs)} contigs of {source_file} in {(timer() - start):5.2f}s')
+
+    def read(self, indices) -> List[np.ndarray]:
+        """
+        Returns the stacked normalized features of shape (contig_len, len(expanded_feature_names)) for the contigs at
+        the given indices in the reader. The arrays are read-only views into the memory-mapped cache.
+        """
+        metadata = self.reader.metadata
+        result = []
+        for idx in indices:
+            data, offsets, row_starts = self._open(int(metadata.file_ids[idx]))
+            pos = np.searchsorted(offsets, metadata.offsets[idx])
+            assert offsets[pos] == metadata.offsets[idx], 'Contig not found in the tensor cache'
+            row_start = row_starts[pos]
+            result.append(data[row_start:row_start + metadata.lengths[idx]])
+        return result
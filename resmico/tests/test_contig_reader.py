@@ -1,15 +1,58 @@
+import contextlib
+import json
 import os
+import pickle
+import random
+import resource
+import shutil
+import tempfile
+import threading
 import numpy as np
 import unittest
+import unittest.mock
 
+from resmico import add_stats
+from resmico import catalog
+from resmico import chunks
+from resmico import histograms
 from resmico import contig_reader
+from resmico import lookup
 from resmico import reader
+from resmico import repack
+from resmico import tensor_cache
+from resmico import toc
 
 test_dir = os.path.join(os.path.dirname(__file__))
 data_dir = os.path.join(test_dir, 'data')
 FEAT_DIR = os.path.join(data_dir, 'preprocess')
 INFILE = os.path.join(FEAT_DIR, 'features_binary')
 
+
+@contextlib.contextmanager
+def _low_open_files_limit():
+    """ Temporarily lowers the soft limit on open files to (about) twice the number of currently open files """
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = 2 * len(os.listdir('/proc/self/fd')) + 20
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard_limit))
+    try:
+        yield limit
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft_limit, hard_limit))
+
+
+def _sample_dirs(out_dir: str, count: int) -> str:
+    """ Creates #count feature directories linking to the files in FEAT_DIR and returns a file listing them """
+    file_list = os.path.join(out_dir, 'file_list.txt')
+    with open(file_list, 'w') as f:
+        for i in range(count):
+            sample_dir = os.path.join(out_dir, f's{i}')
+            os.makedirs(sample_dir)
+            for fname in ['stats', 'toc', 'features_binary']:
+                os.symlink(os.path.join(FEAT_DIR, fname), os.path.join(sample_dir, fname))
+            f.write(os.path.join(sample_dir, 'stats') + '\n')
+    return file_list
+
+
 class TestReadContig(unittest.TestCase):
     def test_read_from_file(self):
         input_file = open(INFILE, 'rb')
@@ -138,5 +181,437 @@ class TestReadContig(unittest.TestCase):
             self.assertEqual(2 if 420 <= pos < 425 or pos < 5 else 0, coverage[pos])
             self.assertEqual(0.5 if 420 <= pos < 425 else 0, result[0]['num_query_C'][pos])
 
+    def test_feature_reader(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, process_count=1, no_cython=True)
+        expected = ctg_reader.read_contigs(ctg_reader.contigs)
+        contigs = list(ctg_reader.contigs)
+        args = ([c.file.encode('utf-8') for c in contigs], [c.length for c in contigs], [c.offset for c in contigs],
+                [c.size_bytes for c in contigs], [1] * len(reader.feature_names))
+        # the same reader is reused across calls, with more threads than contigs
+        feature_reader = reader.FeatureReader(4)
+        for _ in range(3):
+            for features, expected_features in zip(feature_reader.read_contigs(*args), expected):
+                processed = contig_reader._post_process_features(features)
+                ctg_reader._normalize(processed)
+                for feature_name, data in expected_features.items():
+                    self.assertIsNone(np.testing.assert_array_equal(data, processed[feature_name]))
+        self.assertEqual([], feature_reader.read_contigs([], [], [], [], args[4]))
+        with self.assertRaises(IOError):
+            feature_reader.read_contigs([b'/non/existing/features_binary'], [500], [0], [256], args[4])
+        # a wrong record size is detected, and zeros are returned instead of garbage
+        with self.assertLogs(level='WARNING'):
+            result = feature_reader.read_contigs(args[0][:1], [400], args[2][:1], args[3][:1], args[4])
+        self.assertEqual(400, len(result[0]['coverage']))
+        self.assertFalse(np.any(result[0]['coverage']))
+
+    def test_feature_reader_coalescing(self):
+        # records 0, 2 and 3 are adjacent (or close enough) in file 0, record 1 is in another file
+        order, run_idx, run_file, run_start, run_end = reader.FeatureReader(1, 10, 1000).plan([0, 1, 0, 0, 0], [100, 0, 0, 205, 500],
+                                                                           [100, 50, 100, 50, 50])
+        self.assertEqual([2, 0, 3, 4, 1], order.tolist())
+        self.assertEqual([0, 3, 4, 5], run_idx.tolist())
+        self.assertEqual([0, 0, 1], run_file.tolist())
+        self.assertEqual([(0, 255), (500, 550), (0, 50)], list(zip(run_start.tolist(), run_end.tolist())))
+        # runs are split so that each thread gets work
+        feature_reader = reader.FeatureReader(2, max_gap_bytes=10, max_run_bytes=1000)
+        _, run_idx, _, _, _ = feature_reader.plan([0] * 4, [0, 100, 200, 300], [100] * 4)
+        self.assertEqual([0, 2, 4], run_idx.tolist())
+
+        # the results come back in the caller's order, also for duplicate and unordered requests
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, process_count=1, no_cython=True)
+        expected = ctg_reader.read_contigs(ctg_reader.contigs)
+        contigs = [ctg_reader.contigs[i] for i in [1, 0, 1]]
+        result = feature_reader.read_contigs([c.file.encode('utf-8') for c in contigs], [c.length for c in contigs],
+                                             [c.offset for c in contigs], [c.size_bytes for c in contigs],
+                                             [1] * len(reader.feature_names))
+        for features, expected_features in zip(result, [expected[i] for i in [1, 0, 1]]):
+            processed = contig_reader._post_process_features(features)
+            ctg_reader._normalize(processed)
+            for feature_name, data in expected_features.items():
+                self.assertIsNone(np.testing.assert_array_equal(data, processed[feature_name]))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Counting the open files requires /proc')
+    def test_read_many_files(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, ['coverage'], process_count=1)
+        expected = ctg_reader.read_contigs(ctg_reader.contigs, return_raw=True)
+        with tempfile.TemporaryDirectory() as tmp_dir, _low_open_files_limit() as limit:
+            # more feature files than can be open at the same time
+            file_list = _sample_dirs(tmp_dir, limit + 10)
+            for no_cython in [False, True]:
+                many_reader = contig_reader.ContigReader(file_list, ['coverage'], process_count=2, stats_file='',
+                                                         no_cython=no_cython)
+                self.assertEqual(2 * (limit + 10), len(many_reader))
+                # twice, so that the files that were closed are opened again
+                for _ in range(2):
+                    for i, features in enumerate(many_reader.read_contigs(many_reader.contigs, return_raw=True)):
+                        self.assertIsNone(
+                            np.testing.assert_array_equal(expected[i % 2]['coverage'], features['coverage']))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Counting the open files requires /proc')
+    def test_tensor_cache_many_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, _low_open_files_limit() as limit:
+            in_dir = os.path.join(tmp_dir, 'samples')
+            os.makedirs(in_dir)
+            file_list = _sample_dirs(in_dir, limit + 10)
+            ctg_reader = contig_reader.ContigReader(file_list, ['coverage'], process_count=1, stats_file='')
+            cache = tensor_cache.TensorCache(os.path.join(tmp_dir, 'cache'), ctg_reader, ['coverage'])
+            expected = ctg_reader.read_contigs(ctg_reader.contigs[:2])
+            # the arrays are views into the mapped files, so they are read one batch (contig) at a time, as in training
+            for _ in range(2):
+                for i in range(len(ctg_reader)):
+                    data = cache.read([i])[0]
+                    self.assertIsNone(np.testing.assert_array_equal(expected[i % 2]['coverage'], data[:, 0]))
+                self.assertLessEqual(len(cache.stores), contig_reader.open_files_limit())
+
+    def test_tensor_cache_concurrent_populate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_list = _sample_dirs(tmp_dir, 2)
+            ctg_reader = contig_reader.ContigReader(file_list, ['coverage'], process_count=1, stats_file='')
+            cache = tensor_cache.TensorCache(os.path.join(tmp_dir, 'cache'), ctg_reader, ['coverage'])
+            populate = cache._populate
+            release = threading.Event()
+
+            def slow_populate(source_file, base):
+                if source_file == ctg_reader.metadata.files[1]:
+                    release.wait()
+                populate(source_file, base)
+
+            with unittest.mock.patch.object(cache, '_populate', slow_populate):
+                slow_read = threading.Thread(target=cache.read, args=([2],))
+                slow_read.start()
+                # populating the entry of the second file doesn't block the reads from the first one
+                fast_read = threading.Thread(target=cache.read, args=([0],))
+                fast_read.start()
+                fast_read.join(timeout=30)
+                fast_read_blocked = fast_read.is_alive()
+                release.set()
+                slow_read.join()
+                fast_read.join()
+            self.assertFalse(fast_read_blocked)
+            self.assertEqual(2, len(cache.stores))
+
+    def test_read_no_cython(self):
+        expected = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        expected_features = expected.read_contigs(expected.contigs)
+        for process_count in [1, 2]:
+            ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, process_count, no_cython=True)
+            result = ctg_reader.read_contigs(ctg_reader.contigs)
+            self.assertEqual(len(expected_features), len(result))
+            for features, cython_features in zip(result, expected_features):
+                self.assertEqual(cython_features.keys(), features.keys())
+                for feature_name, data in cython_features.items():
+                    self.assertIsNone(np.testing.assert_array_equal(data, features[feature_name]))
+        # a record passed as bytes is decoded the same way as a record read from a file; only the requested features
+        # (plus the reference base and coverage) are returned
+        contig = expected.contigs[1]
+        with open(contig.file, 'rb') as f:
+            f.seek(contig.offset)
+            from_file = contig_reader._read_contig_data(f, ['num_SNPs'])
+            f.seek(contig.offset)
+            from_bytes = contig_reader._read_contig_data(f.read(contig.size_bytes), ['num_SNPs'])
+        self.assertEqual({'ref_base_A', 'ref_base_C', 'ref_base_G', 'ref_base_T', 'coverage', 'num_SNPs'},
+                         set(from_bytes.keys()))
+        for feature_name, data in from_file.items():
+            self.assertIsNone(np.testing.assert_array_equal(data, from_bytes[feature_name]))
+
+    def test_read_chunks(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, ['coverage', 'num_query_C'], process_count=1)
+        chunk_infos = ctg_reader.load_chunks()
+
+        self.assertEqual(2, len(chunk_infos))
+        self.assertEqual(0, chunk_infos[0].contig_idx)
+        self.assertEqual((98, 103), (chunk_infos[0].start, chunk_infos[0].stop))
+        self.assertEqual(1, chunk_infos[0].misassembly)
+        self.assertEqual([(2, 4)], chunk_infos[0].breakpoints)
+        self.assertEqual(1, chunk_infos[1].contig_idx)
+        self.assertEqual(0, chunk_infos[1].misassembly)
+
+        # the same contig is used by two chunks, but read only once
+        chunk_infos.append(contig_reader.ChunkInfo(0, 418, 423, 0, []))
+        result = ctg_reader.read_chunks(chunk_infos)
+        full = ctg_reader.read_contigs(ctg_reader.contigs)
+        self.assertEqual(3, len(result))
+        for chunk, features in zip(chunk_infos, result):
+            self.assertEqual(2, len(features))
+            for feature_name, data in features.items():
+                self.assertEqual(5, len(data))
+                self.assertIsNone(
+                    np.testing.assert_array_equal(full[chunk.contig_idx][feature_name][chunk.start:chunk.stop], data))
+
+    def test_read_into(self):
+        expanded_names = ['ref_base_A', 'ref_base_C', 'ref_base_G', 'ref_base_T'] + reader.feature_names[1:]
+        for no_cython in [False, True]:
+            ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 2, no_cython)
+            full = ctg_reader.read_contigs(ctg_reader.contigs)
+            # contig 1 is written twice; row 1 is not part of the plan
+            x = np.full((4, 100, len(expanded_names)), 7, dtype=np.float32)
+            mask = np.ones((4, 100), dtype=bool)
+            plan = [(1, 0, 500, 0, 50), (0, 10, 60, 2, 30), (1, 5, 20, 3, 10)]
+            ctg_reader.read_into(*zip(*[p[:4] for p in plan]), expanded_names, x, mask, [p[4] for p in plan])
+            for contig_idx, start, stop, row, mask_len in plan:
+                expected = np.column_stack([full[contig_idx][f] for f in expanded_names])[start:stop][:100]
+                self.assertIsNone(np.testing.assert_array_equal(expected, x[row][:len(expected)]))
+                self.assertTrue(np.all(x[row][len(expected):] == 0))
+                self.assertEqual(mask_len, mask[row].sum())
+                self.assertTrue(np.all(mask[row][:mask_len]))
+            self.assertTrue(np.all(x[1] == 7))
+            self.assertTrue(np.all(mask[1]))
+
+    def test_read_async(self):
+        expanded_names = ['ref_base_A', 'ref_base_C', 'ref_base_G', 'ref_base_T'] + reader.feature_names[1:]
+        for no_cython in [False, True]:
+            ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 2, no_cython, max_in_flight=2)
+            expected = ctg_reader.read_contigs(ctg_reader.contigs)
+            # more requests than slots: submitting blocks until a slot is free
+            futures = [ctg_reader.read_contigs_async(ctg_reader.contigs) for _ in range(4)]
+            x = np.zeros((2, 500, len(expanded_names)), dtype=np.float32)
+            x_future = ctg_reader.read_into_async([0, 1], [0, 0], [500, 500], [0, 1], expanded_names, x)
+            for future in futures:
+                for features, expected_features in zip(future.result(), expected):
+                    for feature_name, data in expected_features.items():
+                        self.assertIsNone(np.testing.assert_array_equal(data, features[feature_name]))
+            self.assertIsNone(x_future.result())
+            for i in range(2):
+                self.assertIsNone(np.testing.assert_array_equal(
+                    np.column_stack([expected[i][f] for f in expanded_names]), x[i]))
+            # errors are reported through the future
+            with self.assertRaises(ZeroDivisionError):
+                ctg_reader.submit(lambda: 1 / 0).result()
+
+    def test_chunk_interval(self):
+        rnd = random.Random(0)
+        for _ in range(100):
+            start, stop = chunks.get_chunk_interval((460, 470), 500, 100, 10, rnd)
+            self.assertEqual(100, stop - start)
+            self.assertTrue(start <= 460 and 470 < stop <= 500)
+        self.assertEqual((0, 50), chunks.get_chunk_interval((10, 10), 50, 100, 10, rnd))
+        self.assertEqual([(0, 50, [])], chunks.select_chunks(50, [], 100, 10, rnd))
+
+    def test_read_binary_toc(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, ['coverage'], process_count=1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for fname in ['stats', 'toc', 'features_binary']:
+                shutil.copy(os.path.join(FEAT_DIR, fname), tmp_dir)
+            self.assertEqual(2, toc.write_binary_toc(os.path.join(tmp_dir, 'toc'), os.path.join(tmp_dir, 'toc_binary')))
+            binary_reader = contig_reader.ContigReader(tmp_dir, ['coverage'], process_count=1)
+
+            self.assertEqual(len(ctg_reader.contigs), len(binary_reader.contigs))
+            # the names are decoded from the memory-mapped toc when accessed
+            self.assertIsInstance(binary_reader.contigs.names.blobs[0], memoryview)
+            self.assertEqual(list(ctg_reader.contigs.names), list(binary_reader.contigs.names))
+            for expected, actual in zip(ctg_reader.contigs, binary_reader.contigs):
+                self.assertEqual(os.path.join(tmp_dir, 'features_binary'), actual.file)
+                for attr in ['name', 'length', 'offset', 'size_bytes', 'misassembly', 'breakpoints', 'avg_coverage']:
+                    self.assertEqual(getattr(expected, attr), getattr(actual, attr))
+            for expected, actual in zip(ctg_reader.read_contigs(ctg_reader.contigs),
+                                        binary_reader.read_contigs(binary_reader.contigs)):
+                self.assertIsNone(np.testing.assert_array_equal(expected['coverage'], actual['coverage']))
+
+            # the reader can be sent to another process (e.g. the validation worker)
+            restored = pickle.loads(pickle.dumps(binary_reader))
+            self.assertEqual(list(binary_reader.contigs.names), list(restored.contigs.names))
+            for expected, actual in zip(binary_reader.read_contigs(binary_reader.contigs),
+                                        restored.read_contigs(restored.contigs)):
+                self.assertIsNone(np.testing.assert_array_equal(expected['coverage'], actual['coverage']))
+
+            # contigs are filtered the same way as when reading the text toc
+            binary_reader = contig_reader.ContigReader(tmp_dir, ['coverage'], process_count=1, min_avg_coverage=4)
+            self.assertEqual(['Contig2'], [c.name for c in binary_reader.contigs])
+
+    def test_find_contigs(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, ['coverage'], process_count=1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for fname in ['stats', 'toc', 'features_binary']:
+                shutil.copy(os.path.join(FEAT_DIR, fname), tmp_dir)
+            toc.write_binary_toc(os.path.join(tmp_dir, 'toc'), os.path.join(tmp_dir, 'toc_binary'))
+            self.assertEqual(2, toc.write_name_index(os.path.join(tmp_dir, 'toc_binary'),
+                                                     os.path.join(tmp_dir, 'toc_index')))
+            # with and without the name index
+            for use_index in [True, False]:
+                if not use_index:
+                    os.remove(os.path.join(tmp_dir, 'toc_index'))
+                name_reader = contig_reader.ContigReader(tmp_dir, ['coverage'], process_count=1, load_metadata=False)
+                self.assertEqual(0, len(name_reader))
+                with self.assertLogs(level='WARNING'):
+                    found = name_reader.find_contigs(['Contig2', 'NoSuchContig', 'Contig1'])
+                self.assertEqual(['Contig2', 'Contig1'], [c.name for c in found])
+                for expected, actual in zip([ctg_reader.contigs[0], ctg_reader.contigs[1]], found):
+                    for attr in ['length', 'offset', 'size_bytes', 'misassembly', 'breakpoints', 'avg_coverage']:
+                        self.assertEqual(getattr(expected, attr), getattr(actual, attr))
+                result = lookup.lookup(name_reader, ['Contig1'])
+                self.assertEqual(1, len(result))
+                self.assertIsNone(np.testing.assert_array_equal(
+                    ctg_reader.read_contigs(ctg_reader.contigs[1:])[0]['coverage'], result[0][1]['coverage']))
+
+    def test_contig_metadata(self):
+        contig_infos = [contig_reader.ContigInfo('Contig1', '/tmp/c1', 1000, 0, 10, 0, [], avg_coverage=5),
+                        contig_reader.ContigInfo('Contig2', '/tmp/c1', 2000, 10, 20, 2, [(1, 2), (5, 6)], 3),
+                        contig_reader.ContigInfo('Contig3', '/tmp/c2', 3000, 0, 30, 1, [(7, 8)], avg_coverage=4)]
+        metadata = contig_reader.ContigMetadata.from_contig_infos(contig_infos)
+        self.assertEqual(3, len(metadata))
+        self.assertEqual(['/tmp/c1', '/tmp/c2'], metadata.files)
+        self.assertIsNone(np.testing.assert_array_equal([0, 0, 1], metadata.file_ids))
+        self.assertIsNone(np.testing.assert_array_equal([0, 0, 2, 3], metadata.breakpoint_idx))
+        for expected, actual in zip(contig_infos, metadata):
+            self.assertEqual(vars(expected), vars(actual))
+
+        subset = metadata.subset([2, 1])
+        self.assertEqual(['Contig3', 'Contig2'], [c.name for c in subset])
+        self.assertEqual([[(7, 8)], [(1, 2), (5, 6)]], [c.breakpoints for c in subset])
+        self.assertEqual(['/tmp/c2', '/tmp/c1'], [c.file for c in subset])
+
+        merged = contig_reader.ContigMetadata.concatenate([subset, metadata.subset(metadata.lengths < 2000)])
+        self.assertEqual(['Contig3', 'Contig2', 'Contig1'], [c.name for c in merged])
+        self.assertEqual([(1, 2), (5, 6)], merged[1].breakpoints)
+        self.assertEqual([], merged[-1].breakpoints)
+        self.assertEqual('/tmp/c1', merged[2].file)
+        self.assertEqual(0, len(contig_reader.ContigMetadata.empty().names))
+
+    def test_read_catalog(self):
+        n10_dir = os.path.join(data_dir, 'n10', 'features', '0.5', 'mean-10-sigma-1', '1', '150', '50000')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_list = os.path.join(tmp_dir, 'file_list.txt')
+            with open(file_list, 'w') as f:
+                for assembler in ['metaspades', 'megahit']:
+                    f.write(os.path.join(n10_dir, assembler, '1000', 'stats') + '\n')
+            expected = contig_reader.ContigReader(file_list, ['coverage'], process_count=1, stats_file='')
+
+            # register the two directories incrementally
+            catalog_file = os.path.join(tmp_dir, 'catalog.json')
+            self.assertEqual(1, catalog.register(catalog_file, [os.path.join(n10_dir, 'metaspades')]))
+            self.assertEqual(1, catalog.register(catalog_file, [os.path.join(n10_dir, 'megahit', '1000', 'stats')]))
+            # registering a directory again updates its entry
+            self.assertEqual(1, catalog.register(catalog_file, [os.path.join(n10_dir, 'megahit')]))
+            datasets = catalog.load(catalog_file)['datasets']
+            self.assertEqual(2, len(datasets))
+            self.assertEqual(len(expected), sum(d['contig_count'] for d in datasets))
+
+            actual = contig_reader.ContigReader(catalog_file, ['coverage'], process_count=1, stats_file='')
+            self.assertEqual(expected.means, actual.means)
+            self.assertEqual(expected.stdevs, actual.stdevs)
+            self.assertEqual(list(expected.contigs.names), list(actual.contigs.names))
+            self.assertEqual(expected.contigs.files, actual.contigs.files)
+
+            actual = contig_reader.ContigReader(catalog_file, ['coverage'], process_count=1, stats_file='',
+                                                feature_file_match='megahit')
+            self.assertEqual(1, len(actual.file_list))
+
+    def test_repack(self):
+        n10_dir = os.path.join(data_dir, 'n10', 'features', '0.5', 'mean-10-sigma-1', '1', '150', '50000')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_list = os.path.join(tmp_dir, 'file_list.txt')
+            with open(file_list, 'w') as f:
+                for assembler in ['metaspades', 'megahit']:
+                    f.write(os.path.join(n10_dir, assembler, '1000', 'stats') + '\n')
+            expected = contig_reader.ContigReader(file_list, reader.feature_names, process_count=1, stats_file='')
+
+            out_dir = os.path.join(tmp_dir, 'repacked')
+            shard_count = repack.repack(file_list, out_dir, 20000, order='length')
+            self.assertTrue(shard_count > 1)
+            self.assertEqual(shard_count, len(catalog.load(os.path.join(out_dir, 'catalog.json'))['datasets']))
+            # the output directory must be empty
+            with self.assertRaises(ValueError):
+                repack.repack(file_list, out_dir, 20000)
+
+            actual = contig_reader.ContigReader(out_dir, reader.feature_names, process_count=1, stats_file='')
+            self.assertEqual(shard_count, len(actual.file_list))
+            # the float sums in the stats are split between the shards, so the totals can differ in the last digits
+            for feature_name in expected.means:
+                self.assertAlmostEqual(expected.means[feature_name], actual.means[feature_name])
+                self.assertAlmostEqual(expected.stdevs[feature_name], actual.stdevs[feature_name])
+            # contigs are ordered by length within each shard
+            for file_id in range(shard_count):
+                self.assertTrue(np.all(np.diff(actual.contigs.lengths[actual.contigs.file_ids == file_id]) >= 0))
+
+            # every contig keeps its name, original directory and features
+            self.assertEqual(len(expected), len(actual))
+            actual_contigs = {(c.source, c.name): c for c in actual.contigs}
+            for contig in expected.contigs:
+                self.assertEqual(os.path.dirname(contig.file), contig.source)
+                repacked = actual_contigs[(contig.source, contig.name)]
+                self.assertTrue(repacked.file.startswith(out_dir))
+                for attr in ['length', 'size_bytes', 'misassembly', 'breakpoints']:
+                    self.assertEqual(getattr(contig, attr), getattr(repacked, attr))
+                # the binary toc stores the coverage as float32
+                self.assertAlmostEqual(contig.avg_coverage, repacked.avg_coverage, places=5)
+                for feature_name, values in expected.read_contigs([contig], return_raw=True)[0].items():
+                    self.assertIsNone(np.testing.assert_array_equal(
+                        values, actual.read_contigs([repacked], return_raw=True)[0][feature_name]))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'Counting the open files requires /proc')
+    def test_repack_many_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, _low_open_files_limit() as limit:
+            in_dir = os.path.join(tmp_dir, 'samples')
+            os.makedirs(in_dir)
+            file_list = _sample_dirs(in_dir, limit + 10)
+            # a single shard drawing from all the sample directories
+            out_dir = os.path.join(tmp_dir, 'repacked')
+            self.assertEqual(1, repack.repack(file_list, out_dir, 1 << 30, order='length'))
+            actual = contig_reader.ContigReader(out_dir, ['coverage'], process_count=1, stats_file='')
+            self.assertEqual(2 * (limit + 10), len(actual))
+            self.assertEqual(limit + 10, len(set(c.source for c in actual.contigs)))
+
+    def test_add_stats(self):
+        n10_dir = os.path.join(data_dir, 'n10', 'features', '0.5', 'mean-10-sigma-1', '1', '150', '50000')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for assembler in ['metaspades', 'megahit']:
+                shutil.copytree(os.path.join(n10_dir, assembler, '1000'), os.path.join(tmp_dir, assembler),
+                                ignore=shutil.ignore_patterns('stats.json'))
+            megahit_dir = os.path.join(tmp_dir, 'megahit')
+            toc.write_binary_toc(os.path.join(megahit_dir, 'toc'), os.path.join(megahit_dir, 'toc_binary'))
+            expected = contig_reader.ContigReader(tmp_dir, add_stats.FEATURES, process_count=1, stats_file='')
+            contig_count = add_stats.add_stats(tmp_dir, process_count=2, batch_size=3)
+            self.assertEqual(len(expected), contig_count)
+
+            for assembler in ['metaspades', 'megahit']:
+                contigs = [c for c in expected.contigs if os.path.dirname(c.file) == os.path.join(tmp_dir, assembler)]
+                features = expected.read_contigs(contigs, return_raw=True)
+                with open(os.path.join(tmp_dir, assembler, 'stats')) as f:
+                    stats = json.load(f)
+                coverage = np.concatenate([f['coverage'] for f in features]).astype(np.int64)
+                self.assertEqual(len(coverage), stats['all_count'])
+                self.assertEqual(int(np.sum(coverage)), stats['coverage']['sum'])
+                self.assertEqual(int(np.sum(coverage ** 2)), stats['coverage']['sum2'])
+                for feature_name in ['seq_window_perc_gc', 'seq_window_entropy']:
+                    values = np.concatenate([f[feature_name] for f in features]).astype(np.float64)
+                    self.assertAlmostEqual(1, stats[feature_name]['sum'] / np.sum(values))
+                    self.assertAlmostEqual(1, stats[feature_name]['sum2'] / np.sum(values ** 2))
+                self.assertTrue(os.path.exists(os.path.join(tmp_dir, assembler, 'stats_old')))
+                self.assertEqual(len(coverage), len(histograms.Histogram.from_json(stats['histograms']['coverage'])))
+
+            # the updated average coverages are used by the (binary) toc readers
+            actual = contig_reader.ContigReader(tmp_dir, add_stats.FEATURES, process_count=1, stats_file='')
+            self.assertEqual(list(expected.contigs.names), list(actual.contigs.names))
+            for contig, features in zip(actual.contigs, expected.read_contigs(expected.contigs, return_raw=True)):
+                self.assertAlmostEqual(np.average(features['coverage']), contig.avg_coverage, places=4)
+
+    def test_histograms(self):
+        rnd = np.random.default_rng(0)
+        values = [rnd.normal(300, 50, 10000), rnd.normal(250, 20, 5000)]
+        stats_list = []
+        for v in values:
+            histogram = histograms.Histogram.empty('mean_insert_size_Match')
+            histogram.add(np.concatenate([v, [np.nan]]))
+            coverage = histograms.Histogram.empty('coverage')
+            coverage.add([1, 2, 5000])  # out of range values are counted in the last bin
+            stats_list.append({'histograms': {'mean_insert_size_Match': histogram.to_json(),
+                                              'coverage': coverage.to_json()}})
+        # features without a histogram in all stats files are left out
+        stats_list[1]['histograms'].pop('coverage')
+        merged = histograms.merge(stats_list)
+        self.assertEqual(['mean_insert_size_Match'], list(merged.keys()))
+
+        histogram = merged['mean_insert_size_Match']
+        self.assertEqual(15000, len(histogram))
+        all_values = np.concatenate(values)
+        bin_width = 2000 / 400
+        for q in [0.05, 0.25, 0.5, 0.75, 0.95]:
+            self.assertAlmostEqual(np.quantile(all_values, q), histogram.quantile(q), delta=bin_width)
+        median, iqr = histogram.median_iqr()
+        self.assertAlmostEqual(np.median(all_values), median, delta=bin_width)
+        self.assertTrue(np.isnan(histograms.Histogram.empty('coverage').quantile(0.5)))
+        with self.assertRaises(ValueError):
+            histogram.merge(histograms.Histogram.empty('coverage'))
+
     if __name__ == '__main__':
         unittest.main()
@@ -1,12 +1,21 @@
 import os
+import pickle
 import numpy as np
 import pytest
+import random
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
 from resmico import models_fl
+from resmico import batch_workers
+from resmico import contig_cache
 from resmico import contig_reader
+from resmico import distributed
 from resmico import reader
+from resmico import training_state
+from resmico import validation
+from resmico.commands import train
 
 from resmico.contig_reader import ContigInfo
 
@@ -15,6 +24,17 @@ test_dir = os.path.join(os.path.dirname(__file__))
 data_dir = os.path.join(test_dir, 'data')
 FEAT_DIR = os.path.join(data_dir, 'preprocess')
 INFILE = os.path.join(FEAT_DIR, 'features_binary')
+# x - 2, as for a single convolution of size 3; unlike a lambda, it can be sent to the batch worker processes
+CONVOLUTION_MINUS_2 = models_fl.ConvolutionSize([(3, 1, 1, 2)])
+
+
+def _fail_batch(*args):
+    raise ValueError('Corrupt contig')
+
+
+def _exit_batch(*args):
+    os._exit(3)
+
 
 class TestBase(unittest.TestCase):
     def assert_array_equal(self, a, b):
@@ -197,8 +217,6 @@ class TestBinaryDatasetTrain(TestBase):
                                                     pad_to_max_len=False,
                                                     weight_factor=1000)
             data_gen.translate_short_contigs = False  # so that we know which interval is selected
-            # set these to -1 in order to enforce NOT swapping A/T and G/C (for data enhancement)
-            data_gen.pos_A = data_gen.pos_ref = data_gen.pos_C = -1
             # unshuffle the indices, so that we can make assertions about the returned data
             data_gen.indices = [0, 1]
             self.assertEqual(1, len(data_gen))
@@ -221,6 +239,285 @@ class TestBinaryDatasetTrain(TestBase):
             self.assert_array_equal(train_data[1][5][0:6], np.array([1, 0, 0, 0, 0, 0]))
 
 
+    def test_gen_train_data_fused_read(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        result = []
+        for fused in [False, True]:
+            np.random.seed(0)
+            random.seed(0)
+            data_gen = models_fl.BinaryDatasetTrain(ctg_reader, indices, 4, reader.feature_names, 500,
+                                                    num_translations=1, max_translation_bases=10, fraq_neg=1.0,
+                                                    do_cache=False, show_progress=False,
+                                                    convoluted_size=(lambda x, pad: x - 2), pad_to_max_len=False,
+                                                    weight_factor=0, fused_read=fused)
+            result.append(data_gen[0])
+        (expected_x, expected_mask), expected_y, _ = result[0]
+        (x, mask), y, _ = result[1]
+        self.assert_array_equal(expected_x, x)
+        self.assert_array_equal(expected_mask, mask)
+        self.assert_array_equal(expected_y, y)
+
+
+    def test_gen_train_data_prefetch(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        for fused in [False, True]:
+            result = []
+            for prefetch in [0, 2]:
+                np.random.seed(0)
+                random.seed(0)
+                data_gen = models_fl.BinaryDatasetTrain(ctg_reader, indices, 1, reader.feature_names, 500,
+                                                        num_translations=2, max_translation_bases=10, fraq_neg=1.0,
+                                                        do_cache=False, show_progress=False,
+                                                        convoluted_size=(lambda x, pad: x - 2), pad_to_max_len=False,
+                                                        weight_factor=0, fused_read=fused, prefetch=prefetch)
+                # two epochs, to make sure that reshuffling doesn't use stale prefetched batches
+                result.append([data_gen[i] for i in range(len(data_gen))])
+                data_gen.on_epoch_end()
+                result[-1] += [data_gen[i] for i in range(len(data_gen))]
+            self.assertEqual(8, len(result[1]))
+            for ((expected_x, expected_mask), expected_y, _), ((x, mask), y, _) in zip(*result):
+                self.assert_array_equal(expected_x, x)
+                self.assert_array_equal(expected_mask, mask)
+                self.assert_array_equal(expected_y, y)
+
+
+    def test_gen_train_data_feature_dtype(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        for fused in [False, True]:
+            result = {}
+            for dtype in ['float32', 'float16', 'bfloat16']:
+                np.random.seed(0)
+                random.seed(0)
+                data_gen = models_fl.BinaryDatasetTrain(ctg_reader, indices, 2, reader.feature_names, 500,
+                                                        num_translations=1, max_translation_bases=10, fraq_neg=1.0,
+                                                        do_cache=True, show_progress=False,
+                                                        convoluted_size=(lambda x, pad: x - 2), pad_to_max_len=False,
+                                                        weight_factor=0, fused_read=fused, feature_dtype=dtype)
+                result[dtype] = data_gen[0]
+                self.assertEqual(np.dtype(models_fl.FEATURE_DTYPES[dtype]), result[dtype][0][0].dtype)
+                # the cache keeps the reduced precision tensors
+                for features in data_gen.contig_cache.entries.values():
+                    self.assertEqual(result[dtype][0][0].dtype, features.dtype)
+            (expected_x, expected_mask), expected_y, _ = result['float32']
+            for dtype, tolerance in [('float16', 1e-3), ('bfloat16', 1e-2)]:
+                (x, mask), y, _ = result[dtype]
+                self.assertIsNone(np.testing.assert_allclose(expected_x, x.astype(np.float32), rtol=tolerance,
+                                                             atol=tolerance))
+                self.assert_array_equal(expected_mask, mask)
+                self.assert_array_equal(expected_y, y)
+
+
+    def test_make_tf_dataset(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        for fused in [False, True]:
+            data_gen = models_fl.BinaryDatasetTrain(ctg_reader, indices, 1, reader.feature_names, 500,
+                                                    num_translations=2, max_translation_bases=10, fraq_neg=1.0,
+                                                    do_cache=False, show_progress=False,
+                                                    convoluted_size=(lambda x, pad: x - 2), pad_to_max_len=False,
+                                                    weight_factor=0, fused_read=fused, prefetch=2)
+            signature = ((models_fl.tf.TensorSpec(shape=(1, None, len(data_gen.expanded_feature_names)),
+                                                  dtype=models_fl.tf.float32),
+                          models_fl.tf.TensorSpec(shape=(1, None), dtype=models_fl.tf.bool)),
+                         models_fl.tf.TensorSpec(shape=(1), dtype=models_fl.tf.uint8),
+                         models_fl.tf.TensorSpec(shape=(1), dtype=models_fl.tf.float32))
+            expected = [data_gen.get_batch(i, r) for r in range(2) for i in range(len(data_gen))]
+            for deterministic in [True, False]:
+                batches = list(models_fl.make_tf_dataset(data_gen, signature, repeat=2, parallel_calls=4,
+                                                         deterministic=deterministic).as_numpy_iterator())
+                self.assertEqual(8, len(batches))
+                if not deterministic:  # same batches, possibly in a different order
+                    batches.sort(key=lambda b: b[0][0].tobytes())
+                    expected.sort(key=lambda b: b[0][0].tobytes())
+                for ((expected_x, expected_mask), expected_y, _), ((x, mask), y, _) in zip(expected, batches):
+                    self.assert_array_equal(expected_x, x)
+                    self.assert_array_equal(expected_mask, mask)
+                    self.assert_array_equal(expected_y, y)
+            # the augmentation of each batch only depends on the dataset seed, the epoch and the batch position
+            augment = models_fl.make_augmentation(data_gen.expanded_feature_names, lambda x, pad: x - 2, 500, False,
+                                                  reverse_prob=0.5, max_shift=10)
+            runs = [list(models_fl.make_tf_dataset(data_gen, signature, repeat=2, parallel_calls=4,
+                                                   augment=augment).as_numpy_iterator()) for _ in range(2)]
+            for ((x1, mask1), y1, _), ((x2, mask2), y2, _) in zip(*runs):
+                self.assert_array_equal(x1, x2)
+                self.assert_array_equal(mask1, mask2)
+                self.assert_array_equal(y1, y2)
+
+    def test_augmentation(self):
+        tf = models_fl.tf
+        names = ['num_query_A', 'num_query_C', 'num_query_G', 'num_query_T', 'coverage']
+        lengths = [6, 3, 0]  # the last row is empty, as in an incomplete batch
+        x = np.zeros((3, 6, len(names)), dtype=np.float32)
+        mask = np.ones((3, 4), dtype=bool)
+        for i, length in enumerate(lengths):
+            x[i, :length] = np.arange(1, length * len(names) + 1).reshape(length, len(names))
+            if length > 0:
+                mask[i, length - 2:] = False
+        x[0, 4:] = 0  # positions with no coverage at the end of a contig are all zero too
+        batch = ((tf.constant(x), tf.constant(mask)), tf.constant([1, 0, 0]), tf.constant([1., 1., 1.]))
+        contig_lengths = tf.constant(lengths, dtype=tf.int32)
+        seed = tf.constant([1, 2], dtype=tf.int64)
+        convoluted_size = lambda n, pad: n - 2
+
+        reverse = models_fl.make_augmentation(names, convoluted_size, 6, False, reverse_prob=1)
+        (x_aug, mask_aug), _, _ = reverse(batch, contig_lengths, seed)
+        self.assert_array_equal(mask, mask_aug.numpy())
+        for i, length in enumerate(lengths):
+            self.assert_array_equal(x[i, :length][::-1][:, [3, 2, 1, 0, 4]], x_aug[i, :length])
+            self.assert_array_equal(np.zeros((6 - length, len(names))), x_aug[i, length:])
+
+        shift = models_fl.make_augmentation(names, convoluted_size, 6, False, reverse_prob=0, max_shift=3)
+        shifted_any = False
+        for s in range(10):
+            (x_aug, mask_aug), _, _ = shift(batch, contig_lengths, tf.constant([1, s], dtype=tf.int64))
+            self.assertEqual((3, 9, len(names)), x_aug.shape)
+            self.assertEqual((3, 7), mask_aug.shape)
+            for i, length in enumerate(lengths[:2]):
+                offset = int(np.argmax(np.any(x_aug[i] != 0, axis=1)))
+                self.assertLessEqual(offset, 3)
+                shifted_any |= offset > 0
+                self.assert_array_equal(x[i, :length], x_aug[i, offset:offset + length])
+                self.assertEqual(0, np.count_nonzero(x_aug[i, offset + length:]))
+                # shifted contigs are masked like left-padded contigs; the others keep their mask
+                self.assertEqual(length - 2 + offset, np.count_nonzero(mask_aug[i]))
+                self.assertEqual(0, np.count_nonzero(mask_aug[i, length - 2 + offset:]))
+            self.assertEqual(0, np.count_nonzero(x_aug[2]))
+            self.assertEqual(4, np.count_nonzero(mask_aug[2]))
+        self.assertTrue(shifted_any)
+
+        # the same seed gives the same augmentation
+        both = models_fl.make_augmentation(names, convoluted_size, 6, False, reverse_prob=0.5, max_shift=3)
+        first, second = both(batch, contig_lengths, seed), both(batch, contig_lengths, seed)
+        self.assert_array_equal(first[0][0].numpy(), second[0][0].numpy())
+        self.assert_array_equal(first[0][1].numpy(), second[0][1].numpy())
+
+        # with fixed length batches, contigs are only shifted into the padding
+        fixed = models_fl.make_augmentation(names, convoluted_size, 6, True, reverse_prob=0, max_shift=3)
+        (x_aug, mask_aug), _, _ = fixed(batch, contig_lengths, seed)
+        self.assertEqual((3, 6, len(names)), x_aug.shape)
+        self.assert_array_equal(x[0], x_aug[0])
+        self.assert_array_equal(mask[0], mask_aug[0])
+
+
+    def test_chunks(self):
+        n10_dir = os.path.join(data_dir, 'n10', 'features', '0.5', 'mean-10-sigma-1', '1', '150', '50000')
+        # a composed input dir, so that no stats.json is written to the test data
+        input_dirs = ','.join(os.path.join(n10_dir, assembler) for assembler in ['metaspades', 'megahit'])
+        ctg_reader = contig_reader.ContigReader(input_dirs, reader.feature_names, 1, False)
+        indices = np.arange(0, len(ctg_reader), 2)
+        data_gen = models_fl.BinaryDatasetChunks(ctg_reader, indices, 4, reader.feature_names, fraq_neg=1.0,
+                                                 convoluted_size=(lambda x, pad: x // 2 if pad else x // 2 - 3))
+        self.assertEqual(500, data_gen.chunk_len)
+        self.assertTrue(all(chunk.contig_idx % 2 == 0 for chunk in data_gen.chunks))
+        self.assertEqual(len(data_gen.chunks) // 4, len(data_gen))
+        self.assertEqual(247, np.count_nonzero(data_gen.mask))
+        full = data_gen.read_stacked_features(list(range(len(ctg_reader))))
+        seen = []
+        for i in range(len(data_gen)):
+            (x, mask), y, weights = data_gen[i]
+            self.assertEqual((4, 500, len(data_gen.expanded_feature_names)), x.shape)
+            self.assertEqual((4, 250), mask.shape)
+            for row, chunk_idx in enumerate(data_gen.batch_indices(i)):
+                chunk = data_gen.chunks[chunk_idx]
+                self.assert_array_equal(full[chunk.contig_idx][chunk.start:chunk.stop], x[row])
+                self.assert_array_equal(data_gen.mask, mask[row])
+                self.assertEqual(chunk.misassembly != 0, y[row])
+                seen.append(chunk_idx)
+            self.assert_array_equal(np.ones(4), weights)
+        self.assertEqual(len(seen), len(set(seen)))
+        data_gen.on_epoch_end()
+        self.assertEqual(sorted(data_gen.indices), list(range(len(data_gen.chunks))))
+
+    def test_length_buckets(self):
+        n10_dir = os.path.join(data_dir, 'n10', 'features', '0.5', 'mean-10-sigma-1', '1', '150', '50000')
+        # a composed input dir, so that no stats.json is written to the test data
+        input_dirs = ','.join(os.path.join(n10_dir, assembler) for assembler in ['metaspades', 'megahit'])
+        ctg_reader = contig_reader.ContigReader(input_dirs, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        lengths = ctg_reader.metadata.lengths
+        create = lambda buckets, pad=False: models_fl.BinaryDatasetTrain(
+            ctg_reader, indices, 4, reader.feature_names, 2000, num_translations=1, max_translation_bases=0,
+            fraq_neg=0.5, do_cache=False, show_progress=False, convoluted_size=(lambda x, pad: x),
+            pad_to_max_len=False, weight_factor=0, length_buckets=buckets, pad_to_buckets=pad)
+        np.random.seed(0)
+        plain = create(0)
+        bucketed = create(3)
+        self.assertEqual(3, len(bucketed.length_boundaries))
+        self.assertEqual(2000, bucketed.length_boundaries[-1])
+        for epoch in range(3):
+            # the negative sub-sampling and the class mix are not affected by bucketing
+            self.assertEqual(len(plain.indices), len(bucketed.indices))
+            self.assertEqual(sorted(plain.positive_idx), sorted(i for i in bucketed.indices
+                                                                if ctg_reader.metadata.misassembly[i] != 0))
+            self.assertEqual(len(set(bucketed.indices)), len(bucketed.indices))
+            buckets = np.searchsorted(bucketed.length_boundaries, np.minimum(lengths[bucketed.indices], 2000))
+            for i in range(len(bucketed)):
+                batch_buckets = buckets[4 * i: 4 * (i + 1)]
+                # only the batches made of the bucket remainders (at the end) can mix buckets
+                if i < len(bucketed) - len(bucketed.length_boundaries):
+                    self.assertEqual(1, len(set(batch_buckets)))
+                (x, mask), y, weights = bucketed[i]
+                self.assertEqual(min(2000, lengths[bucketed.indices[4 * i: 4 * (i + 1)]].max()), x.shape[1])
+            self.assertLess(bucketed.padding_fraction(), plain.padding_fraction())
+            plain.on_epoch_end()
+            bucketed.on_epoch_end()
+
+        # padded to the bucket boundaries, the batches have at most one length per bucket
+        padded = create(3, pad=True)
+        for i in range(len(padded)):
+            (x, mask), y, weights = padded[i]
+            batch_len = min(2000, lengths[padded.indices[4 * i: 4 * (i + 1)]].max())
+            boundary = padded.length_boundaries[np.searchsorted(padded.length_boundaries, batch_len)]
+            self.assertEqual(boundary, x.shape[1])
+            self.assertEqual(boundary, mask.shape[1])
+            self.assertEqual(0, np.count_nonzero(x[:, batch_len:]))
+
+
+    def test_read_stacked_features_intervals(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = list(range(len(ctg_reader)))
+        starts = [i * 7 for i in indices]
+        stops = [min(start + 100, ctg_reader.contigs[i].length) for i, start in zip(indices, starts)]
+        for cached in [False, True]:
+            data_gen = models_fl.BinaryDatasetTrain(ctg_reader, np.arange(len(ctg_reader)), 1, reader.feature_names,
+                                                    500, num_translations=1, max_translation_bases=0, fraq_neg=1.0,
+                                                    do_cache=cached, show_progress=False,
+                                                    convoluted_size=(lambda x, pad: x), pad_to_max_len=False,
+                                                    weight_factor=0, feature_dtype='float16')
+            full = data_gen.read_stacked_features(indices)
+            intervals = data_gen.read_stacked_features(indices, starts, stops)
+            for i in indices:
+                self.assertEqual(np.float16, intervals[i].dtype)
+                self.assertEqual((stops[i] - starts[i], len(data_gen.expanded_feature_names)), intervals[i].shape)
+                self.assert_array_equal(full[i][starts[i]:stops[i]], intervals[i])
+
+    def test_gen_train_data_contig_cache(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        result = []
+        for cached in [False, True]:
+            np.random.seed(0)
+            data_gen = models_fl.BinaryDatasetTrain(ctg_reader, indices, 1, reader.feature_names, 500,
+                                                    num_translations=2, max_translation_bases=10, fraq_neg=1.0,
+                                                    do_cache=cached, show_progress=False,
+                                                    convoluted_size=(lambda x, pad: x - 2), pad_to_max_len=False,
+                                                    weight_factor=0, fused_read=True, cache_bytes=10 ** 6)
+            result.append([data_gen[i] for i in range(len(data_gen))])
+            data_gen.on_epoch_end()
+            result[-1] += [data_gen[i] for i in range(len(data_gen))]
+        # each contig is read from disk once, all other lookups are hits
+        self.assertEqual(2, len(data_gen.contig_cache))
+        self.assertEqual(4, data_gen.contig_cache.stats()['hits'])
+        self.assertEqual(0, data_gen.contig_cache.stats()['misses'])
+        for ((expected_x, expected_mask), expected_y, _), ((x, mask), y, _) in zip(*result):
+            self.assert_array_equal(expected_x, x)
+            self.assert_array_equal(expected_mask, mask)
+            self.assert_array_equal(expected_y, y)
+
+
 class TestBinaryDatasetEval(TestBase):
     bytes_per_base = 10 + sum(  # 10 is the overhead also added in Models_Fl.BinaryDataEval
         [np.dtype(ft).itemsize for ft in reader.feature_np_types])
@@ -287,6 +584,80 @@ class TestBinaryDatasetEval(TestBase):
             self.assert_array_equal(x[1][0][0:6], np.array([1, 0, 0, 0, 1, 1]))
             self.assert_array_equal(x[1][5][0:6], np.array([1, 0, 0, 0, 0, 0]))
 
+    def test_gen_eval_data_tensor_cache(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        create = lambda cache_dir, dtype: models_fl.BinaryDatasetEval(ctg_reader, indices, reader.feature_names, 50,
+                                                                      30, 1e6, False, False,
+                                                                      convoluted_size=(lambda x, pad: x),
+                                                                      pad_to_max_len=False, tensor_cache_dir=cache_dir,
+                                                                      tensor_cache_dtype=dtype)
+        (expected_x, expected_mask), _ = create('', 'float32')[0]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            (x, mask), _ = create(cache_dir, 'float32')[0]
+            self.assert_array_equal(expected_x, x)
+            self.assert_array_equal(expected_mask, mask)
+            cache_files = {f: os.path.getmtime(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir)}
+            self.assertEqual(2, len(cache_files))  # the data and the index for the single features_binary file
+
+            # the cache is reused by a new dataset (e.g. in a new run) with the same features and stats
+            (x, _), _ = create(cache_dir, 'float32')[0]
+            self.assert_array_equal(expected_x, x)
+            self.assertEqual(cache_files,
+                             {f: os.path.getmtime(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir)})
+
+            # a different dtype creates a new entry
+            (x, _), _ = create(cache_dir, 'float16')[0]
+            self.assertIsNone(np.testing.assert_allclose(expected_x, x, rtol=1e-3, atol=1e-3))
+            self.assertEqual(4, len(os.listdir(cache_dir)))
+
+    def test_gen_eval_data_fused_read(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        for cached in [False, True]:
+            create = lambda fused: models_fl.BinaryDatasetEval(ctg_reader, indices, reader.feature_names, 50, 30, 1e6,
+                                                               cached, False, convoluted_size=(lambda x, pad: x - 2),
+                                                               pad_to_max_len=False, fused_read=fused)
+            (expected_x, expected_mask), _ = create(False)[0]
+            eval_data = create(True)
+            for _ in range(2):
+                (x, mask), _ = eval_data[0]
+                self.assert_array_equal(expected_x, x)
+                self.assert_array_equal(expected_mask, mask)
+
+    def test_gen_eval_data_prefetch(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        for fused in [False, True]:
+            # small memory budget, so that each contig is in a separate batch
+            create = lambda prefetch: models_fl.BinaryDatasetEval(ctg_reader, indices, reader.feature_names, 50, 30,
+                                                                  1e4, False, False,
+                                                                  convoluted_size=(lambda x, pad: x - 2),
+                                                                  pad_to_max_len=False, fused_read=fused,
+                                                                  prefetch=prefetch)
+            expected = create(0)
+            eval_data = create(1)
+            self.assertEqual(2, len(eval_data))
+            for i in range(len(eval_data)):
+                (expected_x, expected_mask), _ = expected[i]
+                (x, mask), _ = eval_data[i]
+                self.assert_array_equal(expected_x, x)
+                self.assert_array_equal(expected_mask, mask)
+
+    def test_gen_eval_data_feature_dtype(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        indices = np.arange(len(ctg_reader))
+        for fused in [False, True]:
+            create = lambda dtype: models_fl.BinaryDatasetEval(ctg_reader, indices, reader.feature_names, 50, 30,
+                                                               1e4, True, False, convoluted_size=(lambda x, pad: x - 2),
+                                                               pad_to_max_len=False, fused_read=fused,
+                                                               feature_dtype=dtype)
+            (expected_x, expected_mask), _ = create('float32')[0]
+            (x, mask), _ = create('float16')[0]
+            self.assertEqual(np.float16, x.dtype)
+            self.assertIsNone(np.testing.assert_allclose(expected_x, x.astype(np.float32), rtol=1e-3, atol=1e-3))
+            self.assert_array_equal(expected_mask, mask)
+
     def test_gen_eval_data_short_window(self):
         ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
         indices = np.arange(len(ctg_reader))
@@ -398,6 +769,276 @@ class TestBinaryDatasetEval(TestBase):
             np.testing.assert_array_equal(x[1][5][0:6], np.array([1, 0, 0, 0, 0, 0])))
 
 
+class TestContigCache(TestBase):
+    def test_lru_eviction(self):
+        cache = contig_cache.ContigCache(300)
+        for i in range(3):
+            cache.put(i, np.full((10, 2), i, dtype=np.float32))  # 80 bytes each
+        self.assert_array_equal(np.zeros((10, 2)), cache.get(0))  # 0 is now the most recently used
+        cache.put(3, np.full((10, 2), 3, dtype=np.float32))
+        self.assertIsNone(cache.get(1))
+        for i in [0, 2, 3]:
+            self.assert_array_equal(np.full((10, 2), i), cache.get(i))
+        self.assertEqual(240, cache.size_bytes)
+        cache.put(4, np.zeros((100, 2), dtype=np.float32))  # larger than the cache
+        self.assertIsNone(cache.get(4))
+        stats = cache.stats()
+        self.assertEqual((4, 2), (stats['hits'], stats['misses']))
+        cache.log_stats()
+        self.assertEqual(0, cache.stats()['hits'])
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cache = contig_cache.ContigCache(100, spill_dir, 250)
+            # the spill file is removed right away, its space is freed when the mapping is closed
+            self.assertEqual([], os.listdir(spill_dir))
+            for i in range(6):
+                cache.put(i, np.full((10, 2), i, dtype=np.float32))
+            # 5 is in memory, 0-4 were spilled, but the file only fits 3 contigs, so 3 and 4 overwrote 0 and 1
+            self.assertEqual([5], list(cache.entries.keys()))
+            self.assertEqual([2, 3, 4], list(cache.spilled.keys()))
+            self.assertIsNone(cache.get(0))
+            self.assertIsNone(cache.get(1))
+            for i in [2, 3, 4]:
+                features = cache.get(i)
+                self.assertEqual(np.float32, features.dtype)
+                self.assert_array_equal(np.full((10, 2), i), features)
+            self.assertEqual(3, cache.stats()['spill_hits'])
+
+    def test_share(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cache = contig_cache.ContigCache(300, spill_dir, 250)
+            cache.put(0, np.zeros((10, 2), dtype=np.float32))
+            # e.g. the copy of a batch worker process, which starts empty and gets its part of the budgets
+            copy = pickle.loads(pickle.dumps(cache))
+            self.assertEqual(0, len(copy))
+            self.assertIsNone(copy.spill)
+            copy.share(2)
+            self.assertEqual(150, copy.capacity_bytes)
+            self.assertEqual(125, len(copy.spill))
+            for i in range(1, 4):
+                copy.put(i, np.full((10, 2), i, dtype=np.float32))
+            self.assertEqual([3], list(copy.entries.keys()))
+            self.assertEqual([2], list(copy.spilled.keys()))
+            self.assert_array_equal(np.full((10, 2), 2), copy.get(2))
+            self.assertEqual([0], list(cache.entries.keys()))
+
+
+class TestBatchWorkerPool(TestBase):
+    def create_dataset(self, fused: bool = False, cached: bool = False):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        return models_fl.BinaryDatasetTrain(ctg_reader, np.arange(len(ctg_reader)), 1, reader.feature_names, 500,
+                                            num_translations=2, max_translation_bases=10, fraq_neg=1.0,
+                                            do_cache=cached, show_progress=False,
+                                            convoluted_size=CONVOLUTION_MINUS_2, pad_to_max_len=False,
+                                            weight_factor=0, fused_read=fused)
+
+    def test_same_batches(self):
+        for fused, cached in [(False, False), (True, False), (False, True)]:
+            data_gen = self.create_dataset(fused, cached)
+            with batch_workers.BatchWorkerPool(data_gen, 2, 3) as pool:
+                self.assertEqual(len(data_gen), len(pool))
+                for epoch in range(2):
+                    for repeat in range(2):
+                        for i in range(len(data_gen)):
+                            (expected_x, expected_mask), expected_y, expected_weights = data_gen.get_batch(i, repeat)
+                            (x, mask), y, weights = pool.get_batch(i, repeat)
+                            self.assert_array_equal(expected_x, x)
+                            self.assert_array_equal(expected_mask, mask)
+                            self.assert_array_equal(expected_y, y)
+                            self.assert_array_equal(expected_weights, weights)
+                            *_, expected_lengths = data_gen.get_batch(i, repeat, with_lengths=True)
+                            *_, lengths = pool.get_batch(i, repeat, with_lengths=True)
+                            self.assert_array_equal(expected_lengths, lengths)
+                            self.assertEqual(0, np.count_nonzero(x[0, lengths[0]:]))
+                            self.assertLessEqual(lengths[0], data_gen.reader.contigs[data_gen.batch_indices(i)[0]].length)
+                    # the workers use the new order of the contigs
+                    data_gen.on_epoch_end()
+
+    def test_slot_reuse(self):
+        data_gen = self.create_dataset()
+        with batch_workers.BatchWorkerPool(data_gen, 1, 2) as pool:
+            first = pool.get_batch(0)
+            second = pool.get_batch(1)
+            self.assertTrue(pool._free_slots.empty())
+            expected = second[0][0].copy()
+            del first  # releases its slot
+            for i in range(len(data_gen)):
+                pool.get_batch(i)
+            # the slot of the batch that is still referenced was not overwritten
+            self.assert_array_equal(expected, second[0][0])
+        # the shared memory stays mapped until the last batch is released
+        self.assertIsNotNone(pool.buffer.buf)
+        self.assert_array_equal(expected, second[0][0])
+        del second
+        self.assertIsNone(pool.buffer.buf)
+
+    def test_make_tf_dataset(self):
+        data_gen = self.create_dataset()
+        signature = ((models_fl.tf.TensorSpec(shape=(1, None, len(data_gen.expanded_feature_names)),
+                                              dtype=models_fl.tf.float32),
+                      models_fl.tf.TensorSpec(shape=(1, None), dtype=models_fl.tf.bool)),
+                     models_fl.tf.TensorSpec(shape=(1), dtype=models_fl.tf.uint8),
+                     models_fl.tf.TensorSpec(shape=(1), dtype=models_fl.tf.float32))
+        with batch_workers.BatchWorkerPool(data_gen, 2, 8) as pool:
+            batches = list(models_fl.make_tf_dataset(pool, signature, repeat=2, parallel_calls=4,
+                                                     prefetch=2).as_numpy_iterator())
+        self.assertEqual(8, len(batches))
+        for i, ((x, mask), y, _) in enumerate(batches):
+            (expected_x, expected_mask), expected_y, _ = data_gen.get_batch(i % len(data_gen), i // len(data_gen))
+            self.assert_array_equal(expected_x, x)
+            self.assert_array_equal(expected_mask, mask)
+            self.assert_array_equal(expected_y, y)
+
+    def test_worker_error(self):
+        data_gen = self.create_dataset()
+        data_gen.build_batch = _fail_batch
+        with batch_workers.BatchWorkerPool(data_gen, 1, 2) as pool:
+            with self.assertRaisesRegex(RuntimeError, 'Corrupt contig'):
+                pool.get_batch(0)
+            # the slot of the failed batch was released
+            self.assertEqual(2, pool._free_slots.qsize())
+
+    def test_worker_exit(self):
+        data_gen = self.create_dataset()
+        data_gen.build_batch = _exit_batch
+        with batch_workers.BatchWorkerPool(data_gen, 1, 2) as pool:
+            with self.assertRaisesRegex(RuntimeError, 'exited with code 3'):
+                pool.get_batch(0)
+            with self.assertRaisesRegex(RuntimeError, 'exited with code 3'):
+                pool.get_batch(1)
+
+
+class TestValidationWorker(TestBase):
+    def test_validate_checkpoints(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        eval_idx = np.arange(len(ctg_reader))
+        args = train.parse_args(['--max-len', '1000', '--num-blocks', '3', '--features'] + reader.feature_names)
+        model = models_fl.Resmico(args)
+        eval_data = models_fl.BinaryDatasetEval(ctg_reader, eval_idx, args.features, args.max_len, args.max_len - 500,
+                                                int(1e9), False, False, model.convoluted_size, model.fixed_length)
+        eval_data_y = (ctg_reader.metadata.misassembly[np.asarray(eval_data.indices, dtype=np.int64)] != 0)
+        expected = validation.scores(eval_data_y, eval_data.group(
+            model.predict(validation.make_eval_dataset(eval_data, 1), verbose=0)))
+        with tempfile.TemporaryDirectory() as save_dir:
+            checkpoint = os.path.join(save_dir, 'checkpoint.h5')
+            model.save(checkpoint)
+            with validation.ValidationWorker(ctg_reader, eval_idx, args) as worker:
+                worker.submit(2, checkpoint)
+                worker.submit(4, checkpoint)
+                results = worker.results(wait=True)
+                self.assertEqual(0, worker.pending)
+                worker.submit(6, os.path.join(save_dir, 'missing.h5'))
+                with self.assertRaisesRegex(RuntimeError, 'missing.h5'):
+                    worker.results(wait=True)
+        self.assertEqual([2, 4], [result[0] for result in results])
+        for _, result_checkpoint, scores, _ in results:
+            self.assertEqual(checkpoint, result_checkpoint)
+            self.assertEqual(expected.keys(), scores.keys())
+            for key in expected:
+                self.assertAlmostEqual(expected[key], scores[key], places=5)
+
+
+class TestTrainingCheckpoints(TestBase):
+    def test_save_restore(self):
+        tf = models_fl.tf
+        args = train.parse_args(['--max-len', '1000', '--num-blocks', '3'])
+        model = models_fl.Resmico(args)
+        rng = np.random.RandomState(0)
+        x = rng.normal(size=(4, 600, model.n_feat)).astype(np.float32)
+        mask = np.ones((4, model.convoluted_size(600, True)), dtype=bool)
+        model.net.fit([x, mask], np.array([0, 1, 0, 1], dtype=np.uint8), epochs=1, verbose=0)
+        tf.keras.backend.set_value(model.net.optimizer.lr, 0.123)
+        with tempfile.TemporaryDirectory() as save_dir:
+            checkpoints = training_state.TrainingCheckpoints(save_dir, model.net, max_to_keep=2)
+            self.assertIsNone(checkpoints.load_state())
+            for epoch in range(3):
+                checkpoints.save(epoch, {'epoch': epoch, 'indices': list(range(epoch))})
+            self.assertEqual(2, len([f for f in os.listdir(save_dir) if f.endswith('.state')]))
+
+            restored = models_fl.Resmico(args)
+            restored_checkpoints = training_state.TrainingCheckpoints(save_dir, restored.net)
+            state = restored_checkpoints.load_state()
+            self.assertEqual(2, state['epoch'])
+            self.assertEqual([0, 1], state['indices'])
+            restored_checkpoints.restore()
+        self.assertAlmostEqual(0.123, tf.keras.backend.get_value(restored.net.optimizer.lr), places=6)
+        self.assertEqual(1, restored.net.optimizer.iterations.numpy())
+        for expected, actual in zip(model.net.get_weights(), restored.net.get_weights()):
+            self.assert_array_equal(expected, actual)
+        self.assertEqual(len(model.net.optimizer.variables), len(restored.net.optimizer.variables))
+        for expected, actual in zip(model.net.optimizer.variables, restored.net.optimizer.variables):
+            self.assert_array_equal(expected.numpy(), actual.numpy())
+
+    def test_dataset_state(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        create = lambda: models_fl.BinaryDatasetTrain(ctg_reader, np.arange(len(ctg_reader)), 1, reader.feature_names,
+                                                      500, num_translations=2, max_translation_bases=10,
+                                                      fraq_neg=1.0, do_cache=False, show_progress=False,
+                                                      convoluted_size=(lambda x, pad: x - 2), pad_to_max_len=False,
+                                                      weight_factor=0)
+        data_gen = create()
+        data_gen.on_epoch_end()
+        resumed = create()
+        resumed.set_state(data_gen.get_state())
+        self.assertEqual(data_gen.indices, resumed.indices)
+        for i in range(len(data_gen)):
+            (expected_x, expected_mask), expected_y, _ = data_gen.get_batch(i)
+            (x, mask), y, _ = resumed.get_batch(i)
+            self.assert_array_equal(expected_x, x)
+            self.assert_array_equal(expected_mask, mask)
+            self.assert_array_equal(expected_y, y)
+
+    def test_dataset_state_worker_pool(self):
+        ctg_reader = contig_reader.ContigReader(FEAT_DIR, reader.feature_names, 1, False)
+        create = lambda: models_fl.BinaryDatasetTrain(ctg_reader, np.arange(len(ctg_reader)), 1, reader.feature_names,
+                                                      500, num_translations=2, max_translation_bases=10,
+                                                      fraq_neg=1.0, do_cache=False, show_progress=False,
+                                                      convoluted_size=CONVOLUTION_MINUS_2, pad_to_max_len=False,
+                                                      weight_factor=0)
+        data_gen = create()
+        data_gen.on_epoch_end()
+        resumed = create()
+        self.assertNotEqual(data_gen.seed, resumed.seed)
+        # the workers are started before the state is restored
+        with batch_workers.BatchWorkerPool(resumed, 2, 3) as pool:
+            resumed.set_state(data_gen.get_state())
+            for repeat in range(2):
+                for i in range(len(data_gen)):
+                    (expected_x, expected_mask), expected_y, _ = data_gen.get_batch(i, repeat)
+                    (x, mask), y, _ = pool.get_batch(i, repeat)
+                    self.assert_array_equal(expected_x, x)
+                    self.assert_array_equal(expected_mask, mask)
+                    self.assert_array_equal(expected_y, y)
+
+
+class TestDistributed(TestBase):
+    def test_shard_indices(self):
+        rng = np.random.RandomState(0)
+        indices = rng.permutation(1000)[:301]
+        lengths = rng.randint(1000, 20000, size=len(indices))
+        is_positive = rng.random_sample(len(indices)) < 0.1
+        shards = distributed.shard_indices(indices, lengths, is_positive, 4)
+        self.assertEqual(4, len(shards))
+        self.assert_array_equal(np.sort(indices), np.sort(np.concatenate(shards)))
+        length_of, positive_of = dict(zip(indices, lengths)), dict(zip(indices, is_positive))
+        positives = [sum(positive_of[i] for i in shard) for shard in shards]
+        negatives = [len(shard) - p for shard, p in zip(shards, positives)]
+        self.assertLessEqual(max(positives) - min(positives), 1)
+        self.assertLessEqual(max(negatives) - min(negatives), 1)
+        total_lengths = [sum(length_of[i] for i in shard) for shard in shards]
+        self.assertLess(max(total_lengths) - min(total_lengths), 0.02 * np.mean(total_lengths))
+        # the shards only depend on the arguments
+        for expected, actual in zip(shards, distributed.shard_indices(indices, lengths, is_positive, 4)):
+            self.assert_array_equal(expected, actual)
+
+    def test_all_gather(self):
+        strategy = models_fl.tf.distribute.MirroredStrategy(['/cpu:0'])
+        values = np.array([[1, 0.5], [0, 0.25]])
+        self.assert_array_equal(values, distributed.all_gather(strategy, values, 3))
+        self.assertEqual(7, distributed.global_min(strategy, 7))
+
+
 class TestResmico(unittest.TestCase):
     def setUp(self):
         args = MagicMock()
@@ -417,3 +1058,42 @@ class TestResmico(unittest.TestCase):
         self.assertEqual(83, model.convoluted_size(1024, False))
         # (((1071-9-8-5)//2-4-31-4)//2-4-31-4)//2-4-8
         self.assertEqual(89, model.convoluted_size(1071, True))
+
+    def test_convolved_output_size_pickle(self):
+        args = train.parse_args(['--max-len', '1000', '--num-blocks', '3', '--net-type', 'cnn_resnet'])
+        model = models_fl.Resmico(args)
+        # the function is sent to the batch worker processes along with the dataset
+        restored = pickle.loads(pickle.dumps(model.convoluted_size))
+        for length in [500, 1000, 1071]:
+            for pad in [False, True]:
+                self.assertEqual(model.convoluted_size(length, pad), restored(length, pad))
+        self.assertEqual(1000 - 2, CONVOLUTION_MINUS_2(1000, False))
+        self.assertEqual(1000 - 2, CONVOLUTION_MINUS_2(1000, True))
+
+    def test_mixed_precision_parity(self):
+        tf = models_fl.tf
+        args = train.parse_args(['--max-len', '1000', '--num-blocks', '3', '--net-type', 'cnn_resnet'])
+        model = models_fl.Resmico(args)
+        rng = np.random.RandomState(0)
+        x = rng.normal(size=(4, 1000, model.n_feat)).astype(np.float32)
+        x[1, 600:] = 0
+        mask = np.ones((4, model.convoluted_size(1000, True)), dtype=bool)
+        mask[1, model.convoluted_size(600, False):] = False
+        expected = model.predict([x, mask], verbose=0)
+
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        try:
+            loaded = models_fl.apply_global_policy(model.net)
+            mixed = models_fl.Resmico(train.parse_args(['--max-len', '1000', '--num-blocks', '3', '--net-type',
+                                                         'cnn_resnet', '--jit-compile']))
+        finally:
+            tf.keras.mixed_precision.set_global_policy('float32')
+        mixed.net.set_weights(model.net.get_weights())
+        self.assertIsInstance(mixed.net.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        for net in [loaded, mixed.net]:
+            self.assertEqual('float16', net.get_layer('1st_conv').compute_dtype)
+            for layer in net.layers:
+                if type(layer).__name__ in models_fl.FLOAT32_LAYERS:
+                    self.assertEqual('float32', layer.compute_dtype)
+            self.assertEqual(tf.float32, net.outputs[0].dtype)
+            np.testing.assert_allclose(expected, net.predict([x, mask], verbose=0), rtol=5e-2, atol=1e-4)
@@ -1,4 +1,6 @@
 import os
+import socket
+import subprocess
 import pytest
 import logging
 
@@ -29,3 +31,43 @@ def test_train_filelist(tmpdir, script_runner):
                             '--save-path', str(save_path),
                             '--feature-files-path', input_path)
     assert ret.success, ret.print()
+
+def test_train_multi_worker(tmpdir):
+    save_path = tmpdir.mkdir('save_dir')
+    n10_dir = os.path.join(data_dir, 'n10', 'features', '0.5', 'mean-10-sigma-1', '1', '150', '50000')
+    # a composed input dir with given validation indices and stats, so that nothing is written to the test data
+    input_path = ','.join(os.path.join(n10_dir, assembler, '1000') for assembler in ['metaspades', 'megahit'])
+    val_ind_f = str(tmpdir.join('val_ind.csv'))
+    with open(val_ind_f, 'w') as f:
+        f.write('\n'.join(['val_ind'] + [str(i) for i in range(0, 90, 9)]))
+    sockets = [socket.socket() for _ in range(2)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    hosts = ','.join(f'localhost:{s.getsockname()[1]}' for s in sockets)
+    for s in sockets:
+        s.close()
+    # two CPU workers on the local host
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    env.pop('TF_CONFIG', None)
+    logs = [tmpdir.join(f'worker_{i}.log') for i in range(2)]
+    workers = [subprocess.Popen(['resmico', 'train',
+                                 '--n-epochs', '2',
+                                 '--save-path', str(save_path),
+                                 '--feature-files-path', input_path,
+                                 '--stats-file', os.path.join(data_dir, 'n10', 'features', 'stats.json'),
+                                 '--val-ind-f', val_ind_f,
+                                 '--worker-hosts', hosts,
+                                 '--worker-index', str(i)],
+                                env=env, stdout=open(logs[i], 'w'), stderr=subprocess.STDOUT)
+               for i in range(2)]
+    for worker in workers:
+        worker.wait(timeout=1200)
+    outputs = [log.read() for log in logs]
+    for worker, output in zip(workers, outputs):
+        assert worker.returncode == 0, output
+    scores = [[line.split(' - ', 1)[1] for line in output.splitlines() if 'Validation scores' in line]
+              for output in outputs]
+    assert len(scores[0]) == 1 and scores[0] == scores[1]
+    # only the chief writes the models
+    assert len([f for f in os.listdir(save_path) if f.endswith('.h5')]) == 2
+    assert os.path.isdir(os.path.join(save_path, 'resmico_checkpoints', 'worker_1'))
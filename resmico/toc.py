@@ -0,0 +1,214 @@
+"""
+Binary, memory-mappable table of contents (toc_binary) for the contigs in a features_binary file. Loading it is O(1):
+the file is mmap-ed and the columns are numpy views into the mapping, so no per-contig parsing is needed.
+
+Layout (little endian):
+    - header: magic (8 bytes), contig count (uint64), breakpoint count (uint64), size of the name blob (uint64)
+    - contig count records of #TOC_DTYPE
+    - breakpoint count (start, end) pairs of uint32; the breakpoints for contig i are
+      breakpoints[breakpoint_idx[i]:breakpoint_idx[i] + breakpoint_cnt[i]]
+    - the concatenated utf-8 contig names; the name of contig i is names[name_offset[i]:name_offset[i] + name_len[i]]
+
+Repacked data sets (see repack.py) hold contigs from several original directories; their toc has an additional
+source column and the directories are listed in the sources file (one per line), see #read_sources.
+
+The name index (toc_index) maps contig names to records in toc_binary. It contains a header (magic, record count)
+followed by one #INDEX_DTYPE entry per contig, sorted by the 64-bit hash of the contig name, so a name is found with a
+binary search in the memory-mapped file. Hash collisions are resolved by comparing the names in toc_binary.
+"""
+import argparse
+import csv
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+from glob import glob
+
+import numpy as np
+
+TOC_MAGIC = b'RMCTOC01'
+TOC_HEADER = struct.Struct('<8sQQQ')
+TOC_DTYPE = np.dtype([('offset', '<u8'),  # offset of the contig record in features_binary
+                      ('name_offset', '<u8'),
+                      ('name_len', '<u4'),
+                      ('length', '<u4'),
+                      ('size_bytes', '<u4'),
+                      ('misassembly', '<u4'),
+                      ('avg_coverage', '<f4'),
+                      ('breakpoint_idx', '<u4'),
+                      ('breakpoint_cnt', '<u4'),
+                      ('source', '<u4')])  # index into the sources file of repacked data sets (0 otherwise)
+
+INDEX_MAGIC = b'RMCIDX01'
+INDEX_HEADER = struct.Struct('<8sQ')
+INDEX_DTYPE = np.dtype([('hash', '<u8'),  # #name_hash of the contig name
+                        ('record', '<u4'),  # index of the contig in toc_binary
+                        ('reserved', '<u4')])
+
+
+def read_sources(toc_file: str):
+    """
+    Returns the original directories of the contigs listed in the sources file next to toc_file, or None if there is
+    no such file (i.e. the data set was not repacked and all contigs come from the directory of toc_file)
+    """
+    sources_file = os.path.join(os.path.dirname(toc_file), 'sources')
+    if not os.path.exists(sources_file):
+        return None
+    with open(sources_file) as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def name_hash(name: bytes) -> int:
+    """ Stable 64-bit hash of a utf-8 encoded contig name (Python's hash() is randomized across processes) """
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), 'little')
+
+
+class BinaryToc:
+    """
+    A memory-mapped toc_binary file. #records, #breakpoints and #names are read-only views into the mapping.
+    """
+
+    def __init__(self, fname: str):
+        with open(fname, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+        if size < TOC_HEADER.size:
+            raise ValueError(f'{fname} is not a valid binary toc file (too short)')
+        magic, contig_count, breakpoint_count, names_size = TOC_HEADER.unpack_from(self._mm, 0)
+        if magic != TOC_MAGIC:
+            raise ValueError(f'{fname} is not a valid binary toc file (bad magic: {magic})')
+        pos = TOC_HEADER.size
+        self.records = np.frombuffer(self._mm, dtype=TOC_DTYPE, count=contig_count, offset=pos)
+        pos += contig_count * TOC_DTYPE.itemsize
+        self.breakpoints = np.frombuffer(self._mm, dtype='<u4', count=2 * breakpoint_count,
+                                         offset=pos).reshape(-1, 2)
+        pos += 8 * breakpoint_count
+        self.names = memoryview(self._mm)[pos:pos + names_size]
+
+    def __len__(self):
+        return len(self.records)
+
+    def name(self, idx: int) -> str:
+        offset = int(self.records['name_offset'][idx])
+        return bytes(self.names[offset:offset + int(self.records['name_len'][idx])]).decode('utf-8')
+
+    def contig_breakpoints(self, idx: int):
+        start = int(self.records['breakpoint_idx'][idx])
+        stop = start + int(self.records['breakpoint_cnt'][idx])
+        return [(int(b[0]), int(b[1])) for b in self.breakpoints[start:stop]]
+
+
+class NameIndex:
+    """
+    A memory-mapped toc_index file, used together with the toc_binary file it was created from.
+    """
+
+    def __init__(self, fname: str, binary_toc: BinaryToc):
+        with open(fname, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+        if size < INDEX_HEADER.size:
+            raise ValueError(f'{fname} is not a valid name index file (too short)')
+        magic, count = INDEX_HEADER.unpack_from(self._mm, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f'{fname} is not a valid name index file (bad magic: {magic})')
+        if count != len(binary_toc):
+            raise ValueError(f'{fname} has {count} entries, but the binary toc has {len(binary_toc)} contigs')
+        self.entries = np.frombuffer(self._mm, dtype=INDEX_DTYPE, count=count, offset=INDEX_HEADER.size)
+        self.binary_toc = binary_toc
+
+    def find(self, name: str):
+        """ Returns the indices in the binary toc of the contigs with the given name (usually zero or one) """
+        h = np.uint64(name_hash(name.encode('utf-8')))
+        lo = np.searchsorted(self.entries['hash'], h, side='left')
+        hi = np.searchsorted(self.entries['hash'], h, side='right')
+        return [int(r) for r in self.entries['record'][lo:hi] if self.binary_toc.name(int(r)) == name]
+
+
+def write_name_index(binary_toc_file: str, out_file: str):
+    """
+    Writes the name index (toc_index) for the contigs in binary_toc_file.
+    Returns:
+        - the number of contigs written
+    """
+    binary_toc = BinaryToc(binary_toc_file)
+    entries = np.zeros(len(binary_toc), dtype=INDEX_DTYPE)
+    names = binary_toc.names
+    for i, (offset, length) in enumerate(zip(binary_toc.records['name_offset'].tolist(),
+                                            binary_toc.records['name_len'].tolist())):
+        entries['hash'][i] = name_hash(names[offset:offset + length])
+    entries['record'] = np.arange(len(binary_toc))
+    entries = entries[np.argsort(entries['hash'], kind='stable')]
+
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'wb') as out:
+        out.write(INDEX_HEADER.pack(INDEX_MAGIC, len(entries)))
+        out.write(entries.tobytes())
+    os.replace(tmp_file, out_file)
+    return len(entries)
+
+
+def write_binary_toc(toc_file: str, out_file: str):
+    """
+    Converts the tab-separated toc_file (as written by bam2feat) to a toc_binary file.
+    Returns:
+        - the number of contigs written
+    """
+    names = bytearray()
+    records = []
+    breakpoints = []
+    offset = 0
+    with open(toc_file) as f:
+        rd = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        next(rd, None)  # skip header
+        for row in rd:
+            # the fields in row are: name, length (bases), misassembly_count, size_bytes, breakpoints, coverage and,
+            # for repacked data sets, the source id
+            name = row[0].encode('utf-8')
+            bp_idx = len(breakpoints)
+            if len(row) >= 5 and row[4] != '-':
+                for break_point in row[4].split(','):
+                    start_stop = break_point.split('-')
+                    breakpoints.append((int(start_stop[0]), int(start_stop[1])))
+            avg_coverage = float(row[5]) if len(row) >= 6 else 100
+            source = int(row[6]) if len(row) >= 7 else 0
+            records.append((offset, len(names), len(name), int(row[1]), int(row[3]), int(row[2]), avg_coverage,
+                            bp_idx, len(breakpoints) - bp_idx, source))
+            names += name
+            offset += int(row[3])
+
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'wb') as out:
+        out.write(TOC_HEADER.pack(TOC_MAGIC, len(records), len(breakpoints), len(names)))
+        out.write(np.array(records, dtype=TOC_DTYPE).tobytes())
+        out.write(np.array(breakpoints, dtype='<u4').reshape(-1, 2).tobytes())
+        out.write(names)
+    os.replace(tmp_file, out_file)
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert toc files to the binary, memory-mappable toc_binary format '
+                                                 'and create the contig name index (toc_index) for each of them')
+    parser.add_argument('--feature-files-path', default='.', type=str,
+                        help='Path to the feature files produced by ResMiCo-SM (default: %(default)s)')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['CRITICAL', 'FATAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help='Logging level (default: %(default)s)')
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging._nameToLevel[args.log_level.upper()])
+
+    toc_files = sorted(glob(args.feature_files_path + '/**/toc', recursive=True))
+    logging.info(f'Converting {len(toc_files)} toc files...')
+    for toc_file in toc_files:
+        count = write_binary_toc(toc_file, toc_file + '_binary')
+        write_name_index(toc_file + '_binary', toc_file + '_index')
+        logging.debug(f'Wrote {count} contigs to {toc_file}_binary and {toc_file}_index')
+    logging.info('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,53 @@ import logging
 import math
 import time
 import atexit
+from typing import Dict
 
 import numpy as np
 import pandas as pd
 import tensorflow as tf
 from tensorflow.keras import backend as K
-from sklearn.metrics import recall_score, average_precision_score
 
+from resmico import batch_workers
 from resmico import contig_reader
+from resmico import distributed
 from resmico import models_fl as Models
+from resmico import training_state
+from resmico import validation
+
+
+def make_train_pipeline(dataset, args, repeat: int, length: int = None, augment=None) -> tf.data.Dataset:
+    """
+    Creates the tf.data pipeline returning the training batches of dataset #repeat times. The batches are built in
+    parallel (up to --n-procs at a time), or in --loader-workers worker processes.
+    Arguments:
+        - dataset: a BinaryDatasetTrain or BinaryDatasetChunks
+        - length: the length of all the batches if it is fixed, None otherwise
+        - augment: the augmentation applied to each batch (see models_fl.make_augmentation), if any
+    """
+    batches, parallel_calls, prefetch = dataset, max(1, args.n_procs), tf.data.AUTOTUNE
+    if args.loader_workers > 0:
+        # each worker process builds one batch while the next one is queued; the ring buffer must hold the batches
+        # being built, those waiting in the pipeline (at most parallel_calls + prefetch) and those used by Keras
+        parallel_calls, prefetch = 2 * args.loader_workers, 2
+        batches = batch_workers.BatchWorkerPool(dataset, args.loader_workers, parallel_calls + prefetch + 4)
+        atexit.register(batches.close)
+    mask_len = None if length is None else dataset.convoluted_size(length, True)
+    result = Models.make_tf_dataset(
+        batches,
+        output_signature=(
+            (tf.TensorSpec(shape=(args.batch_size, length, len(dataset.expanded_feature_names)),
+                           dtype=tf.as_dtype(dataset.dtype)),
+             tf.TensorSpec(shape=(args.batch_size, mask_len), dtype=tf.bool)),
+            tf.TensorSpec(shape=(args.batch_size), dtype=tf.uint8),
+            tf.TensorSpec(shape=(args.batch_size), dtype=tf.float32)),
+        repeat=repeat, parallel_calls=parallel_calls, deterministic=args.deterministic, prefetch=prefetch,
+        augment=augment)
+
+    # set the sharding policy to DATA in order to avoid Tensorflow ugly console barf
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    return result.with_options(options)
 
 
 def main(args):
@@ -30,14 +68,32 @@ def main(args):
 
     logging.info('Building Tensorflow model...')
     logging.info(args)
-    strategy = tf.distribute.MirroredStrategy()
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    strategy, worker_count, worker_index = distributed.make_strategy(args)
+    is_chief = worker_index == 0
+    if worker_count > 1 and args.async_validation_device:
+        raise ValueError('--async-validation-device is not supported with multi-worker training')
 
     with strategy.scope():
         resmico = Models.Resmico(args)
     resmico.print_summary()
 
+    # the workers other than the chief write their checkpoints and logs into their own sub-directory
+    worker_dir = '' if is_chief else f'worker_{worker_index}'
+    # full training checkpoints (model, optimizer and training state), written after every group of epochs
+    checkpoints = training_state.TrainingCheckpoints(
+        os.path.join(args.save_path, args.save_name + '_checkpoints', worker_dir), resmico.net)
+    resume_state = None
+    if args.resume:
+        resume_state = checkpoints.load_state()
+        if resume_state is None:
+            logging.warning(f'No training checkpoint found in {checkpoints.directory}, starting from scratch')
+        elif resume_state.get('worker_count', 1) != worker_count:
+            raise ValueError(f'The checkpoint was written by a training with {resume_state["worker_count"]} workers, '
+                             f'it cannot be resumed with {worker_count} workers')
+
     # tensorboard logs
-    tb_logs = tf.keras.callbacks.TensorBoard(log_dir=os.path.join(args.save_path, args.save_name),
+    tb_logs = tf.keras.callbacks.TensorBoard(log_dir=os.path.join(args.save_path, args.save_name, worker_dir),
                                              histogram_freq=0,
                                              write_graph=True,
                                              write_images=True)
@@ -46,116 +102,148 @@ def main(args):
     reader = contig_reader.ContigReader(args.feature_files_path, args.features, args.n_procs,
                                         args.no_cython, args.stats_file, min_len=args.min_contig_len,
                                         min_avg_coverage=args.min_avg_coverage,
-                                        feature_file_match=args.feature_file_match)
+                                        feature_file_match=args.feature_file_match,
+                                        max_in_flight=max(1, args.prefetch_batches))
 
     # separate data into 90% for training and 10% for evaluation
     all_idx = np.arange(len(reader))
-    if args.val_ind_f:
+    if resume_state is not None:
+        logging.info('Split data: using the split of the resumed training')
+        train_idx, eval_idx = resume_state['train_idx'], resume_state['eval_idx']
+    elif args.val_ind_f:
         logging.info(f'Split data: using {args.val_ind_f} for validation, for training everything else')
         eval_idx = list(pd.read_csv(args.val_ind_f)['val_ind'])
-        train_idx = list(set(all_idx) - set(eval_idx))
+        train_idx = np.setdiff1d(all_idx, eval_idx)
     else:
         np.random.shuffle(all_idx)
         train_idx = all_idx[:(9 * len(reader)) // 10]
         eval_idx = all_idx[(9 * len(reader)) // 10:]
-        df = pd.DataFrame(eval_idx, columns=['val_ind'])
-        if os.path.isfile(args.feature_files_path):
-            fname = os.path.join(os.path.split(args.feature_files_path)[0], "evaluation_indices.csv")
-        else:
-            fname = os.path.join(args.feature_files_path.split(",")[0], "evaluation_indices.csv")
-        df.to_csv(fname)
-        logging.info(f'Evaluation indices saved to: {fname}')
+        if is_chief:
+            df = pd.DataFrame(eval_idx, columns=['val_ind'])
+            if os.path.isfile(args.feature_files_path):
+                fname = os.path.join(os.path.split(args.feature_files_path)[0], "evaluation_indices.csv")
+            else:
+                fname = os.path.join(args.feature_files_path.split(",")[0], "evaluation_indices.csv")
+            df.to_csv(fname)
+            logging.info(f'Evaluation indices saved to: {fname}')
     logging.info(f'Using {len(train_idx)} contigs for training, {len(eval_idx)} contigs for evaluation')
 
+    # each worker trains and validates on its own shard of the contigs (see distributed.shard_indices)
+    worker_train_idx, worker_eval_idx, eval_shard_size = train_idx, eval_idx, len(eval_idx)
+    if worker_count > 1:
+        lengths, is_positive = reader.metadata.lengths, reader.metadata.misassembly != 0
+        train_shards = distributed.shard_indices(train_idx, np.minimum(lengths[train_idx], args.max_len),
+                                                 is_positive[train_idx], worker_count)
+        eval_shards = distributed.shard_indices(eval_idx, lengths[eval_idx], is_positive[eval_idx], worker_count)
+        worker_train_idx, worker_eval_idx = train_shards[worker_index], eval_shards[worker_index]
+        eval_shard_size = max(len(shard) for shard in eval_shards)
+        if min(len(shard) for shard in eval_shards) == 0:
+            raise ValueError(f'{len(eval_idx)} validation contigs are not enough for {worker_count} workers')
+        logging.info(f'Worker {worker_index} uses {len(worker_train_idx)} contigs for training, '
+                     f'{len(worker_eval_idx)} contigs for evaluation')
+
     # create data generators for training data and evaluation data
-    train_data = Models.BinaryDatasetTrain(reader, train_idx, args.batch_size, args.features, args.max_len,
+    train_data = Models.BinaryDatasetTrain(reader, worker_train_idx, args.batch_size, args.features, args.max_len,
                                            args.num_translations, args.max_translation_bases, args.fraq_neg,
                                            args.cache_train or args.cache, args.log_progress, resmico.convoluted_size,
-                                           resmico.fixed_length, args.weight_factor)
-    # convert the slow Keras train_data of type Sequence to a tf.data object
-    # first, we convert the keras sequence into a generator-like object
-    data_iter = lambda: (s for s in train_data)
-
-    # second, we use tf.data.Dataset.from_generator to create a tf.data.Dataset object and use this for training
-    train_data_tf = tf.data.Dataset.from_generator(
-        data_iter,
-        output_signature=(
-            (tf.TensorSpec(shape=(args.batch_size, None, len(train_data.expanded_feature_names)), dtype=tf.float32),
-             tf.TensorSpec(shape=(args.batch_size, None), dtype=tf.bool)),
-            tf.TensorSpec(shape=(args.batch_size), dtype=tf.uint8),
-            tf.TensorSpec(shape=(args.batch_size), dtype=tf.float32)))
+                                           resmico.fixed_length, args.weight_factor, args.tensor_cache_dir,
+                                           args.tensor_cache_dtype, args.fused_reader, args.prefetch_batches,
+                                           args.feature_dtype, args.length_buckets, int(args.cache_mem_gb * 1e9),
+                                           args.cache_spill_dir, int(args.cache_spill_gb * 1e9), args.jit_compile)
+    if resume_state is not None:  # before the pipeline (and its worker processes) is created
+        train_data.set_state(resume_state['train_data'])
+    num_epochs = 2
+    augment = None
+    if args.augment_reverse_prob > 0 or args.augment_max_shift > 0:
+        logging.info(f'Augmenting the training batches: reverse complement probability {args.augment_reverse_prob}, '
+                     f'maximum shift {args.augment_max_shift}')
+        augment = Models.make_augmentation(train_data.expanded_feature_names, resmico.convoluted_size, args.max_len,
+                                           resmico.fixed_length, args.augment_reverse_prob, args.augment_max_shift)
+    train_data_tf = make_train_pipeline(train_data, args, num_epochs, augment=augment)
 
-    # add a prefetch option that builds the next batch ready for consumption by the GPU as it is working on
-    # the current batch.
-    train_data_tf = train_data_tf.prefetch(2 * strategy.num_replicas_in_sync)
+    # pretraining on the fixed-length chunks in the toc_chunked files
+    chunk_data = chunk_data_tf = None
+    if args.chunk_epochs > 0:
+        if resmico.fixed_length:
+            raise ValueError(f'--chunk-epochs requires a variable length network, {args.net_type} is fixed length')
+        chunk_data = Models.BinaryDatasetChunks(reader, worker_train_idx, args.batch_size, args.features, args.fraq_neg,
+                                                resmico.convoluted_size, args.chunk_toc, args.cache_train or args.cache,
+                                                args.tensor_cache_dir, args.tensor_cache_dtype, args.feature_dtype,
+                                                int(args.cache_mem_gb * 1e9))
+        if len(chunk_data) == 0:
+            raise ValueError(f'No training chunks found in the {args.chunk_toc} files')
+        if resume_state is not None:
+            chunk_data.set_state(resume_state['chunk_data'])
+        chunk_augment = None
+        if args.augment_reverse_prob > 0:  # the chunks fill the batches, so they are not shifted
+            chunk_augment = Models.make_augmentation(chunk_data.expanded_feature_names, resmico.convoluted_size,
+                                                     chunk_data.chunk_len, True, args.augment_reverse_prob)
+        chunk_data_tf = make_train_pipeline(chunk_data, args, num_epochs, chunk_data.chunk_len, chunk_augment)
 
-    # set the sharding policy to DATA in order to avoid Tensorflow ugly console barf
-    options = tf.data.Options()
-    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
-    train_data_tf = train_data_tf.with_options(options)
+    # the number of steps per epoch of each dataset, which must be the same on all the workers
+    steps = {train_data: len(train_data)}
+    if chunk_data is not None:
+        steps[chunk_data] = len(chunk_data)
+    if worker_count > 1:
+        for dataset in steps:
+            steps[dataset] = distributed.global_min(strategy, steps[dataset])
+            if steps[dataset] < len(dataset):
+                logging.info(f'Using {steps[dataset]} of the {len(dataset)} batches of this worker per epoch')
+        if min(steps.values()) == 0:
+            raise ValueError('A worker has less than one batch of training data')
+        train_data_tf = distributed.worker_dataset(train_data_tf)
+        if chunk_data_tf is not None:
+            chunk_data_tf = distributed.worker_dataset(chunk_data_tf)
 
     np.seterr(all='raise')
-    eval_data = Models.BinaryDatasetEval(reader, eval_idx, args.features, args.max_len, args.max_len-500,
-                                         int(args.gpu_eval_mem_gb * 1e9 * 0.8), args.cache_validation or args.cache,
-                                         args.log_progress, resmico.convoluted_size, resmico.fixed_length)
-
-    eval_data_y = np.array([0 if reader.contigs[idx].misassembly == 0 else 1 for idx in eval_data.indices])
+    first_epoch = 0
+    if resume_state is not None:
+        # the datasets consumed random numbers when created, so the random state is restored afterwards
+        np.random.set_state(resume_state['numpy_rng'])
+        checkpoints.restore()
+        first_epoch = resume_state['epoch'] + 1
+        logging.info(f'Resuming training after {first_epoch * num_epochs} epochs')
 
-    # convert the slow Keras eval_data of type Sequence to a tf.data object
-    data_iter = lambda: (s for s in eval_data)
-    eval_data_tf = tf.data.Dataset.from_generator(
-        data_iter,
-        output_signature=(
-            # first dimension is batch size, second is contig length, third is number of features
-            (tf.TensorSpec(shape=(None, None, len(eval_data.expanded_feature_names)), dtype=tf.float32),
-             # first dimension is batch size, second is contig length (no third dimension,
-             # as all features are masked the same way)
-             tf.TensorSpec(shape=(None, None), dtype=tf.bool)),
-            tf.TensorSpec(shape=(None), dtype=tf.bool)
-        ))
-    eval_data_tf = eval_data_tf.prefetch(4 * strategy.num_replicas_in_sync)
-    eval_data_tf = eval_data_tf.with_options(options)  # avoids Tensorflow ugly console barf
+    validation_worker = None
+    if args.async_validation_device:
+        validation_worker = validation.ValidationWorker(reader, eval_idx, args, args.async_validation_device)
+        atexit.register(validation_worker.close)
+    else:
+        eval_data = Models.BinaryDatasetEval(reader, worker_eval_idx, args.features, args.max_len, args.max_len-500,
+                                             int(args.gpu_eval_mem_gb * 1e9 * 0.8),
+                                             args.cache_validation or args.cache, args.log_progress,
+                                             resmico.convoluted_size, resmico.fixed_length, args.tensor_cache_dir,
+                                             args.tensor_cache_dtype, args.fused_reader, args.prefetch_batches,
+                                             args.feature_dtype)
+        eval_data_y = (reader.metadata.misassembly[np.asarray(eval_data.indices, dtype=np.int64)] != 0).astype(int)
+        eval_data_tf = validation.make_eval_dataset(eval_data, max(1, args.n_procs))
 
     logging.info('Training network...')
-    num_epochs = 2
-    train_data_tf = train_data_tf.repeat(num_epochs)
     auc_val_best = 0
     auc_val_prev = 0
+    auc_val = 0
     best_file = None
-    for epoch in range(math.ceil(args.n_epochs / num_epochs)):
-        start = time.time()
-        resmico.net.fit(x=train_data_tf,
-                        epochs=num_epochs,
-                        steps_per_epoch=len(train_data),
-                        workers=args.n_procs,
-                        use_multiprocessing=True,
-                        max_queue_size=max(args.n_procs, 10),
-                        callbacks=[tb_logs],
-                        verbose=2)
-
-        duration = time.time() - start
-        logging.info(f'Fitted {num_epochs} epochs in {duration:.0f}s')
-        train_data.on_epoch_end()
+    # the (epoch, file) of the saved models whose asynchronous validation is pending
+    pending_checkpoints = []
+    if resume_state is not None:
+        auc_val_best, auc_val_prev, auc_val = [resume_state[key] for key in ['auc_val_best', 'auc_val_prev', 'auc_val']]
+        best_file = resume_state['best_file']
+        for cur_epoch, checkpoint in resume_state['pending_checkpoints']:
+            if validation_worker is not None and os.path.exists(checkpoint):
+                validation_worker.submit(cur_epoch, checkpoint)
+                pending_checkpoints.append((cur_epoch, checkpoint))
 
-        logging.info('Starting validation')
-        start = time.time()
-        eval_data_flat_y = resmico.predict(x=eval_data_tf,
-                                           workers=args.n_procs,
-                                           use_multiprocessing=True,
-                                           max_queue_size=max(args.n_procs, 10),
-                                           verbose=2)
-        eval_data_predicted_y = eval_data.group(eval_data_flat_y)
-
-        auc_val = average_precision_score(eval_data_y, eval_data_predicted_y)
-        recall1_val = recall_score(eval_data_y, eval_data_predicted_y > 0.5, pos_label=1)
-        recall0_val = recall_score(eval_data_y, eval_data_predicted_y > 0.5, pos_label=0)
-        logging.info(f'Validation scores after {(epoch + 1) * num_epochs} epochs: aucPR: {auc_val} - '
-                     f'recall1: {recall1_val} - recall0: {recall0_val} - mean: {np.mean(eval_data_predicted_y)}')
-        duration = time.time() - start
-        logging.info(f'Validation done in {duration:.0f}s')
+    def on_validation(cur_epoch: int, scores: Dict[str, float], save_model):
+        """
+        Updates the learning rate and the best model given the validation scores of the model after cur_epoch
+        epochs; save_model(path) writes that model to path.
+        """
+        nonlocal auc_val_best, auc_val_prev, auc_val, best_file
+        auc_val = scores['aucPR']
+        logging.info(f'Validation scores after {cur_epoch} epochs: aucPR: {auc_val} - '
+                     f'recall1: {scores["recall1"]} - recall0: {scores["recall0"]} - mean: {scores["mean"]}')
 
         # update the learning rate
-        cur_epoch = (epoch + 1) * num_epochs
         if cur_epoch > 10 and auc_val < auc_val_prev:
             lr_old = K.get_value(resmico.net.optimizer.lr)
             K.set_value(resmico.net.optimizer.lr, lr_old * 0.8)  # changed for 120h jobs
@@ -163,7 +251,7 @@ def main(args):
 
         auc_val_prev = auc_val
         if auc_val > auc_val_best:
-            if best_file:  # delete old best model
+            if best_file and is_chief:  # delete old best model
                 try:
                     os.remove(best_file)
                 except OSError:
@@ -172,17 +260,85 @@ def main(args):
             best_file = os.path.join(args.save_path, '_'.join(
                 ['mc_epoch', str(cur_epoch), 'aucPR', str(auc_val_best)[:5], args.save_name,
                  'model.h5']))
-            resmico.save(best_file)
-            logging.info(f'New best model written to: {best_file}')
+            save_model(best_file)
+            if is_chief:
+                logging.info(f'New best model written to: {best_file}')
+
+    def on_checkpoint_validation(cur_epoch: int, checkpoint: str, scores: Dict[str, float], duration: float):
+        logging.info(f'Validation of the checkpoint after {cur_epoch} epochs done in {duration:.0f}s')
+        pending_checkpoints.remove((cur_epoch, checkpoint))
+        on_validation(cur_epoch, scores, lambda path: os.replace(checkpoint, path))
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    for epoch in range(first_epoch, math.ceil(args.n_epochs / num_epochs)):
+        # curriculum: the first --chunk-epochs epochs are trained on chunks, the following ones on full contigs
+        epoch_data, epoch_data_tf = train_data, train_data_tf
+        if epoch * num_epochs < args.chunk_epochs:
+            epoch_data, epoch_data_tf = chunk_data, chunk_data_tf
+            logging.info(f'Training on chunks of length {chunk_data.chunk_len}')
+        elif chunk_data is not None and (epoch - 1) * num_epochs < args.chunk_epochs:
+            logging.info('Training on full contigs')
+        start = time.time()
+        resmico.net.fit(x=epoch_data_tf,
+                        epochs=num_epochs,
+                        steps_per_epoch=steps[epoch_data],
+                        callbacks=[tb_logs],
+                        verbose=2)
+
+        duration = time.time() - start
+        logging.info(f'Fitted {num_epochs} epochs in {duration:.0f}s')
+        epoch_data.on_epoch_end()
+        cur_epoch = (epoch + 1) * num_epochs
+
+        if validation_worker is not None:
+            # validate the checkpoint in the background and use the results that are ready
+            checkpoint = os.path.join(args.save_path, f'{args.save_name}_checkpoint_e{cur_epoch}.h5')
+            resmico.save(checkpoint)
+            validation_worker.submit(cur_epoch, checkpoint)
+            pending_checkpoints.append((cur_epoch, checkpoint))
+            for result in validation_worker.results():
+                on_checkpoint_validation(*result)
+        else:
+            logging.info('Starting validation')
+            start = time.time()
+            if worker_count > 1:
+                eval_data_predicted_y = eval_data.group(distributed.predict_local(resmico.net, eval_data_tf))
+                # every worker computes the scores of all the validation contigs
+                gathered = distributed.all_gather(
+                    strategy, np.stack([eval_data_y, eval_data_predicted_y], axis=1), eval_shard_size)
+                scores = validation.scores(gathered[:, 0].astype(int), gathered[:, 1])
+            else:
+                eval_data_flat_y = resmico.predict(x=eval_data_tf, verbose=2)
+                eval_data_predicted_y = eval_data.group(eval_data_flat_y)
+                scores = validation.scores(eval_data_y, eval_data_predicted_y)
+            on_validation(cur_epoch, scores, lambda path: distributed.save_model(resmico.net, path, is_chief))
+            duration = time.time() - start
+            logging.info(f'Validation done in {duration:.0f}s')
+
+        checkpoints.save(epoch, {
+            'epoch': epoch, 'train_idx': train_idx, 'eval_idx': eval_idx, 'numpy_rng': np.random.get_state(),
+            'train_data': train_data.get_state(), 'chunk_data': chunk_data.get_state() if chunk_data else None,
+            'auc_val_best': auc_val_best, 'auc_val_prev': auc_val_prev, 'auc_val': auc_val, 'best_file': best_file,
+            'pending_checkpoints': list(pending_checkpoints), 'worker_count': worker_count})
+
+    if validation_worker is not None:
+        logging.info(f'Waiting for the validation of {validation_worker.pending} checkpoints')
+        for result in validation_worker.results(wait=True):
+            on_checkpoint_validation(*result)
+        validation_worker.close()
 
     # saving
     logging.info('Saving trained model...')
     outfile = os.path.join(args.save_path, args.save_name + '_' + str(auc_val)[:5] + '_e' + str(args.n_epochs) + '.h5')
-    resmico.save(outfile)
-    logging.info(f'Latest model written to: {outfile}')
-    
+    distributed.save_model(resmico.net, outfile, is_chief)
+    if is_chief:
+        logging.info(f'Latest model written to: {outfile}')
+
     # exit
-    atexit.register(strategy._extended._collective_ops._pool.close)
+    pool = getattr(getattr(strategy.extended, '_collective_ops', None), '_pool', None)
+    if pool is not None:  # only some strategies and Tensorflow versions have a thread pool to close
+        atexit.register(pool.close)
 
 
 if __name__ == '__main__':
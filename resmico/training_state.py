@@ -0,0 +1,68 @@
+"""
+Full training checkpoints, used to resume a training run that was interrupted (see --resume). A checkpoint consists of:
+  - a Tensorflow checkpoint of the model weights, the optimizer (slots, iteration count, learning rate, loss scale)
+    and the global Tensorflow random generator
+  - a pickled dictionary with the rest of the training state (epoch counter, best-score bookkeeping, train/validation
+    split, NumPy random state and the state of the training datasets), written next to the Tensorflow checkpoint
+"""
+import glob
+import logging
+import os
+import pickle
+from typing import Dict, Optional
+
+import tensorflow as tf
+
+_STATE_SUFFIX = '.state'
+
+
+class TrainingCheckpoints:
+    def __init__(self, directory: str, model: tf.keras.Model, max_to_keep: int = 2):
+        """
+        Arguments:
+            - directory: the directory where the checkpoints are written
+            - model: the compiled model being trained
+            - max_to_keep: the number of most recent checkpoints that are kept
+        """
+        self.directory = directory
+        self.model = model
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer,
+                                              rng=tf.random.get_global_generator())
+        self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep)
+
+    def save(self, number: int, state: Dict):
+        """ Writes checkpoint #number with the model, the optimizer and #state """
+        path = self.manager.save(checkpoint_number=number)
+        # the state is written after the Tensorflow checkpoint, so a checkpoint is complete iff it has a state file
+        tmp_file = path + _STATE_SUFFIX + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(tmp_file, path + _STATE_SUFFIX)
+        # remove the state files of the checkpoints deleted by the manager
+        for state_file in glob.glob(os.path.join(self.directory, '*' + _STATE_SUFFIX)):
+            if state_file[:-len(_STATE_SUFFIX)] not in self.manager.checkpoints:
+                os.remove(state_file)
+        logging.info(f'Training checkpoint written to: {path}')
+
+    def _latest(self) -> Optional[str]:
+        """ Returns the path of the latest complete checkpoint, if any """
+        for path in reversed(self.manager.checkpoints):
+            if os.path.exists(path + _STATE_SUFFIX):
+                return path
+        return None
+
+    def load_state(self) -> Optional[Dict]:
+        """ Returns the training state of the latest checkpoint, or None if there is no checkpoint """
+        path = self._latest()
+        if path is None:
+            return None
+        with open(path + _STATE_SUFFIX, 'rb') as f:
+            return pickle.load(f)
+
+    def restore(self):
+        """ Restores the model and optimizer of the latest checkpoint """
+        path = self._latest()
+        # create the optimizer slots, so that they are restored right away rather than when first used
+        self.model.optimizer.build(self.model.trainable_variables)
+        self.checkpoint.restore(path).assert_existing_objects_matched()
+        logging.info(f'Restored training checkpoint: {path}')
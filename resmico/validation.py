@@ -0,0 +1,152 @@
+"""
+Validation of the model during training. By default, training stops after each group of epochs to predict the
+validation contigs on the training devices; with --async-validation-device, the model is saved to a checkpoint that is
+validated by a ValidationWorker process (on the CPU or on a different GPU) while training continues, and the scores
+are used (for learning rate decay and best model selection) as they arrive.
+"""
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+import traceback
+from typing import Dict, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+from sklearn.metrics import recall_score, average_precision_score
+
+from resmico import models_fl as Models
+from resmico import utils
+
+# the interval (in seconds) at which the liveness of the worker is checked while waiting for results
+_POLL_SECONDS = 1
+
+
+def scores(eval_data_y: np.ndarray, eval_data_predicted_y: np.ndarray) -> Dict[str, float]:
+    """ Returns the validation scores (aucPR, recall of each class, mean prediction) of the contig predictions """
+    return {'aucPR': average_precision_score(eval_data_y, eval_data_predicted_y),
+            'recall1': recall_score(eval_data_y, eval_data_predicted_y > 0.5, pos_label=1),
+            'recall0': recall_score(eval_data_y, eval_data_predicted_y > 0.5, pos_label=0),
+            'mean': float(np.mean(eval_data_predicted_y))}
+
+
+def make_eval_dataset(eval_data: Models.BinaryDatasetEval, parallel_calls: int) -> tf.data.Dataset:
+    """ Creates the tf.data pipeline of the validation batches """
+    # the predictions are grouped by contig in batch order, so the evaluation batches must stay in order
+    eval_data_tf = Models.make_tf_dataset(
+        eval_data,
+        output_signature=(
+            # first dimension is batch size, second is contig length, third is number of features
+            (tf.TensorSpec(shape=(None, None, len(eval_data.expanded_feature_names)),
+                           dtype=tf.as_dtype(eval_data.dtype)),
+             # first dimension is batch size, second is contig length (no third dimension,
+             # as all features are masked the same way)
+             tf.TensorSpec(shape=(None, None), dtype=tf.bool)),
+            tf.TensorSpec(shape=(None), dtype=tf.bool)
+        ), parallel_calls=parallel_calls, deterministic=True)
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    return eval_data_tf.with_options(options)  # avoids Tensorflow ugly console barf
+
+
+def _worker(reader, eval_idx: List[int], args, device: str, tasks, results):
+    """ Validates the checkpoints received in #tasks until it receives None """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # interrupts are handled by the training process
+    logging.basicConfig(format='%(asctime)s - validation - %(message)s',
+                        level=logging._nameToLevel[args.log_level.upper()])
+    gpu_devices = tf.config.list_physical_devices('GPU')
+    visible_devices = [] if device == 'cpu' else [gpu_devices[int(device)]]
+    tf.config.set_visible_devices(visible_devices, 'GPU')
+    for gpu_device in visible_devices:
+        tf.config.experimental.set_memory_growth(gpu_device, True)
+    tf.keras.mixed_precision.set_global_policy(args.precision)
+    custom_obj = {'class_recall_0': utils.class_recall_0, 'class_recall_1': utils.class_recall_1,
+                  'GlobalMaskedMaxPooling1D': Models.GlobalMaskedMaxPooling1D}
+    eval_data = eval_data_y = eval_data_tf = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        cur_epoch, checkpoint = task
+        try:
+            start = time.time()
+            model = tf.keras.models.load_model(checkpoint, custom_objects=custom_obj, compile=False)
+            if eval_data is None:  # all the checkpoints have the same architecture
+                is_fixed_length = model.layers[0].input_shape[0][1] is not None
+                eval_data = Models.BinaryDatasetEval(reader, eval_idx, args.features, args.max_len,
+                                                     args.max_len - 500, int(args.gpu_eval_mem_gb * 1e9 * 0.8),
+                                                     args.cache_validation or args.cache, False,
+                                                     Models.construct_convolution_lambda(model), is_fixed_length,
+                                                     args.tensor_cache_dir, args.tensor_cache_dtype,
+                                                     args.fused_reader, args.prefetch_batches, args.feature_dtype)
+                eval_data_y = (reader.metadata.misassembly[np.asarray(eval_data.indices, dtype=np.int64)] != 0) \
+                    .astype(int)
+                eval_data_tf = make_eval_dataset(eval_data, max(1, args.n_procs))
+            eval_data_predicted_y = eval_data.group(model.predict(x=eval_data_tf, verbose=0))
+            results.put((cur_epoch, checkpoint, scores(eval_data_y, eval_data_predicted_y), time.time() - start,
+                         None))
+        except Exception:
+            results.put((cur_epoch, checkpoint, None, 0, traceback.format_exc()))
+
+
+class ValidationWorker:
+    def __init__(self, reader, eval_idx: List[int], args, device: str = 'cpu'):
+        """
+        Arguments:
+            - reader: ContigReader instance with all the contig metadata
+            - eval_idx: the positions in #reader of the validation contigs
+            - args: the training arguments (features, max_len, caching and precision options, etc.)
+            - device: 'cpu', or the index of the GPU used for validation
+        """
+        # the training process has initialized Tensorflow, which isn't safe to fork
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(target=_worker, name='validation-worker', daemon=True,
+                                        args=(reader, list(eval_idx), args, device, self._tasks, self._results))
+        self._process.start()
+        self.pending = 0
+        logging.info(f'Validating checkpoints asynchronously on device: {device}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, cur_epoch: int, checkpoint: str):
+        """ Queues the validation of the model saved in #checkpoint after #cur_epoch epochs """
+        self._tasks.put((cur_epoch, checkpoint))
+        self.pending += 1
+
+    def results(self, wait: bool = False) -> List[Tuple[int, str, Dict[str, float], float]]:
+        """
+        Returns the (epoch, checkpoint, scores, duration) of the validations completed since the last call, in the
+        order of submission. If #wait is True, waits until all the submitted checkpoints are validated.
+        """
+        result = []
+        while self.pending > 0:
+            try:
+                cur_epoch, checkpoint, checkpoint_scores, duration, error = \
+                    self._results.get(timeout=_POLL_SECONDS) if wait else self._results.get_nowait()
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(f'The validation worker exited with code {self._process.exitcode}')
+                if wait:
+                    continue
+                break
+            self.pending -= 1
+            if error is not None:
+                raise RuntimeError(f'Validating {checkpoint} failed:\n{error}')
+            result.append((cur_epoch, checkpoint, checkpoint_scores, duration))
+        return result
+
+    def close(self):
+        """ Stops the worker; the checkpoints whose validation is still pending are not validated """
+        if self._process.is_alive():
+            if self.pending > 0:
+                self._process.terminate()
+            else:
+                self._tasks.put(None)
+            self._process.join()